@@ -1,60 +1,347 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
 import math
-from typing import List
+import multiprocessing
+import multiprocessing.process
+import multiprocessing.queues
+import multiprocessing.synchronize
+import os
+import queue
+import time
+from typing import Any, Callable, Coroutine, List, Sequence
 
 import broker
+import broker_server
 import config
+import dedup
+import gateway
+import local_stats
+import loop_probe
+import metrics_export
 import monitor
 import producer
-import sender
+import recipients
+import retry
+import sender_pool
+import shm_broker
+from sms_message import MessageBatch
 import stats_collector
+import wal
+import worker
 
 
 class Application:
-    def __init__(self, config_file_name: str) -> None:
+    # If `conf` is given it is used as is, and `config_file_name` is not read.
+    def __init__(
+        self, config_file_name: str, conf: None | config.Config = None
+    ) -> None:
         self.config_file_name = config_file_name
-        self.config: None | config.Config = None
+        self.config: None | config.Config = conf
 
     async def run(self) -> None:
-        self.config = config.read_config(self.config_file_name)
+        if self.config is None:
+            self.config = config.read_config(self.config_file_name)
         self.stats_collector = stats_collector.StatsCollector()
-        # TODO: add a separate config for message broker queue size
-        self.broker = broker.MessageBroker(self.config)
-        self.monitor = monitor.Monitor(self.config, self.stats_collector)
+        await self.stats_collector.log_started()
+        self.broker: broker.Broker
+        self.retries: None | retry.RetryQueue = None
+        self.wal: None | wal.WriteAheadLog = None
+        self.recovered: List[MessageBatch] = []
+        lane_depths: None | Callable[[], Sequence[int]] = None
+        if self.config.simulation and self.config.sender_backend == "http":
+            raise ValueError("The http sender backend cannot run in simulation mode")
+        self.server_processes: List[multiprocessing.process.BaseProcess] = []
+        if self.config.sender_backend == "http" and self.config.gateway_stub:
+            await self._start_server_process(gateway.run_stub)
+        if self.config.worker_processes > 1:
+            if self.config.wal_dir:
+                raise ValueError("The write-ahead log needs worker_processes = 1")
+            # Use "spawn" rather than "fork": forking a process with a running
+            # event loop and executor threads is not safe.
+            self.mp_context = multiprocessing.get_context("spawn")
+            if self.config.broker_backend == "shared_memory":
+                self.broker = shm_broker.SharedMemoryBroker(
+                    self.config, self.mp_context
+                )
+            elif self.config.broker_backend == "queue":
+                self.broker = broker.ProcessQueueBroker(self.config, self.mp_context)
+            elif self.config.broker_backend == "network":
+                if self.config.broker_serve:
+                    await self._start_server_process(broker_server.run_server)
+                self.broker = broker_server.BrokerClient(self.config)
+            else:
+                raise ValueError(
+                    f"Unknown broker backend {self.config.broker_backend!r}"
+                )
+        else:
+            # TODO: add a separate config for message broker queue size
+            local_broker = broker.local_broker(self.config)
+            lane_depths = local_broker.lane_depths
+            self.broker = local_broker
+            if self.config.retry_max_attempts > 1:
+                self.retries = retry.RetryQueue(
+                    self.config, self.broker, self.stats_collector
+                )
+                self.broker = self.retries
+            if self.config.wal_dir:
+                # Carry on from where an earlier run with this log stopped.
+                self.wal = wal.WriteAheadLog(self.config)
+                self.recovered = self.wal.recover()
+                self.broker = wal.DurableBroker(self.config, self.broker, self.wal)
+        clock = asyncio.get_running_loop().time if self.config.simulation else time.time
+        self.monitor = monitor.Monitor(
+            self.config,
+            self.stats_collector,
+            sinks=metrics_export.sinks_from_config(self.config),
+            clock=clock,
+        )
+        self.flusher = local_stats.StatsFlusher(self.config, self.stats_collector)
 
+        self.probe_task: None | asyncio.Task[None] = None
+        if self.config.monitor_probe_interval > 0:
+            probe = loop_probe.LoopProbe(
+                self.config, self.stats_collector, lane_depths
+            )
+            self.probe_task = probe.run()
+        self.flush_task = self.flusher.run()
         self.monitor_task = self.monitor.run()
-        self.produce_task = self._start_producers()
-        self.send_task = self._start_senders()
+        self.produce_task = asyncio.create_task(self._start_producers())
+        if self.config.worker_processes > 1:
+            self.send_task = self._start_workers()
+        else:
+            self.send_task = self._start_senders()
 
-        await asyncio.gather(self.produce_task, self.send_task, return_exceptions=True)
+        _, send_result = await asyncio.gather(
+            self.produce_task, self.send_task, return_exceptions=True
+        )
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+        self.flush_task.cancel()
+        await self.flusher.flush_all()
         self.monitor_task.cancel()
-        
+        await asyncio.gather(self.monitor_task, return_exceptions=True)
+        if self.wal is not None:
+            await self.wal.close()
+        if isinstance(self.broker, shm_broker.SharedMemoryBroker):
+            self.broker.close()
+        elif isinstance(self.broker, broker_server.BrokerClient):
+            await self.broker.close()
+        for process in self.server_processes:
+            process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, process.join)
+        if isinstance(send_result, Exception):
+            raise send_result
+
+    async def _start_server_process(
+        self,
+        target: Callable[[config.Config, multiprocessing.synchronize.Event], None],
+    ) -> None:
+        # Run a server (a stub gateway or a broker server) in its own
+        # process, so that serving requests does not take CPU from this
+        # event loop, and wait until it listens. It is stopped at the end
+        # of the run.
+        assert self.config is not None
+        context = multiprocessing.get_context("spawn")
+        ready = context.Event()
+        process = context.Process(target=target, args=(self.config, ready), daemon=True)
+        process.start()
+        self.server_processes.append(process)
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, ready.wait, 30):
+            raise RuntimeError(f"The server in process {process.pid} did not start")
 
     async def _start_producers(self) -> None:
         # Start parallel producers. When all producers have finished,
         # shut down the broker to signal that no more
         assert self.config is not None
+        loop = asyncio.get_running_loop()
         tasks: List[asyncio.Task[None]] = []
+        message_count = self.config.message_count
+        if self.wal is not None:
+            # Messages logged by earlier runs count towards message_count;
+            # the ones that were not finished are sent first.
+            message_count = max(0, message_count - self.wal.next_sequence)
+            for batch in self.recovered:
+                await self.stats_collector.log_produced(len(batch))
+                await self.broker.put_batch(batch)
+            self.recovered = []
         batch_count = math.ceil(
-            self.config.message_count
-            / self.config.batch_size
-            / self.config.producer_count
+            message_count / self.config.batch_size / self.config.producer_count
         )
-        for i in range(self.config.producer_count):
-            prod = producer.SmsMessageProducer(
-                self.config, self.broker, self.stats_collector
+        executor: None | ProcessPoolExecutor = None
+        if self.config.producer_processes > 0 and not self.config.recipient_file:
+            executor = ProcessPoolExecutor(
+                self.config.producer_processes,
+                mp_context=multiprocessing.get_context("spawn"),
             )
-            task = asyncio.create_task(prod.send_multiple_batches(batch_count, self.config.batch_size))
-            tasks.append(task)
-        await asyncio.gather(*tasks, return_exceptions=True)
+        index: None | dedup.DestinationIndex = None
+        snapshot_path = self.config.dedup_snapshot_path
+        if self.config.dedup_enabled:
+            if snapshot_path and os.path.exists(snapshot_path):
+                index = await loop.run_in_executor(
+                    None, dedup.DestinationIndex.load, snapshot_path
+                )
+            else:
+                index = dedup.DestinationIndex()
+        priorities = self.config.producer_priorities
+        if self.config.recipient_file:
+            tasks = self._start_file_producers(index)
+        else:
+            for i in range(self.config.producer_count):
+                prod = producer.SmsMessageProducer(
+                    self.config,
+                    self.broker,
+                    self.stats_collector,
+                    executor,
+                    self.flusher.local_stats(),
+                    priorities[i] if i < len(priorities) else 0,
+                    index,
+                )
+                task = asyncio.create_task(
+                    self._run_producer(
+                        prod.send_multiple_batches(batch_count, self.config.batch_size),
+                        prod.stats,
+                    )
+                )
+                tasks.append(task)
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
         self.broker.shutdown()
+        if index is not None and snapshot_path:
+            await loop.run_in_executor(None, index.save, snapshot_path)
+
+    async def _run_producer(
+        self, work: Coroutine[Any, Any, None], stats: local_stats.LocalStats
+    ) -> None:
+        # Run a producer, then release its stats buffer from the flusher, as
+        # SenderPool does for each sender.
+        try:
+            await work
+        finally:
+            await self.flusher.release(stats)
+
+    def _start_file_producers(
+        self, index: None | dedup.DestinationIndex
+    ) -> List[asyncio.Task[None]]:
+        # One producer per byte range of the recipient file, resuming from
+        # the saved progress if there is any. Progress is saved as they go,
+        # and once more when they have all finished.
+        assert self.config is not None
+        path = self.config.recipient_file
+        progress_path = self.config.recipient_progress_path
+        ranges = recipients.load_progress(
+            progress_path, os.path.getsize(path), self.config.producer_count
+        )
+        priorities = self.config.producer_priorities
+        producers = [
+            recipients.RecipientFileProducer(
+                self.config,
+                self.broker,
+                self.stats_collector,
+                path,
+                start,
+                end,
+                self.flusher.local_stats(),
+                priorities[i] if i < len(priorities) else 0,
+                index,
+            )
+            for i, (start, end) in enumerate(ranges)
+        ]
+        tasks = [
+            asyncio.create_task(self._run_producer(prod.send_file(), prod.stats))
+            for prod in producers
+        ]
+        if not progress_path:
+            return tasks
+
+        async def save_progress() -> None:
+            assert self.config is not None
+            loop = asyncio.get_running_loop()
+            try:
+                while not all(task.done() for task in tasks):
+                    await asyncio.wait(tasks, timeout=self.config.recipient_progress_interval)
+                    await loop.run_in_executor(
+                        None, recipients.save_progress, progress_path, producers
+                    )
+            finally:
+                recipients.save_progress(progress_path, producers)
+
+        return [*tasks, asyncio.create_task(save_progress())]
 
     async def _start_senders(self) -> None:
         assert self.config is not None
-        tasks: List[asyncio.Task[None]] = []
-        for i in range(self.config.sender_count):
-            send = sender.Sender(self.config, self.broker, self.stats_collector)
-            task = asyncio.create_task(send.consume_messages())
-            tasks.append(task)
-        await asyncio.gather(*tasks, return_exceptions=True)
-        
+        pool = sender_pool.SenderPool(
+            self.config,
+            self.broker,
+            self.stats_collector,
+            self.retries,
+            self.flusher,
+            self.wal,
+        )
+        await pool.run()
+
+    async def _start_workers(self) -> None:
+        # Split the senders across worker processes, each with its own event
+        # loop, and merge their stats into our collector as they report in.
+        assert self.config is not None
+        worker_count = self.config.worker_processes
+        stats_queue: multiprocessing.queues.Queue[worker.StatsReport] = (
+            self.mp_context.Queue()
+        )
+        processes: List[multiprocessing.process.BaseProcess] = []
+        for i in range(worker_count):
+            worker_config = dataclasses.replace(
+                self.config,
+                sender_count=worker.shard_size(
+                    self.config.sender_count, worker_count, i
+                ),
+                max_queued_batches=max(
+                    1, self.config.max_queued_batches // worker_count
+                ),
+                # Each worker gets an even share of every rate limit.
+                rate_limit_global=self.config.rate_limit_global / worker_count,
+                rate_limit_route=self.config.rate_limit_route / worker_count,
+                rate_limit_routes=tuple(
+                    (prefix, rate / worker_count)
+                    for prefix, rate in self.config.rate_limit_routes
+                ),
+            )
+            proc = self.mp_context.Process(
+                target=worker.run_worker,
+                args=(i, worker_config, self.broker, stats_queue),
+                daemon=True,
+            )
+            proc.start()
+            processes.append(proc)
+
+        loop = asyncio.get_running_loop()
+        finished = [False] * worker_count
+        died = [False] * worker_count
+        while not all(finished):
+            try:
+                worker_id, stats, final = await loop.run_in_executor(
+                    None, stats_queue.get, True, self.config.worker_stats_interval
+                )
+            except queue.Empty:
+                # A worker that died without a final report will never
+                # send one, so stop waiting for it.
+                for i, process in enumerate(processes):
+                    if not process.is_alive() and process.exitcode != 0:
+                        finished[i] = died[i] = True
+                continue
+            await self.stats_collector.log_remote_stats(worker_id, stats)
+            if final:
+                finished[worker_id] = True
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        if all(died) and not self.produce_task.done():
+            # Nothing is left to take batches, so the producers would wait
+            # on a full broker forever.
+            self.produce_task.cancel()
+            raise RuntimeError(
+                "All worker processes exited while producers were still running"
+            )
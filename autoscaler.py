@@ -0,0 +1,67 @@
+import asyncio
+from typing import Protocol
+
+from config import Config
+from stats_collector import StatsCollector
+
+
+# A pool of senders whose size can change while it runs.
+class ResizablePool(Protocol):
+    @property
+    def size(self) -> int: ...
+
+    def resize(self, count: int) -> None: ...
+
+
+# Sizes a sender pool at runtime by hill climbing on throughput. Every
+# `autoscale_interval` seconds it measures recent throughput the same way
+# the Monitor does, and moves the pool size by `autoscale_step` senders:
+# in the same direction as last time if throughput went up, and the other
+# way if it went down. If event loop lag is over `autoscale_max_loop_lag`,
+# the loop is saturated and more senders would only slow everything down,
+# so it shrinks the pool instead. The size stays within
+# [autoscale_min_senders, autoscale_max_senders], and is never below 1.
+class SenderAutoscaler:
+    def __init__(
+        self, conf: Config, pool: ResizablePool, collector: StatsCollector
+    ) -> None:
+        self.config = conf
+        self.pool = pool
+        self.collector = collector
+        self.direction = 1
+        self.last_throughput: None | float = None
+
+    def run(self) -> asyncio.Task[None]:
+        return asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        interval = self.config.autoscale_interval
+        stats = await self.collector.get_stats()
+        last_finished = stats.sent + stats.failed
+        last_time = loop.time()
+        while True:
+            scheduled = loop.time() + interval
+            await asyncio.sleep(interval)
+            now = loop.time()
+            stats = await self.collector.get_stats()
+            finished = stats.sent + stats.failed
+            throughput = (finished - last_finished) / (now - last_time)
+            # Our own wakeup is a lag sample too, in case the probe is off.
+            lag = max(now - scheduled, stats.loop_lag)
+            self.pool.resize(self.next_size(throughput, lag))
+            last_finished = finished
+            last_time = now
+
+    def next_size(self, throughput: float, loop_lag: float) -> int:
+        if loop_lag > self.config.autoscale_max_loop_lag:
+            self.direction = -1
+        elif self.last_throughput is not None and throughput < self.last_throughput:
+            self.direction = -self.direction
+        self.last_throughput = throughput
+        size = self.pool.size + self.direction * self.config.autoscale_step
+        return max(
+            1,
+            self.config.autoscale_min_senders,
+            min(self.config.autoscale_max_senders, size),
+        )
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict, List, Sequence
+
+import application
+import config
+
+# Benchmarks the real application (producers, broker, senders, stats) over a
+# grid of configurations. Every point runs in a fresh process, so CPU time
+# and peak RSS are that point's alone, and the results can be saved as a
+# baseline and compared against later to catch performance regressions.
+#
+# Example:
+#   python benchmark.py --sender-count 1000,10000 --batch-size 1,10 \
+#       --output results.csv --save-baseline baseline.json
+#   python benchmark.py --sender-count 1000,10000 --batch-size 1,10 \
+#       --baseline baseline.json
+
+# The config fields that make up the grid, in the order they are varied.
+GRID_FIELDS = ("sender_count", "batch_size", "producer_count", "max_queued_batches")
+
+Result = Dict[str, Any]
+
+
+def grid(values: Dict[str, Sequence[int]]) -> List[Dict[str, int]]:
+    # Every combination of the given values, one dict per grid point.
+    fields = [name for name in GRID_FIELDS if name in values]
+    return [
+        dict(zip(fields, point))
+        for point in itertools.product(*(values[name] for name in fields))
+    ]
+
+
+def run_point(conf: config.Config) -> Result:
+    # Run the application once with `conf` and measure it. Meant to be run
+    # in a process of its own.
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    app = application.Application("", conf)
+    start = time.perf_counter()
+    asyncio.run(app.run())
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    stats = asyncio.run(app.stats_collector.get_stats())
+    cpu_time = (
+        usage.ru_utime
+        - start_usage.ru_utime
+        + usage.ru_stime
+        - start_usage.ru_stime
+        + children.ru_utime
+        - start_children.ru_utime
+        + children.ru_stime
+        - start_children.ru_stime
+    )
+    send_times = stats.send_time_percentiles
+    queue_delays = stats.queue_delay_percentiles
+    return {
+        "message_count": conf.message_count,
+        "elapsed": elapsed,
+        "throughput": (stats.sent + stats.failed) / elapsed,
+        "cpu_time": cpu_time,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_mb": max(usage.ru_maxrss, children.ru_maxrss) / 1024,
+        "send_time_p50": send_times.p50,
+        "send_time_p99": send_times.p99,
+        "queue_delay_p50": queue_delays.p50,
+        "queue_delay_p99": queue_delays.p99,
+        "queue_delay_p999": queue_delays.p999,
+    }
+
+
+def _run_point_quietly(conf: config.Config) -> Result:
+    # The Monitor prints to stdout; keep the benchmark's own output readable.
+    sys.stdout = open(os.devnull, "w")
+    return run_point(conf)
+
+
+def run_grid(
+    base: config.Config, points: List[Dict[str, int]], messages_per_sender: int
+) -> List[Result]:
+    results: List[Result] = []
+    for params in points:
+        changes: Dict[str, Any] = {
+            "message_count": params.get("sender_count", base.sender_count)
+            * messages_per_sender,
+            "monitor_json_lines_path": "",
+            "monitor_prometheus_port": 0,
+        }
+        changes.update(params)
+        conf = dataclasses.replace(base, **changes)
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(_run_point_quietly, conf).result()
+        result = {**params, **result}
+        print(
+            ", ".join(f"{name}={params[name]}" for name in params)
+            + f": {result['throughput']:.1f} msgs/s, {result['cpu_time']:.2f} s CPU,"
+            f" {result['peak_rss_mb']:.1f} MB peak RSS",
+            flush=True,
+        )
+        results.append(result)
+    return results
+
+
+def write_results(results: List[Result], path: str) -> None:
+    if path.endswith(".json"):
+        with open(path, "w") as fp:
+            json.dump(results, fp, indent=2)
+        return
+    with open(path, "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def read_results(path: str) -> List[Result]:
+    if path.endswith(".json"):
+        with open(path) as fp:
+            results: List[Result] = json.load(fp)
+            return results
+    with open(path, newline="") as fp:
+        return [
+            {name: float(value) for name, value in row.items()}
+            for row in csv.DictReader(fp)
+        ]
+
+
+def compare(
+    results: List[Result], baseline: List[Result], tolerance: float
+) -> List[str]:
+    # Regressions of more than `tolerance` (a fraction) against the baseline
+    # point with the same grid parameters. Throughput going down and CPU
+    # time or peak RSS going up count as regressions.
+    def key(result: Result) -> tuple[int, ...]:
+        return tuple(int(result[name]) for name in GRID_FIELDS if name in result)
+
+    by_key = {key(result): result for result in baseline}
+    regressions: List[str] = []
+    for result in results:
+        base = by_key.get(key(result))
+        if base is None:
+            continue
+        point = ", ".join(
+            f"{name}={result[name]}" for name in GRID_FIELDS if name in result
+        )
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{point}: throughput {result['throughput']:.1f} msgs/s,"
+                f" baseline {base['throughput']:.1f} msgs/s"
+            )
+        for name, unit in (("cpu_time", "s"), ("peak_rss_mb", "MB")):
+            if result[name] > base[name] * (1 + tolerance):
+                regressions.append(
+                    f"{point}: {name} {result[name]:.2f} {unit},"
+                    f" baseline {base[name]:.2f} {unit}"
+                )
+    return regressions
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.replace("_", "").split(",")]
+
+
+def main(argv: None | Sequence[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the application over a grid of configurations."
+    )
+    parser.add_argument(
+        "--config", default="config.toml", help="settings outside the grid"
+    )
+    for name in GRID_FIELDS:
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=_int_list,
+            help="comma-separated values (default: the config's value)",
+        )
+    parser.add_argument(
+        "--messages-per-sender",
+        type=int,
+        default=10,
+        help="message_count is sender_count times this",
+    )
+    parser.add_argument("--output", help="write results to this .csv or .json file")
+    parser.add_argument("--save-baseline", help="write results as a baseline file")
+    parser.add_argument("--baseline", help="compare results against this baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed fractional regression against the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    base = config.read_config(args.config)
+    values: Dict[str, Sequence[int]] = {
+        name: getattr(args, name) or [getattr(base, name)] for name in GRID_FIELDS
+    }
+    results = run_grid(base, grid(values), args.messages_per_sender)
+    if args.output:
+        write_results(results, args.output)
+    if args.save_baseline:
+        write_results(results, args.save_baseline)
+    if args.baseline:
+        regressions = compare(results, read_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
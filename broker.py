@@ -1,9 +1,25 @@
 import asyncio
+from collections import deque
+from multiprocessing.context import BaseContext
+import multiprocessing.queues
+import queue
+from typing import Any, Deque, Dict, List, Optional, Protocol
 
 from config import Config
+from priority_broker import PriorityMessageBroker
+from sharded_broker import ShardedBroker
 from sms_message import MessageBatch
 
 
+# The interface shared by all broker implementations.
+class Broker(Protocol):
+    async def put_batch(self, batch: MessageBatch) -> None: ...
+
+    def shutdown(self) -> None: ...
+
+    async def get_batch(self) -> None | MessageBatch: ...
+
+
 class MessageBroker:
     def __init__(self, conf: Config) -> None:
         self.config = conf
@@ -15,8 +31,153 @@ class MessageBroker:
     def shutdown(self) -> None:
         self.queue.shutdown()
 
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    def lane_depths(self) -> List[int]:
+        # A MessageBroker has a single lane.
+        return [self.queue.qsize()]
+
     async def get_batch(self) -> None | MessageBatch:
         try:
             return await self.queue.get()
         except asyncio.QueueShutDown:
             return None
+
+
+# The broker that senders in one process read from: a MessageBroker, a
+# PriorityMessageBroker if the config asks for several priority lanes, or a
+# ShardedBroker if it asks for several shards. Lanes and shards can't be
+# combined yet.
+def local_broker(
+    conf: Config,
+) -> MessageBroker | PriorityMessageBroker | ShardedBroker:
+    if conf.priority_lanes > 1 and conf.broker_shards > 1:
+        raise ValueError("priority_lanes and shards can't both be more than 1")
+    if conf.priority_lanes > 1:
+        return PriorityMessageBroker(conf)
+    if conf.broker_shards > 1:
+        return ShardedBroker(conf)
+    return MessageBroker(conf)
+
+
+# Batches are handed to the multiprocessing queue in chunks so that the
+# per-item pickling and pipe overhead is paid once per chunk, not per batch.
+_CHUNK_SIZE = 32
+# How long to wait before retrying when the cross-process queue is full.
+_FULL_RETRY_DELAY = 0.001
+
+
+# A broker that moves batches between processes. It is backed by a
+# `multiprocessing.Queue` carrying chunks of batches and has the same
+# interface as `MessageBroker`. The usual pattern is for one process to put
+# batches, and for every worker process to run a single `pump_batches` task
+# that moves them into a local `MessageBroker` for its senders.
+# Shutdown is signalled with a `None` chunk that every consumer passes on
+# to the next one, so all consumers drain the queue and then see `None`.
+class ProcessQueueBroker:
+    def __init__(self, conf: Config, ctx: BaseContext) -> None:
+        self.config = conf
+        max_chunks = max(1, conf.max_queued_batches // _CHUNK_SIZE)
+        self.queue: multiprocessing.queues.Queue[Optional[List[MessageBatch]]] = (
+            ctx.Queue(max_chunks)
+        )
+        self._init_local_state()
+
+    def _init_local_state(self) -> None:
+        self._pending: List[MessageBatch] = []
+        self._received: Deque[MessageBatch] = deque()
+        self._flush_scheduled = False
+        self._is_shutdown = False
+        self._marker_sent = False
+        self._drained = False
+
+    # Only the underlying queue crosses the process boundary; buffers are
+    # local to each process.
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"config": self.config, "queue": self.queue}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.config = state["config"]
+        self.queue = state["queue"]
+        self._init_local_state()
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        if self._is_shutdown:
+            raise asyncio.QueueShutDown
+        while len(self._pending) >= _CHUNK_SIZE:
+            if not self._flush():
+                await asyncio.sleep(_FULL_RETRY_DELAY)
+        self._pending.append(batch)
+        if len(self._pending) >= _CHUNK_SIZE:
+            self._flush()
+        elif not self._flush_scheduled:
+            # Partial chunks go out at the end of the current loop iteration,
+            # so a slow producer never leaves batches stranded here.
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._scheduled_flush)
+
+    def _scheduled_flush(self) -> None:
+        self._flush_scheduled = False
+        if self._pending and not self._flush():
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_later(
+                _FULL_RETRY_DELAY, self._scheduled_flush
+            )
+        elif self._is_shutdown and not self._pending:
+            if not self._put_shutdown_marker():
+                self._flush_scheduled = True
+                asyncio.get_running_loop().call_later(
+                    _FULL_RETRY_DELAY, self._scheduled_flush
+                )
+
+    def _flush(self) -> bool:
+        # Returns False if the cross-process queue is full.
+        if not self._pending:
+            return True
+        try:
+            self.queue.put_nowait(self._pending)
+        except queue.Full:
+            return False
+        self._pending = []
+        return True
+
+    def _put_shutdown_marker(self) -> bool:
+        if not self._marker_sent:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                return False
+            self._marker_sent = True
+        return True
+
+    def shutdown(self) -> None:
+        self._is_shutdown = True
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._scheduled_flush)
+
+    async def get_batch(self) -> None | MessageBatch:
+        if not self._received:
+            if self._drained:
+                return None
+            loop = asyncio.get_running_loop()
+            chunk = await loop.run_in_executor(None, self.queue.get)
+            if chunk is None:
+                # Pass the marker on so the other consumers also stop. We
+                # just took an item off the queue, so there is room for it.
+                self._drained = True
+                self.queue.put(None)
+                return None
+            self._received.extend(chunk)
+        return self._received.popleft()
+
+
+async def pump_batches(source: Broker, dest: Broker) -> None:
+    # Move every batch from `source` into `dest`, then shut `dest` down.
+    while True:
+        batch = await source.get_batch()
+        if batch is None:
+            break
+        await dest.put_batch(batch)
+    dest.shutdown()
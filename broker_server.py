@@ -0,0 +1,406 @@
+import asyncio
+from collections import deque
+import logging
+import multiprocessing.synchronize
+import struct
+import sys
+from typing import Any, Deque, Dict, List, Set
+
+from config import Config, read_config
+from sms_message import MessageBatch, decode_batch, encode_batch
+
+log = logging.getLogger(__name__)
+
+# Every frame is its kind and payload length, then the payload.
+_FRAME = struct.Struct("<II")
+_COUNT = struct.Struct("<I")
+# Client to server:
+# - _OPEN_PUTS: the client will put batches, and wants up to a payload
+#   count of put credits at a time
+# - _PUT: a batch, in the packed encoding of sms_message.encode_batch; it
+#   uses up one credit
+# - _GET: the client wants a payload count more batches
+# - _SHUTDOWN: the client has no more batches to put
+_OPEN_PUTS = 1
+_PUT = 2
+_GET = 3
+_SHUTDOWN = 4
+# Server to client:
+# - _CREDIT: a payload count of put credits
+# - _BATCH: a batch the client asked for
+# - _END: the broker is shut down and there are no more batches
+_CREDIT = 5
+_BATCH = 6
+_END = 7
+
+
+# Writes frames to a stream. Frames written in the same pass of the event
+# loop go out together, in one system call.
+class _FrameWriter:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self._unwritten: List[bytes] = []
+
+    def send(self, kind: int, payload: bytes = b"") -> None:
+        if not self._unwritten:
+            asyncio.get_running_loop().call_soon(self._write)
+        self._unwritten.append(_FRAME.pack(kind, len(payload)))
+        self._unwritten.append(payload)
+
+    def _write(self) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(b"".join(self._unwritten))
+        self._unwritten = []
+
+    async def drain(self) -> None:
+        if self._unwritten:
+            self._write()
+        await self.writer.drain()
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    kind, length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return kind, await reader.readexactly(length) if length else b""
+
+
+# One connection to the server, from a producer, a consumer or both.
+class _Peer:
+    def __init__(self, frames: _FrameWriter) -> None:
+        self.frames = frames
+        # Put credits the client may hold at once, and holds now.
+        self.window = 0
+        self.credit = 0
+        self.wants_credit = False
+        # Batches the client has asked for and not been sent.
+        self.demand = 0
+        self.ended = False
+
+
+# A broker server, so that producers and senders can run in separate
+# processes or on separate hosts. Clients (see BrokerClient) connect over
+# TCP and exchange length-prefixed frames; batches stay in their packed
+# encoding, so the server never decodes them.
+#
+# Requests are pipelined both ways. Producers hold put credits, and can put
+# as many batches as they have credits without waiting for any reply;
+# credits come from a pool of `max_queued_batches`, and go back to it as
+# batches are sent on, so queued batches plus credits held never exceed
+# it, and producers wait for credit just as they would wait on a full
+# `MessageBroker`. Consumers ask for a number of batches ahead of time, and
+# are sent each one as it comes in, round robin between consumers.
+#
+# The broker shuts down once `broker_producers` clients have shut down:
+# consumers are sent what is left, and then an end-of-stream frame.
+class BrokerServer:
+    def __init__(self, conf: Config, host: str, port: int) -> None:
+        self.config = conf
+        self.host = host
+        self.port = port
+        self.queue: Deque[bytes] = deque()
+        # Credits not held by any producer or used by a queued batch.
+        self.free_credits = max(1, conf.max_queued_batches)
+        self.peers: Set[_Peer] = set()
+        self._wanting_credit: Deque[_Peer] = deque()
+        self._wanting_batches: Deque[_Peer] = deque()
+        self._producers_done = 0
+        self.is_shutdown = False
+        self._server: None | asyncio.Server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    @property
+    def bound_port(self) -> int:
+        # The port actually listened on, which differs from `port` if it was 0.
+        assert self._server is not None
+        port: int = self._server.sockets[0].getsockname()[1]
+        return port
+
+    async def serve_forever(self) -> None:
+        assert self._server is not None
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = _Peer(_FrameWriter(writer))
+        self.peers.add(peer)
+        try:
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind == _PUT:
+                    if peer.credit <= 0:
+                        raise ValueError("Batch put without credit")
+                    peer.credit -= 1
+                    self.queue.append(payload)
+                    if peer.credit <= peer.window // 2:
+                        self._want_credit(peer)
+                        self._grant()
+                    self._dispatch()
+                elif kind == _GET:
+                    (count,) = _COUNT.unpack(payload)
+                    if not peer.demand:
+                        self._wanting_batches.append(peer)
+                    peer.demand += count
+                    self._dispatch()
+                elif kind == _OPEN_PUTS:
+                    (peer.window,) = _COUNT.unpack(payload)
+                    self._want_credit(peer)
+                    self._grant()
+                elif kind == _SHUTDOWN:
+                    # Credits it no longer needs go back to the pool.
+                    self.free_credits += peer.credit
+                    peer.credit = peer.window = 0
+                    self._producers_done += 1
+                    if self._producers_done >= self.config.broker_producers:
+                        self.is_shutdown = True
+                    self._dispatch()
+                else:
+                    raise ValueError(f"Unknown frame kind {kind}")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            log.exception("Bad request from a broker client")
+        finally:
+            # Credits the client held go back to the pool. Batches already
+            # sent to it are gone with it.
+            self.peers.discard(peer)
+            self.free_credits += peer.credit
+            peer.credit = peer.window = peer.demand = 0
+            writer.close()
+            self._grant()
+
+    def _dispatch(self) -> None:
+        # Send queued batches to the consumers that asked for them, and end
+        # their streams once the broker is shut down and empty.
+        wanting = self._wanting_batches
+        sent = 0
+        while self.queue and wanting:
+            peer = wanting.popleft()
+            if peer not in self.peers or not peer.demand:
+                continue
+            peer.frames.send(_BATCH, self.queue.popleft())
+            peer.demand -= 1
+            sent += 1
+            if peer.demand:
+                wanting.append(peer)
+        if sent:
+            self.free_credits += sent
+            self._grant()
+        if self.is_shutdown and not self.queue:
+            for peer in self.peers:
+                if peer.demand and not peer.ended:
+                    peer.ended = True
+                    peer.frames.send(_END)
+
+    def _want_credit(self, peer: _Peer) -> None:
+        # Producers ask for more credit once they have used half of it.
+        if not peer.wants_credit:
+            peer.wants_credit = True
+            self._wanting_credit.append(peer)
+
+    def _grant(self) -> None:
+        # Top up producers' credits from the pool, in turn. One that can't
+        # be topped up all the way stays first in line.
+        wanting = self._wanting_credit
+        while self.free_credits and wanting:
+            peer = wanting.popleft()
+            peer.wants_credit = False
+            count = min(self.free_credits, peer.window - peer.credit)
+            if peer not in self.peers or count <= 0:
+                continue
+            peer.credit += count
+            self.free_credits -= count
+            peer.frames.send(_CREDIT, _COUNT.pack(count))
+            if peer.credit < peer.window:
+                peer.wants_credit = True
+                wanting.appendleft(peer)
+
+
+# A broker client with the same interface as MessageBroker, backed by a
+# BrokerServer at `broker_host`:`broker_port`. It connects on first use.
+# Putting a batch takes one of the client's credits, and only waits if it
+# has none; getting a batch takes one the server has already sent, and the
+# client asks for more whenever fewer than half of `broker_window` are
+# received or on their way.
+#
+# Losing the connection to the server is not the end of the stream: puts
+# and gets that follow raise ConnectionError instead, so that batches still
+# queued on the server are not silently dropped.
+#
+# Like ProcessQueueBroker, it can be passed to another process, which
+# opens its own connection.
+class BrokerClient:
+    def __init__(self, conf: Config) -> None:
+        self.config = conf
+        self._init_local_state()
+
+    def _init_local_state(self) -> None:
+        self._frames: None | _FrameWriter = None
+        self._connecting: None | asyncio.Task[_FrameWriter] = None
+        self._reader_task: None | asyncio.Task[None] = None
+        self._puts_opened = False
+        self._credit = 0
+        self._credit_waiters: Deque[asyncio.Future[None]] = deque()
+        self._received: Deque[bytes] = deque()
+        self._requested = 0
+        self._batch_waiters: Deque[asyncio.Future[None]] = deque()
+        self._ended = False
+        self._lost = False
+        self._is_shutdown = False
+        self._shutdown_task: None | asyncio.Task[None] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"config": self.config}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.config = state["config"]
+        self._init_local_state()
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        if self._is_shutdown:
+            raise asyncio.QueueShutDown
+        frames = await self._connect()
+        if not self._puts_opened:
+            self._puts_opened = True
+            frames.send(_OPEN_PUTS, _COUNT.pack(max(1, self.config.broker_window)))
+        while self._credit <= 0:
+            self._check_connection()
+            if self._ended:
+                raise asyncio.QueueShutDown
+            waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            self._credit_waiters.append(waiter)
+            await waiter
+        self._credit -= 1
+        frames.send(_PUT, encode_batch(batch))
+
+    def shutdown(self) -> None:
+        if self._is_shutdown:
+            return
+        self._is_shutdown = True
+        self._shutdown_task = asyncio.create_task(self._send_shutdown())
+
+    async def _send_shutdown(self) -> None:
+        frames = await self._connect()
+        frames.send(_SHUTDOWN)
+        await frames.drain()
+
+    async def get_batch(self) -> None | MessageBatch:
+        frames = await self._connect()
+        while not self._received:
+            self._check_connection()
+            if self._ended:
+                return None
+            self._request_more(frames)
+            waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            self._batch_waiters.append(waiter)
+            await waiter
+        payload = self._received.popleft()
+        self._request_more(frames)
+        return decode_batch(payload)
+
+    async def close(self) -> None:
+        # Wait for everything written to be sent, and disconnect. A lost
+        # connection has already been reported by then.
+        try:
+            if self._shutdown_task is not None:
+                await self._shutdown_task
+            if self._frames is not None:
+                await self._frames.drain()
+        except ConnectionError:
+            pass
+        if self._frames is not None:
+            self._frames.writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+    def _check_connection(self) -> None:
+        if self._lost:
+            raise ConnectionError("Lost the connection to the broker server")
+
+    def _request_more(self, frames: _FrameWriter) -> None:
+        window = max(1, self.config.broker_window)
+        if self._ended or self._requested + len(self._received) > window // 2:
+            return
+        count = window - self._requested - len(self._received)
+        self._requested += count
+        frames.send(_GET, _COUNT.pack(count))
+
+    async def _connect(self) -> _FrameWriter:
+        if self._frames is not None:
+            return self._frames
+        if self._connecting is None:
+            self._connecting = asyncio.create_task(self._open())
+        return await asyncio.shield(self._connecting)
+
+    async def _open(self) -> _FrameWriter:
+        reader, writer = await asyncio.open_connection(
+            self.config.broker_host, self.config.broker_port
+        )
+        self._frames = _FrameWriter(writer)
+        self._reader_task = asyncio.create_task(self._read_frames(reader))
+        return self._frames
+
+    async def _read_frames(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind == _BATCH:
+                    self._requested -= 1
+                    self._received.append(payload)
+                    _wake_one(self._batch_waiters)
+                elif kind == _CREDIT:
+                    (count,) = _COUNT.unpack(payload)
+                    self._credit += count
+                    for _ in range(count):
+                        if not _wake_one(self._credit_waiters):
+                            break
+                elif kind == _END:
+                    self._ended = True
+                    _wake_all(self._batch_waiters)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not self._ended:
+                log.error("Lost the connection to the broker server")
+                self._lost = True
+        finally:
+            _wake_all(self._batch_waiters)
+            _wake_all(self._credit_waiters)
+
+
+def _wake_one(waiters: Deque[asyncio.Future[None]]) -> bool:
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return True
+    return False
+
+
+def _wake_all(waiters: Deque[asyncio.Future[None]]) -> None:
+    while _wake_one(waiters):
+        pass
+
+
+def run_server(conf: Config, ready: None | multiprocessing.synchronize.Event = None) -> None:
+    # Entry point for a broker server process, listening on `broker_host`:
+    # `broker_port`. Sets `ready` once it is listening.
+    asyncio.run(_run_server(conf, ready))
+
+
+async def _run_server(conf: Config, ready: None | multiprocessing.synchronize.Event) -> None:
+    server = BrokerServer(conf, conf.broker_host, conf.broker_port)
+    await server.start()
+    if ready is not None:
+        ready.set()
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    # Run a broker server for the config file given, or config.toml.
+    run_server(read_config(sys.argv[1] if len(sys.argv) > 1 else "config.toml"))
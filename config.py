@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 import tomllib
-from typing import Dict, Any
+from typing import Any, Dict, Tuple
 
 
 @dataclass(frozen=True)
@@ -11,14 +11,89 @@ class Config:
     message_count: int = 1000
     min_message_length: int = 100
     max_message_length: int = 100
+    # If set, messages are rendered from this template (see template.py)
+    # and batches only carry each recipient's parameters.
+    message_template: str = ""
+    template_field_length: int = 8
     producer_count: int = 1
     batch_size: int = 1
+    generation_block_size: int = 100
+    producer_processes: int = 0
+    prefetch_batches: int = 1000
+    # Priority of the batches from each producer, in order; 0 for producers
+    # past the end.
+    producer_priorities: Tuple[int, ...] = ()
+    # If set, the producers send the rows of this file instead of random
+    # messages.
+    recipient_file: str = ""
+    recipient_message: str = ""
+    recipient_progress_path: str = ""
+    recipient_progress_interval: float = 1.0
     sender_count: int = 1
     send_time_mean: float = 1.0
     send_time_stddev: float = 0.1
     send_failure_rate: float = 0.1
+    send_window: int = 1
+    render_cache_size: int = 1024
+    # "simulated" sleeps for each send; "http" sends to the gateway below
+    # (see gateway.py).
+    sender_backend: str = "simulated"
+    gateway_host: str = "127.0.0.1"
+    gateway_port: int = 8025
+    gateway_connections: int = 64
+    gateway_pipeline_depth: int = 16
+    gateway_stub: bool = False
+    sender_engine: str = "tasks"
+    sender_startup_chunk: int = 10_000
+    wheel_tick: float = 0.01
+    # Send rate limits in messages a second (see rate_limit.py); 0 is
+    # unlimited. `rate_limit_routes` has (prefix, rate) pairs for routes
+    # with their own rate.
+    rate_limit_global: float = 0.0
+    rate_limit_route: float = 0.0
+    rate_limit_routes: Tuple[Tuple[int, float], ...] = ()
+    rate_limit_prefix_digits: int = 3
+    rate_limit_burst: float = 1.0
+    rate_limit_tick: float = 0.01
+    retry_max_attempts: int = 1
+    retry_base_delay: float = 1.0
+    retry_max_delay: float = 30.0
     print_frequency: int = 2
+    monitor_json_lines_path: str = ""
+    monitor_prometheus_port: int = 0
+    monitor_prometheus_host: str = "127.0.0.1"
+    monitor_probe_interval: float = 0.1
+    stats_flush_count: int = 1
+    stats_flush_interval: float = 0.5
     max_queued_batches: int = 1
+    broker_backend: str = "queue"
+    priority_lanes: int = 1
+    lane_policy: str = "strict"
+    lane_weights: Tuple[int, ...] = ()
+    broker_shards: int = 1
+    ring_buffer_bytes: int = 64 * 1024 * 1024
+    # The "network" backend (see broker_server.py).
+    broker_host: str = "127.0.0.1"
+    broker_port: int = 8026
+    broker_serve: bool = True
+    broker_window: int = 64
+    broker_producers: int = 1
+    worker_processes: int = 1
+    worker_stats_interval: float = 0.5
+    autoscale_enabled: bool = False
+    autoscale_interval: float = 5.0
+    autoscale_min_senders: int = 1
+    autoscale_max_senders: int = 1_000_000
+    autoscale_step: int = 1000
+    autoscale_max_loop_lag: float = 0.1
+    simulation: bool = False
+    simulation_seed: int = 0
+    dedup_enabled: bool = False
+    dedup_snapshot_path: str = ""
+    wal_dir: str = ""
+    wal_segment_bytes: int = 64 * 1024 * 1024
+    wal_commit_interval: float = 0.005
+    wal_commit_bytes: int = 1024 * 1024
 
 
 def read_config(filename: str = "config.toml") -> Config:
@@ -40,16 +115,94 @@ def _parse_config(raw_config: Dict[str, Any]) -> Config:
     def get_float(section: str, name: str, default: float) -> float:
         return float(raw_config.get(section, {}).get(name, default))
 
+    def get_str(section: str, name: str, default: str) -> str:
+        return str(raw_config.get(section, {}).get(name, default))
+
+    def get_int_tuple(section: str, name: str) -> Tuple[int, ...]:
+        return tuple(int(v) for v in raw_config.get(section, {}).get(name, ()))
+
+    def get_bool(section: str, name: str, default: bool) -> bool:
+        return bool(raw_config.get(section, {}).get(name, default))
+
+    def get_float_table(section: str, name: str) -> Tuple[Tuple[int, float], ...]:
+        table = raw_config.get(section, {}).get(name, {})
+        return tuple((int(key), float(value)) for key, value in table.items())
+
     return Config(
         message_count=get_int("messages", "message_count", 1_000),
         min_message_length=get_int("messages", "min_message_length", 100),
         max_message_length=get_int("messages", "max_message_length", 100),
+        message_template=get_str("messages", "template", ""),
+        template_field_length=get_int("messages", "template_field_length", 8),
         producer_count=get_int("producer", "producer_count", 1),
         batch_size=get_int("producer", "batch_size", 1),
+        generation_block_size=get_int("producer", "generation_block_size", 100),
+        producer_processes=get_int("producer", "producer_processes", 0),
+        prefetch_batches=get_int("producer", "prefetch_batches", 1000),
+        producer_priorities=get_int_tuple("producer", "priorities"),
+        recipient_file=get_str("producer", "recipient_file", ""),
+        recipient_message=get_str("producer", "recipient_message", ""),
+        recipient_progress_path=get_str("producer", "recipient_progress_path", ""),
+        recipient_progress_interval=get_float(
+            "producer", "recipient_progress_interval", 1.0
+        ),
         sender_count=get_int("sender", "sender_count", 50_000),
         send_time_mean=get_float("sender", "send_time_mean", 1.0),
         send_time_stddev=get_float("sender", "send_time_stddev", 0.1),
         send_failure_rate=get_float("sender", "send_failure_rate", 0.1),
+        send_window=get_int("sender", "send_window", 1),
+        render_cache_size=get_int("sender", "render_cache_size", 1024),
+        sender_backend=get_str("sender", "backend", "simulated"),
+        gateway_host=get_str("gateway", "host", "127.0.0.1"),
+        gateway_port=get_int("gateway", "port", 8025),
+        gateway_connections=get_int("gateway", "connections", 64),
+        gateway_pipeline_depth=get_int("gateway", "pipeline_depth", 16),
+        gateway_stub=get_bool("gateway", "stub", False),
+        sender_engine=get_str("sender", "engine", "tasks"),
+        sender_startup_chunk=get_int("sender", "startup_chunk", 10_000),
+        wheel_tick=get_float("sender", "wheel_tick", 0.01),
+        rate_limit_global=get_float("rate_limit", "global_rate", 0.0),
+        rate_limit_route=get_float("rate_limit", "route_rate", 0.0),
+        rate_limit_routes=get_float_table("rate_limit", "routes"),
+        rate_limit_prefix_digits=get_int("rate_limit", "prefix_digits", 3),
+        rate_limit_burst=get_float("rate_limit", "burst", 1.0),
+        rate_limit_tick=get_float("rate_limit", "tick", 0.01),
+        retry_max_attempts=get_int("retry", "max_attempts", 1),
+        retry_base_delay=get_float("retry", "base_delay", 1.0),
+        retry_max_delay=get_float("retry", "max_delay", 30.0),
         print_frequency=get_int("monitor", "print_frequency", 2),
-        max_queued_batches=get_int("broker", "max_queued_batches", 10_000)
+        monitor_json_lines_path=get_str("monitor", "json_lines_path", ""),
+        monitor_prometheus_port=get_int("monitor", "prometheus_port", 0),
+        monitor_prometheus_host=get_str("monitor", "prometheus_host", "127.0.0.1"),
+        monitor_probe_interval=get_float("monitor", "probe_interval", 0.1),
+        stats_flush_count=get_int("stats", "flush_count", 1),
+        stats_flush_interval=get_float("stats", "flush_interval", 0.5),
+        max_queued_batches=get_int("broker", "max_queued_batches", 10_000),
+        broker_backend=get_str("broker", "backend", "queue"),
+        priority_lanes=get_int("broker", "priority_lanes", 1),
+        lane_policy=get_str("broker", "lane_policy", "strict"),
+        lane_weights=get_int_tuple("broker", "lane_weights"),
+        broker_shards=get_int("broker", "shards", 1),
+        ring_buffer_bytes=get_int("broker", "ring_buffer_bytes", 64 * 1024 * 1024),
+        broker_host=get_str("broker", "host", "127.0.0.1"),
+        broker_port=get_int("broker", "port", 8026),
+        broker_serve=get_bool("broker", "serve", True),
+        broker_window=get_int("broker", "window", 64),
+        broker_producers=get_int("broker", "producers", 1),
+        worker_processes=get_int("application", "worker_processes", 1),
+        worker_stats_interval=get_float("application", "worker_stats_interval", 0.5),
+        autoscale_enabled=get_bool("autoscale", "enabled", False),
+        autoscale_interval=get_float("autoscale", "interval", 5.0),
+        autoscale_min_senders=get_int("autoscale", "min_senders", 1),
+        autoscale_max_senders=get_int("autoscale", "max_senders", 1_000_000),
+        autoscale_step=get_int("autoscale", "step", 1000),
+        autoscale_max_loop_lag=get_float("autoscale", "max_loop_lag", 0.1),
+        simulation=get_bool("simulation", "enabled", False),
+        simulation_seed=get_int("simulation", "seed", 0),
+        dedup_enabled=get_bool("dedup", "enabled", False),
+        dedup_snapshot_path=get_str("dedup", "snapshot_path", ""),
+        wal_dir=get_str("wal", "dir", ""),
+        wal_segment_bytes=get_int("wal", "segment_bytes", 64 * 1024 * 1024),
+        wal_commit_interval=get_float("wal", "commit_interval", 0.005),
+        wal_commit_bytes=get_int("wal", "commit_bytes", 1024 * 1024),
     )
@@ -0,0 +1,122 @@
+import os
+from typing import Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+# Every 10-digit destination number.
+DESTINATION_COUNT = 10**10
+# Each chunk is a bitmap of 2^16 consecutive numbers, 8 KiB.
+_CHUNK_SHIFT = 16
+_CHUNK_BYTES = (1 << _CHUNK_SHIFT) // 8
+
+
+# The set of destinations that have been sent to, as a bitmap with one bit
+# per possible number, split into chunks that are only allocated once a
+# number in them is added. At US-population scale (hundreds of millions of
+# numbers) it is 1.25 GB, where a `set` of `str` would take tens of GB, and
+# a few thousand numbers take a few chunks rather than the whole bitmap.
+#
+# Chunks are rows of one array, handed out in the order they are first
+# needed. The array is allocated zeroed but untouched, so the OS only
+# commits memory for the rows in use. Row 0 is never handed out and stays
+# all zeros, so chunks without a row of their own can point at it, and a
+# lookup for a whole batch is a single NumPy gather.
+class DestinationIndex:
+    def __init__(self, size: int = DESTINATION_COUNT) -> None:
+        self.size = size
+        chunk_count = (size + (1 << _CHUNK_SHIFT) - 1) >> _CHUNK_SHIFT
+        # Row of each chunk in `_chunks`, or 0 if it has none yet.
+        self._rows = np.zeros(chunk_count, dtype=np.int64)
+        self._chunks = np.zeros((chunk_count + 1, _CHUNK_BYTES), dtype=np.uint8)
+        self._bytes = self._chunks.reshape(-1)
+        self.chunks_used = 0
+        # Numbers in the index.
+        self.count = 0
+
+    def contains(self, destinations: npt.NDArray[np.uint64]) -> npt.NDArray[np.bool_]:
+        chunk_ids, columns, bits = _locate(destinations)
+        positions = self._rows[chunk_ids] * _CHUNK_BYTES + columns
+        found: npt.NDArray[np.bool_] = (self._bytes[positions] & bits) != 0
+        return found
+
+    def add_new(self, destinations: npt.NDArray[np.uint64]) -> npt.NDArray[np.bool_]:
+        # Add `destinations` to the index. Returns which of them are new:
+        # not in the index before, and not earlier in `destinations`.
+        chunk_ids, columns, bits = _locate(destinations)
+        rows = self._rows[chunk_ids]
+        new: npt.NDArray[np.bool_] = (
+            self._bytes[rows * _CHUNK_BYTES + columns] & bits
+        ) == 0
+        if len(destinations) > 1:
+            # Only the first of repeated numbers in the batch is new. Batches
+            # rarely repeat a number, and checking the sorted numbers against
+            # their neighbours is much cheaper than finding the firsts.
+            ordered = np.sort(destinations)
+            if (ordered[1:] == ordered[:-1]).any():
+                _, first = np.unique(destinations, return_index=True)
+                firsts = np.zeros(len(destinations), dtype=np.bool_)
+                firsts[first] = True
+                new &= firsts
+        if not new.any():
+            return new
+        missing = chunk_ids[new & (rows == 0)]
+        if len(missing):
+            missing = np.unique(missing)
+            self._rows[missing] = np.arange(
+                self.chunks_used + 1, self.chunks_used + 1 + len(missing)
+            )
+            self.chunks_used += len(missing)
+            rows = self._rows[chunk_ids]
+        positions = (rows * _CHUNK_BYTES + columns)[new]
+        bits = bits[new]
+        self._bytes[positions] |= bits
+        if not np.array_equal(self._bytes[positions] & bits, bits):
+            # Some numbers share a byte, and only one of their bits stuck.
+            np.bitwise_or.at(self._bytes, positions, bits)
+        self.count += len(positions)
+        return new
+
+    def save(self, path: str) -> None:
+        # Write the chunks in use to `path`, replacing it only once the
+        # snapshot is complete.
+        chunk_ids = np.flatnonzero(self._rows)
+        chunk_ids = chunk_ids[np.argsort(self._rows[chunk_ids])]
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as fp:
+            np.savez(
+                fp,
+                size=np.array(self.size),
+                count=np.array(self.count),
+                chunk_ids=chunk_ids,
+                chunks=self._chunks[1 : self.chunks_used + 1],
+            )
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "DestinationIndex":
+        with np.load(path) as data:
+            index = cls(int(data["size"]))
+            chunk_ids = data["chunk_ids"]
+            index.chunks_used = len(chunk_ids)
+            index._rows[chunk_ids] = np.arange(1, len(chunk_ids) + 1)
+            index._chunks[1 : len(chunk_ids) + 1] = data["chunks"]
+            index.count = int(data["count"])
+        return index
+
+
+_BIT_MASKS = np.left_shift(1, np.arange(8)).astype(np.uint8)
+
+
+def _locate(
+    destinations: npt.NDArray[np.uint64],
+) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64], npt.NDArray[np.uint8]]:
+    # The chunk, byte within the chunk and bit mask of each destination.
+    numbers = destinations.astype(np.int64)
+    return (
+        numbers >> _CHUNK_SHIFT,
+        (numbers & ((1 << _CHUNK_SHIFT) - 1)) >> 3,
+        _BIT_MASKS[numbers & 7],
+    )
@@ -0,0 +1,294 @@
+import asyncio
+from collections import deque
+import multiprocessing.synchronize
+import random
+import sys
+from typing import Deque, List
+from urllib.parse import quote
+
+from config import Config, read_config
+
+# Messages are sent with one POST each, as "to=<digits>&text=<body>".
+_PATH = b"/messages"
+
+
+# An HTTP/1.1 connection to the gateway that requests are pipelined on: they
+# are written without waiting for earlier responses, and a task reads the
+# responses, which come back in request order, and resolves each request's
+# future with whether the send succeeded. Requests made in the same pass
+# of the event loop are written together, in one system call.
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.pending: Deque[asyncio.Future[bool]] = deque()
+        self.closed = False
+        self._unwritten: List[bytes] = []
+        self._task = asyncio.create_task(self._read_responses())
+
+    def request(self, request: bytes) -> asyncio.Future[bool]:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[bool] = loop.create_future()
+        self.pending.append(future)
+        if not self._unwritten:
+            loop.call_soon(self._write)
+        self._unwritten.append(request)
+        return future
+
+    def _write(self) -> None:
+        if not self.closed:
+            self.writer.write(b"".join(self._unwritten))
+        self._unwritten = []
+
+    def close(self) -> None:
+        self._task.cancel()
+        self._fail(ConnectionError("Gateway connection closed"))
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                status_line = await self.reader.readline()
+                if not status_line:
+                    raise ConnectionError("Gateway closed the connection")
+                length = 0
+                keep_alive = True
+                while True:
+                    line = await self.reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.partition(b":")
+                    name = name.strip().lower()
+                    if name == b"content-length":
+                        length = int(value)
+                    elif name == b"connection" and value.strip().lower() == b"close":
+                        keep_alive = False
+                if length:
+                    await self.reader.readexactly(length)
+                status = int(status_line.split()[1])
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(200 <= status < 300)
+                if not keep_alive:
+                    raise ConnectionError("Gateway closed the connection")
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            self._fail(e)
+
+    def _fail(self, error: Exception) -> None:
+        self.closed = True
+        self.writer.close()
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(str(error)))
+
+
+# Sends messages to an HTTP SMS gateway at `gateway_host`:`gateway_port`
+# over a pool of up to `gateway_connections` keep-alive connections, each
+# with up to `gateway_pipeline_depth` requests pipelined on it. A send waits
+# for room in the pool, so the number of requests in flight is bounded
+# however many senders share the client. Connections are opened as they are
+# needed, and one that fails is dropped, failing the requests on it, and
+# replaced by the next send that needs one.
+class GatewayClient:
+    def __init__(self, conf: Config) -> None:
+        self.config = conf
+        self.connections: List[_Connection] = []
+        self._opening = 0
+        self._next = 0
+        self._waiters: Deque[asyncio.Future[None]] = deque()
+        self._host_header = f"Host: {conf.gateway_host}:{conf.gateway_port}\r\n".encode()
+
+    async def send(self, destination: str, body: str) -> bool:
+        # Send a message, and return whether the gateway accepted it. Raises
+        # ConnectionError if the connection fails first.
+        payload = f"to={destination.replace('-', '')}&text={quote(body)}".encode()
+        request = b"".join(
+            (
+                b"POST " + _PATH + b" HTTP/1.1\r\n",
+                self._host_header,
+                b"Content-Type: application/x-www-form-urlencoded\r\n"
+                b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n",
+                payload,
+            )
+        )
+        connection = await self._acquire()
+        try:
+            future = connection.request(request)
+            if connection.writer.transport.get_write_buffer_size():
+                await connection.writer.drain()
+            return await future
+        finally:
+            self._release()
+
+    async def close(self) -> None:
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    async def _acquire(self) -> _Connection:
+        # A connection with room for another request, taking them round
+        # robin so the load is spread over the pool.
+        depth = self.config.gateway_pipeline_depth
+        while True:
+            self.connections = [c for c in self.connections if not c.closed]
+            for _ in range(len(self.connections)):
+                self._next = (self._next + 1) % len(self.connections)
+                connection = self.connections[self._next]
+                if len(connection.pending) < depth:
+                    return connection
+            if len(self.connections) + self._opening < self.config.gateway_connections:
+                self._opening += 1
+                try:
+                    reader, writer = await asyncio.open_connection(
+                        self.config.gateway_host, self.config.gateway_port
+                    )
+                except BaseException:
+                    # Let a waiting send try to open one instead.
+                    self._release()
+                    raise
+                finally:
+                    self._opening -= 1
+                connection = _Connection(reader, writer)
+                self.connections.append(connection)
+                # Sends that waited while it opened can use it too.
+                for woken in self._waiters:
+                    if not woken.done():
+                        woken.set_result(None)
+                self._waiters.clear()
+                return connection
+            waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def _release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+# A stand-in for an SMS gateway, for benchmarking the network path on one
+# machine. It accepts the requests GatewayClient sends, on any number of
+# keep-alive connections with any depth of pipelining, and answers each
+# after a send time drawn from `send_time_mean` and `send_time_stddev`:
+# "202 Accepted", or "503 Service Unavailable" for a `send_failure_rate`
+# fraction of them. Requests on a connection are handled concurrently, and
+# their responses are written in request order.
+class StubGateway:
+    def __init__(self, conf: Config, host: str, port: int) -> None:
+        self.config = conf
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._server: None | asyncio.Server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    @property
+    def bound_port(self) -> int:
+        # The port actually listened on, which differs from `port` if it was 0.
+        assert self._server is not None
+        port: int = self._server.sockets[0].getsockname()[1]
+        return port
+
+    async def serve_forever(self) -> None:
+        assert self._server is not None
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        responses: asyncio.Queue[None | asyncio.Task[bytes]] = asyncio.Queue()
+        write_task = asyncio.create_task(self._write_responses(writer, responses))
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                if length:
+                    await reader.readexactly(length)
+                parts = request_line.split()
+                if len(parts) >= 2 and parts[0] == b"POST" and parts[1] == _PATH:
+                    self.requests += 1
+                    responses.put_nowait(asyncio.create_task(self._send()))
+                else:
+                    responses.put_nowait(asyncio.create_task(_not_found()))
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            responses.put_nowait(None)
+            await write_task
+
+    async def _send(self) -> bytes:
+        send_time = max(
+            random.normalvariate(self.config.send_time_mean, self.config.send_time_stddev),
+            0,
+        )
+        await asyncio.sleep(send_time)
+        if random.random() < self.config.send_failure_rate:
+            return _response(b"503 Service Unavailable", b"")
+        return _response(b"202 Accepted", b"")
+
+    async def _write_responses(
+        self,
+        writer: asyncio.StreamWriter,
+        responses: "asyncio.Queue[None | asyncio.Task[bytes]]",
+    ) -> None:
+        try:
+            while True:
+                task = await responses.get()
+                if task is None:
+                    break
+                writer.write(await task)
+                if responses.empty():
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _response(status: bytes, body: bytes) -> bytes:
+    return (
+        b"HTTP/1.1 " + status + b"\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+    )
+
+
+async def _not_found() -> bytes:
+    return _response(b"404 Not Found", b"Not Found\n")
+
+
+def run_stub(conf: Config, ready: None | multiprocessing.synchronize.Event = None) -> None:
+    # Entry point for a stub gateway process, listening on `gateway_host`:
+    # `gateway_port`. Sets `ready` once it is listening.
+    asyncio.run(_run_stub(conf, ready))
+
+
+async def _run_stub(conf: Config, ready: None | multiprocessing.synchronize.Event) -> None:
+    stub = StubGateway(conf, conf.gateway_host, conf.gateway_port)
+    await stub.start()
+    if ready is not None:
+        ready.set()
+    await stub.serve_forever()
+
+
+if __name__ == "__main__":
+    # Run a stub gateway for the config file given, or config.toml.
+    run_stub(read_config(sys.argv[1] if len(sys.argv) > 1 else "config.toml"))
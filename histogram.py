@@ -0,0 +1,118 @@
+import math
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+# Values are recorded in whole microseconds.
+_UNITS_PER_SECOND = 1_000_000
+# Each power-of-two range is split into 2^(_PRECISION_BITS - 1) linear
+# sub-buckets, so a bucket is never wider than 1/512 of its value: about
+# three significant digits.
+_PRECISION_BITS = 10
+_SUB_BUCKETS = 1 << _PRECISION_BITS
+_HALF_SUB_BUCKETS = _SUB_BUCKETS >> 1
+# Values from 2^_MAX_EXPONENT microseconds (about 13 days) up are recorded in
+# the last bucket.
+_MAX_EXPONENT = 40
+_MAX_UNITS = (1 << _MAX_EXPONENT) - 1
+_BUCKET_COUNT = _SUB_BUCKETS + (_MAX_EXPONENT - _PRECISION_BITS) * _HALF_SUB_BUCKETS
+# record_many records fewer values than this one at a time: below about 64
+# values, the fixed cost of the NumPy calls is more than a loop of record().
+VECTOR_MIN = 64
+
+
+@dataclass(frozen=True)
+class Percentiles:
+    p50: float
+    p90: float
+    p99: float
+    p999: float
+
+
+def _bucket_index(units: int) -> int:
+    if units < _SUB_BUCKETS:
+        return max(units, 0)
+    units = min(units, _MAX_UNITS)
+    shift = units.bit_length() - _PRECISION_BITS
+    return _SUB_BUCKETS + (shift - 1) * _HALF_SUB_BUCKETS + (units >> shift) - _HALF_SUB_BUCKETS
+
+
+def _bucket_indices(units: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    # Vectorized _bucket_index.
+    units = np.clip(units, 0, _MAX_UNITS)
+    exponent = np.frexp(units.astype(np.float64))[1].astype(np.int64)
+    shift = np.maximum(exponent - _PRECISION_BITS, 0)
+    large = _SUB_BUCKETS + (shift - 1) * _HALF_SUB_BUCKETS + (units >> shift) - _HALF_SUB_BUCKETS
+    return np.where(units < _SUB_BUCKETS, units, large)
+
+
+def _bucket_midpoint(index: int) -> float:
+    # The middle of the range of values recorded in a bucket, in seconds.
+    if index < _SUB_BUCKETS:
+        return index / _UNITS_PER_SECOND
+    offset = index - _SUB_BUCKETS
+    shift = offset // _HALF_SUB_BUCKETS + 1
+    low = (offset % _HALF_SUB_BUCKETS + _HALF_SUB_BUCKETS) << shift
+    return (low + ((1 << shift) - 1) / 2) / _UNITS_PER_SECOND
+
+
+# A fixed-size histogram of durations in seconds with logarithmically sized
+# buckets, in the style of HdrHistogram. Memory use is the same however
+# many values are recorded, recording is O(1), and histograms from
+# different sources can be merged exactly by adding their counts.
+class LogHistogram:
+    def __init__(self) -> None:
+        self.counts = np.zeros(_BUCKET_COUNT, dtype=np.int64)
+        self.count = 0
+
+    def record(self, seconds: float) -> None:
+        self.counts[_bucket_index(int(seconds * _UNITS_PER_SECOND))] += 1
+        self.count += 1
+
+    def record_many(self, seconds: Sequence[float]) -> None:
+        if len(seconds) < VECTOR_MIN:
+            for value in seconds:
+                self.record(value)
+            return
+        values = np.asarray(seconds, dtype=np.float64)
+        units = (values * _UNITS_PER_SECOND).astype(np.int64)
+        # Only the buckets hit are touched, not the whole array.
+        np.add.at(self.counts, _bucket_indices(units), 1)
+        self.count += len(values)
+
+    def merge(self, other: "LogHistogram") -> None:
+        self.counts += other.counts
+        self.count += other.count
+
+    def copy(self) -> "LogHistogram":
+        result = LogHistogram()
+        result.merge(self)
+        return result
+
+    def percentile(self, percent: float) -> float:
+        # The value, in seconds, that `percent` of recorded values are at or
+        # below. 0 if nothing has been recorded.
+        if self.count == 0:
+            return 0.0
+        # Round before taking the ceiling, so that e.g. 99.9% of 10000 is
+        # rank 9990 rather than 9991.
+        rank = max(1, math.ceil(round(self.count * percent / 100, 6)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return _bucket_midpoint(index)
+
+    def percentiles(self) -> Percentiles:
+        return Percentiles(
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            p999=self.percentile(99.9),
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, LogHistogram):
+            return NotImplemented
+        return self.count == other.count and bool(np.array_equal(self.counts, other.counts))
+
+    __hash__ = None  # type: ignore[assignment]
@@ -0,0 +1,140 @@
+from array import array
+import asyncio
+from typing import Set
+
+from config import Config
+from stats_collector import StatsCollector
+
+
+# Counters that a single component adds to with plain, synchronous calls,
+# flushed to the StatsCollector in bulk. This keeps the per-message cost of
+# stats to an integer increment instead of a coroutine call and an await.
+#
+# Each `log_*` method returns True once `flush_count` events are pending,
+# and the caller should then `await flush()`. Buffers created by a
+# `StatsFlusher` are also flushed every `stats_flush_interval` seconds, so
+# counts from a component that has gone idle still show up.
+class LocalStats:
+    __slots__ = (
+        "collector",
+        "flush_count",
+        "pending",
+        "produced",
+        "dequeued",
+        "queue_delays",
+        "queue_delay_priorities",
+        "sent_times",
+        "first_sent_at",
+        "failed_times",
+        "failed_permanently",
+    )
+
+    def __init__(self, collector: StatsCollector, flush_count: int = 1) -> None:
+        self.collector = collector
+        self.flush_count = flush_count
+        self.pending = 0
+        self.produced = 0
+        self.dequeued = 0
+        # Individual times are kept in flat arrays of doubles, so the
+        # collector can build its histograms from them in bulk.
+        self.queue_delays = array("d")
+        self.queue_delay_priorities = array("i")
+        self.sent_times = array("d")
+        # Loop time of the first send in `sent_times`. The collector only
+        # sees sends when they are flushed, so this is passed on to it.
+        self.first_sent_at: None | float = None
+        self.failed_times = array("d")
+        self.failed_permanently = 0
+
+    def log_produced(self, batch_size: int) -> bool:
+        self.produced += batch_size
+        self.pending += 1
+        return self.pending >= self.flush_count
+
+    def log_dequeued(
+        self, batch_size: int, queue_delay: None | float = None, priority: int = 0
+    ) -> bool:
+        self.dequeued += batch_size
+        if queue_delay is not None:
+            self.queue_delays.append(queue_delay)
+            self.queue_delay_priorities.append(priority)
+        self.pending += 1
+        return self.pending >= self.flush_count
+
+    def log_sent(self, send_time: float) -> bool:
+        if self.first_sent_at is None:
+            self.first_sent_at = asyncio.get_running_loop().time()
+        self.sent_times.append(send_time)
+        self.pending += 1
+        return self.pending >= self.flush_count
+
+    def log_failed(self, send_time: float) -> bool:
+        self.failed_times.append(send_time)
+        self.pending += 1
+        return self.pending >= self.flush_count
+
+    def log_failed_permanently(self, count: int) -> bool:
+        self.failed_permanently += count
+        self.pending += 1
+        return self.pending >= self.flush_count
+
+    async def flush(self) -> None:
+        if self.pending == 0:
+            return
+        # Take the counts before awaiting anything, so events logged while
+        # the flush is in progress are kept for the next one.
+        produced, self.produced = self.produced, 0
+        dequeued, self.dequeued = self.dequeued, 0
+        queue_delays, self.queue_delays = self.queue_delays, array("d")
+        priorities, self.queue_delay_priorities = self.queue_delay_priorities, array("i")
+        sent_times, self.sent_times = self.sent_times, array("d")
+        first_sent_at, self.first_sent_at = self.first_sent_at, None
+        failed_times, self.failed_times = self.failed_times, array("d")
+        failed_permanently, self.failed_permanently = self.failed_permanently, 0
+        self.pending = 0
+
+        if produced:
+            await self.collector.log_produced(produced)
+        if dequeued:
+            await self.collector.log_dqueued(dequeued)
+        if queue_delays:
+            await self.collector.log_queue_delays(queue_delays, priorities)
+        if first_sent_at is not None:
+            await self.collector.log_first_sent(first_sent_at)
+        if sent_times:
+            await self.collector.log_sent_many(sent_times)
+        if failed_times:
+            await self.collector.log_failed_many(failed_times)
+        if failed_permanently:
+            await self.collector.log_failed_permanently(failed_permanently)
+
+
+# Creates LocalStats buffers and flushes all of them on an interval.
+class StatsFlusher:
+    def __init__(self, conf: Config, collector: StatsCollector) -> None:
+        self.config = conf
+        self.collector = collector
+        self.buffers: Set[LocalStats] = set()
+
+    def local_stats(self) -> LocalStats:
+        stats = LocalStats(self.collector, self.config.stats_flush_count)
+        self.buffers.add(stats)
+        return stats
+
+    async def release(self, stats: LocalStats) -> None:
+        # Flush a buffer that is no longer needed and stop tracking it.
+        self.buffers.discard(stats)
+        await stats.flush()
+
+    def run(self) -> asyncio.Task[None]:
+        return asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.stats_flush_interval)
+            await self.flush_all()
+
+    async def flush_all(self) -> None:
+        for stats in list(self.buffers):
+            if stats.pending:
+                await stats.flush()
@@ -0,0 +1,51 @@
+import asyncio
+from typing import Callable, Sequence
+
+from config import Config
+from stats_collector import StatsCollector
+
+# asyncio.all_tasks() copies the set of every live task, which takes
+# milliseconds with tens of thousands of senders, so tasks are counted at
+# most once per this many seconds.
+_TASK_COUNT_INTERVAL = 1.0
+
+
+# Samples the health of the event loop it runs on every
+# `monitor_probe_interval` seconds and reports it to the stats collector:
+# - loop lag: how much later than scheduled the probe's own sleep woke up.
+#   On an idle loop this is close to 0; when ready callbacks pile up faster
+#   than the loop can run them, it grows.
+# - the number of live tasks
+# - broker depth: batches waiting in each lane of the broker, if
+#   `lane_depths` is given
+# Together they tell a saturated loop apart from an empty broker or from
+# producers that are falling behind.
+class LoopProbe:
+    def __init__(
+        self,
+        conf: Config,
+        collector: StatsCollector,
+        lane_depths: None | Callable[[], Sequence[int]] = None,
+    ) -> None:
+        self.config = conf
+        self.collector = collector
+        self.lane_depths = lane_depths
+
+    def run(self) -> asyncio.Task[None]:
+        return asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        interval = self.config.monitor_probe_interval
+        task_count = 0
+        next_task_count = loop.time()
+        while True:
+            scheduled = loop.time() + interval
+            await asyncio.sleep(interval)
+            now = loop.time()
+            lag = max(0.0, now - scheduled)
+            if now >= next_task_count:
+                task_count = len(asyncio.all_tasks())
+                next_task_count = now + _TASK_COUNT_INTERVAL
+            depths = self.lane_depths() if self.lane_depths is not None else ()
+            await self.collector.log_loop_health(lag, task_count, depths)
@@ -1,13 +1,13 @@
-import asyncio
-
 import application
+import config
+import simulation
 
 
-async def main() -> None:
-    app = application.Application("config.toml")
-    await app.run()
-    return
+def main() -> None:
+    conf = config.read_config("config.toml")
+    app = application.Application("config.toml", conf)
+    simulation.run(app.run(), conf)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,266 @@
+import asyncio
+import dataclasses
+from dataclasses import dataclass
+import json
+from typing import IO, List, Protocol, Tuple
+
+from config import Config
+from histogram import Percentiles
+
+
+# Depth and queue delay of one priority lane of the broker.
+@dataclass(frozen=True)
+class LaneSnapshot:
+    priority: int
+    depth: int
+    queue_delay: Percentiles
+
+
+# One report from the Monitor, in a form that sinks can export.
+@dataclass(frozen=True)
+class MetricsSnapshot:
+    timestamp: float
+    elapsed: float
+    produced: int
+    dequeued: int
+    sent: int
+    failed: int
+    retried: int
+    failed_permanently: int
+    # Messages produced but not yet taken by a sender.
+    queue_depth: int
+    # Messages taken by a sender but not yet sent or failed.
+    in_flight: int
+    throughput: float
+    recent_throughput: float
+    average_latency: float
+    send_time: Percentiles
+    queue_delay: Percentiles
+    # Event loop health; see loop_probe.LoopProbe.
+    loop_lag: float
+    loop_lag_p99: float
+    task_count: int
+    # Batches waiting in the broker.
+    broker_depth: int
+    # From the start of the run to the first message sent, if any has been.
+    time_to_first_sent: None | float
+    # Per priority lane, if there is more than one.
+    lanes: Tuple[LaneSnapshot, ...] = ()
+    # Produced messages dropped as duplicates.
+    duplicates: int = 0
+
+
+# Somewhere other than stdout that the Monitor sends its reports. `start` is
+# called before the first report and `close` after the last one.
+class MonitorSink(Protocol):
+    async def start(self) -> None: ...
+
+    async def write(self, snapshot: MetricsSnapshot) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+# Appends each snapshot to a file as one line of JSON. Lines are buffered in
+# memory and written by a thread from the default executor, so a slow disk
+# never blocks the event loop.
+class JsonLinesSink:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lines: List[str] = []
+        self._file: None | IO[str] = None
+        self._writer: None | asyncio.Task[None] = None
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(None, open, self.path, "a")
+
+    async def write(self, snapshot: MetricsSnapshot) -> None:
+        self.lines.append(json.dumps(dataclasses.asdict(snapshot)) + "\n")
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_lines())
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            await self._writer
+        if self.lines:
+            await self._write_lines()
+        if self._file is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._file.close)
+            self._file = None
+
+    async def _write_lines(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.lines and self._file is not None:
+            data, self.lines = "".join(self.lines), []
+            await loop.run_in_executor(None, self._write, self._file, data)
+
+    @staticmethod
+    def _write(fp: IO[str], data: str) -> None:
+        fp.write(data)
+        fp.flush()
+
+
+# Serves the latest snapshot in the Prometheus text exposition format from a
+# minimal HTTP server. The page is rendered once per snapshot, so a scrape
+# costs no more than writing out a short string.
+class PrometheusSink:
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.page = b""
+        self._server: None | asyncio.Server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    @property
+    def bound_port(self) -> int:
+        # The port actually listened on, which differs from `port` if it was 0.
+        assert self._server is not None
+        port: int = self._server.sockets[0].getsockname()[1]
+        return port
+
+    async def write(self, snapshot: MetricsSnapshot) -> None:
+        self.page = render_prometheus(snapshot).encode("utf-8")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            # Skip the headers; there is never a request body we care about.
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+                status = b"200 OK"
+                body = self.page
+            else:
+                status = b"404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def render_prometheus(snapshot: MetricsSnapshot) -> str:
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str, value: float) -> None:
+        lines.append(f"# HELP sms_{name} {help_text}")
+        lines.append(f"# TYPE sms_{name} {kind}")
+        lines.append(f"sms_{name} {value}")
+
+    def summary(name: str, help_text: str, percentiles: Percentiles) -> None:
+        lines.append(f"# HELP sms_{name} {help_text}")
+        lines.append(f"# TYPE sms_{name} summary")
+        for quantile, value in (
+            ("0.5", percentiles.p50),
+            ("0.9", percentiles.p90),
+            ("0.99", percentiles.p99),
+            ("0.999", percentiles.p999),
+        ):
+            lines.append(f'sms_{name}{{quantile="{quantile}"}} {value}')
+
+    metric("produced_total", "counter", "Messages produced.", snapshot.produced)
+    metric("dequeued_total", "counter", "Messages taken by senders.", snapshot.dequeued)
+    metric("sent_total", "counter", "Messages sent.", snapshot.sent)
+    metric("failed_total", "counter", "Failed send attempts.", snapshot.failed)
+    metric("retried_total", "counter", "Messages retried.", snapshot.retried)
+    metric(
+        "failed_permanently_total",
+        "counter",
+        "Messages that ran out of attempts.",
+        snapshot.failed_permanently,
+    )
+    metric(
+        "duplicates_total",
+        "counter",
+        "Messages dropped because their destination was already sent to.",
+        snapshot.duplicates,
+    )
+    metric("queue_depth", "gauge", "Messages waiting in the broker.", snapshot.queue_depth)
+    metric("in_flight", "gauge", "Messages being sent.", snapshot.in_flight)
+    metric(
+        "throughput",
+        "gauge",
+        "Messages finished per second since the last report.",
+        snapshot.recent_throughput,
+    )
+    metric(
+        "send_time_seconds_average",
+        "gauge",
+        "Average send time.",
+        snapshot.average_latency,
+    )
+    summary("send_time_seconds", "Send time percentiles.", snapshot.send_time)
+    summary(
+        "queue_delay_seconds",
+        "Time from enqueue to dequeue percentiles.",
+        snapshot.queue_delay,
+    )
+    metric("loop_lag_seconds", "gauge", "Latest event loop lag.", snapshot.loop_lag)
+    metric(
+        "loop_lag_seconds_p99",
+        "gauge",
+        "99th percentile event loop lag.",
+        snapshot.loop_lag_p99,
+    )
+    metric("tasks", "gauge", "Live asyncio tasks.", snapshot.task_count)
+    metric("broker_depth", "gauge", "Batches waiting in the broker.", snapshot.broker_depth)
+    if snapshot.lanes:
+        lines.append("# HELP sms_lane_depth Batches waiting in each priority lane.")
+        lines.append("# TYPE sms_lane_depth gauge")
+        for lane in snapshot.lanes:
+            lines.append(f'sms_lane_depth{{priority="{lane.priority}"}} {lane.depth}')
+        lines.append(
+            "# HELP sms_lane_queue_delay_seconds"
+            " Time from enqueue to dequeue percentiles per priority lane."
+        )
+        lines.append("# TYPE sms_lane_queue_delay_seconds summary")
+        for lane in snapshot.lanes:
+            for quantile, value in (
+                ("0.5", lane.queue_delay.p50),
+                ("0.9", lane.queue_delay.p90),
+                ("0.99", lane.queue_delay.p99),
+                ("0.999", lane.queue_delay.p999),
+            ):
+                lines.append(
+                    "sms_lane_queue_delay_seconds"
+                    f'{{priority="{lane.priority}",quantile="{quantile}"}} {value}'
+                )
+    if snapshot.time_to_first_sent is not None:
+        metric(
+            "time_to_first_sent_seconds",
+            "gauge",
+            "Time from start-up to the first message sent.",
+            snapshot.time_to_first_sent,
+        )
+    metric("elapsed_seconds", "gauge", "Run time so far.", snapshot.elapsed)
+    return "\n".join(lines) + "\n"
+
+
+def sinks_from_config(conf: Config) -> List[MonitorSink]:
+    sinks: List[MonitorSink] = []
+    if conf.monitor_json_lines_path:
+        sinks.append(JsonLinesSink(conf.monitor_json_lines_path))
+    if conf.monitor_prometheus_port:
+        sinks.append(
+            PrometheusSink(conf.monitor_prometheus_host, conf.monitor_prometheus_port)
+        )
+    return sinks
@@ -1,74 +1,181 @@
 import asyncio
 import time
-from typing import Dict
+from typing import Callable, Dict, Sequence, Tuple
 
 from config import Config
+from histogram import LogHistogram
+from metrics_export import LaneSnapshot, MetricsSnapshot, MonitorSink
 from stats_collector import MessagingStats, StatsCollector
 
 
 class Monitor:
     def __init__(
-        self, conf: Config, stats_collector: StatsCollector, now: float = time.time()
+        self,
+        conf: Config,
+        stats_collector: StatsCollector,
+        now: None | float = None,
+        sinks: Sequence[MonitorSink] = (),
+        clock: Callable[[], float] = time.time,
     ) -> None:
         self.config = conf
         self.stats_collector = stats_collector
+        # Where the current time comes from; the event loop's clock in
+        # simulation mode.
+        self.clock = clock
+        if now is None:
+            now = clock()
         self.start_time = now
         self.last_finished = 0
         self.last_time = now
+        self.sinks = sinks
 
     def run(self) -> asyncio.Task[None]:
         return asyncio.create_task(self._run())
 
     async def _run(self) -> None:
-        while True:
-            try:
-                await asyncio.sleep(self.config.print_frequency)
-                stats = await self.stats_collector.get_stats()
-                now = time.time()
+        for sink in self.sinks:
+            await sink.start()
+        try:
+            while True:
+                try:
+                    await asyncio.sleep(self.config.print_frequency)
+                    stats = await self.stats_collector.get_stats()
+                    now = self.clock()
 
-                msg = self._stats_to_string(stats, now)
-                print(msg)
-            
-                finished = stats.sent + stats.failed
-                self.last_time = now
-                self.last_finished = finished
-            except asyncio.CancelledError:
-                break
+                    snapshot = self._snapshot(stats, now)
+                    print(self._snapshot_to_string(snapshot))
+                    for sink in self.sinks:
+                        await sink.write(snapshot)
 
+                    self.last_time = now
+                    self.last_finished = stats.sent + stats.failed
+                except asyncio.CancelledError:
+                    break
+        finally:
+            for sink in self.sinks:
+                await sink.close()
+
+    def _snapshot(self, stats: MessagingStats, now: float) -> MetricsSnapshot:
+        finished = stats.sent + stats.failed
+        total_elapsed = now - self.start_time
+        recent_elapsed = now - self.last_time
+        recent_finished = finished - self.last_finished
+        return MetricsSnapshot(
+            timestamp=now,
+            elapsed=total_elapsed,
+            produced=stats.produced,
+            dequeued=stats.dequeued,
+            sent=stats.sent,
+            failed=stats.failed,
+            retried=stats.retried,
+            failed_permanently=stats.failed_permanently,
+            # Retried messages go back into the broker and are dequeued
+            # again.
+            queue_depth=stats.produced + stats.retried - stats.dequeued,
+            in_flight=stats.dequeued - finished,
+            throughput=finished / total_elapsed,
+            recent_throughput=recent_finished / recent_elapsed,
+            average_latency=stats.average_time,
+            send_time=stats.send_time_percentiles,
+            queue_delay=stats.queue_delay_percentiles,
+            loop_lag=stats.loop_lag,
+            loop_lag_p99=stats.loop_lag_percentiles.p99,
+            task_count=stats.task_count,
+            broker_depth=stats.broker_depth,
+            time_to_first_sent=stats.time_to_first_sent,
+            lanes=self._lanes(stats),
+            duplicates=stats.duplicates,
+        )
+
+    def _lanes(self, stats: MessagingStats) -> Tuple[LaneSnapshot, ...]:
+        priorities = set(range(len(stats.lane_depths)))
+        priorities.update(stats.queue_delay_by_priority)
+        if len(priorities) <= 1:
+            return ()
+        return tuple(
+            LaneSnapshot(
+                priority=priority,
+                depth=(
+                    stats.lane_depths[priority]
+                    if priority < len(stats.lane_depths)
+                    else 0
+                ),
+                queue_delay=stats.queue_delay_by_priority.get(
+                    priority, LogHistogram()
+                ).percentiles(),
+            )
+            for priority in sorted(priorities)
+        )
 
     def _stats_to_string(self, stats: MessagingStats, now: float) -> str:
+        return self._snapshot_to_string(self._snapshot(stats, now))
+
+    def _snapshot_to_string(self, snapshot: MetricsSnapshot) -> str:
         detailed_monitor_format = """
-Total Produced: {produced}
+Total Produced: {produced}{duplicates}
 Enqueued: {enqueued}
 Processing: {processing}
 Finished: {finished}
 Failures: {sent} sent, {failed} failed. {f_rate_pct:.1f}% failure rate.
+Retries: {retried} retried, {failed_permanently} permanently failed.
 Throughput: {overall_tput:.1f} msgs/s overall, {recent_tput:.1f} msgs/s recently.
 Latency: {latency} s/msg.
+Send time: {send_p50:.3f} s p50, {send_p90:.3f} s p90, {send_p99:.3f} s p99, {send_p999:.3f} s p99.9.
+Queue delay: {queue_p50:.3f} s p50, {queue_p90:.3f} s p90, {queue_p99:.3f} s p99, {queue_p999:.3f} s p99.9.
+Event loop: {loop_lag:.3f} s lag, {loop_lag_p99:.3f} s lag p99, {tasks} tasks, {broker_depth} batches in broker.
+{lanes}Startup: {first_sent} to the first message sent.
 Elapsed: {elapsed:.1f} s total run time.
 """
-        finished = stats.sent + stats.failed
-        failure_rate_percent = stats.failed * 100.0 / finished
-
-        total_elapsed = now - self.start_time
-        recent_elapsed = now - self.last_time
+        finished = snapshot.sent + snapshot.failed
+        failure_rate_percent = (
+            snapshot.failed * 100.0 / finished if finished > 0 else 0.0
+        )
+        send_times = snapshot.send_time
+        queue_delays = snapshot.queue_delay
 
-        recent_finished = finished - self.last_finished
-        throughput = finished / total_elapsed
-        recent_throughput = recent_finished / recent_elapsed
+        if snapshot.time_to_first_sent is None:
+            first_sent = "not yet"
+        else:
+            first_sent = f"{snapshot.time_to_first_sent:.3f} s"
 
+        duplicates = (
+            f" ({snapshot.duplicates} duplicates dropped)" if snapshot.duplicates else ""
+        )
+        lanes = "".join(
+            f"Priority {lane.priority}: {lane.depth} batches queued,"
+            f" {lane.queue_delay.p50:.3f} s p50, {lane.queue_delay.p99:.3f} s p99"
+            " queue delay.\n"
+            for lane in snapshot.lanes
+        )
 
-        stats_dict: Dict[str, int | float] = {
-            "produced": stats.produced,
-            "finished": stats.sent + stats.failed,
-            "sent": stats.sent,
-            "failed": stats.failed,
+        stats_dict: Dict[str, int | float | str] = {
+            "produced": snapshot.produced,
+            "duplicates": duplicates,
+            "finished": finished,
+            "sent": snapshot.sent,
+            "failed": snapshot.failed,
+            "retried": snapshot.retried,
+            "failed_permanently": snapshot.failed_permanently,
             "f_rate_pct": failure_rate_percent,
-            "overall_tput": throughput,
-            "recent_tput": recent_throughput,
-            "elapsed": total_elapsed,
-            "enqueued": stats.produced - stats.dequeued,
-            "processing": stats.dequeued - finished,
-            "latency": stats.average_time,
+            "overall_tput": snapshot.throughput,
+            "recent_tput": snapshot.recent_throughput,
+            "elapsed": snapshot.elapsed,
+            "enqueued": snapshot.queue_depth,
+            "processing": snapshot.in_flight,
+            "latency": snapshot.average_latency,
+            "send_p50": send_times.p50,
+            "send_p90": send_times.p90,
+            "send_p99": send_times.p99,
+            "send_p999": send_times.p999,
+            "queue_p50": queue_delays.p50,
+            "queue_p90": queue_delays.p90,
+            "queue_p99": queue_delays.p99,
+            "queue_p999": queue_delays.p999,
+            "loop_lag": snapshot.loop_lag,
+            "loop_lag_p99": snapshot.loop_lag_p99,
+            "tasks": snapshot.task_count,
+            "broker_depth": snapshot.broker_depth,
+            "first_sent": first_sent,
+            "lanes": lanes,
         }
         return detailed_monitor_format.format(**stats_dict)
@@ -0,0 +1,142 @@
+import asyncio
+from collections import deque
+from typing import Deque, List
+
+from config import Config
+from sms_message import MessageBatch
+
+
+# A MessageBroker with a separate lane for each of `priority_lanes`
+# priorities, so an urgent batch never waits behind a full lane of bulk
+# traffic. A batch goes in the lane of its `priority`, clamped to the lanes
+# there are; each lane holds up to `max_queued_batches` batches, and
+# `put_batch` only blocks when the batch's own lane is full.
+#
+# `get_batch` picks a lane among the non-empty ones by `lane_policy`:
+# - "strict": always the highest priority lane
+# - "weighted": smooth weighted round robin with `lane_weights` (1 for any
+#   lane without a weight), so lane i gets about weight[i] / sum(weights)
+#   of the batches while every lane has some, and no lane starves.
+#
+# Shutdown works like asyncio.Queue.shutdown(): `put_batch` raises
+# QueueShutDown from then on, and `get_batch` keeps returning batches until
+# every lane is empty, and then returns None.
+class PriorityMessageBroker:
+    def __init__(self, conf: Config) -> None:
+        if conf.lane_policy not in ("strict", "weighted"):
+            raise ValueError(f"Unknown lane policy {conf.lane_policy!r}")
+        self.config = conf
+        lane_count = max(1, conf.priority_lanes)
+        self.lanes: List[Deque[MessageBatch]] = [deque() for _ in range(lane_count)]
+        self.weights = [
+            conf.lane_weights[i] if i < len(conf.lane_weights) else 1
+            for i in range(lane_count)
+        ]
+        if any(weight < 1 for weight in self.weights):
+            # A lane with no weight would never win the round robin.
+            raise ValueError(
+                f"Lane weights must be at least 1: {list(conf.lane_weights)}"
+            )
+        # Running credit of each lane for the weighted round robin. Ties go
+        # to the higher priority lane.
+        self._credit = [0] * lane_count
+        self._getters: Deque[asyncio.Future[None]] = deque()
+        self._putters: List[Deque[asyncio.Future[None]]] = [
+            deque() for _ in range(lane_count)
+        ]
+        self._count = 0
+        self._is_shutdown = False
+
+    def qsize(self) -> int:
+        return self._count
+
+    def lane_depths(self) -> List[int]:
+        return [len(lane) for lane in self.lanes]
+
+    def lane_of(self, batch: MessageBatch) -> int:
+        return min(max(batch.priority, 0), len(self.lanes) - 1)
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        lane = self.lane_of(batch)
+        putters = self._putters[lane]
+        while len(self.lanes[lane]) >= self.config.max_queued_batches:
+            if self._is_shutdown:
+                raise asyncio.QueueShutDown
+            putter = asyncio.get_running_loop().create_future()
+            putters.append(putter)
+            try:
+                await putter
+            except:
+                putter.cancel()
+                try:
+                    putters.remove(putter)
+                except ValueError:
+                    pass
+                if (
+                    len(self.lanes[lane]) < self.config.max_queued_batches
+                    and not putter.cancelled()
+                ):
+                    _wakeup_next(putters)
+                raise
+        if self._is_shutdown:
+            raise asyncio.QueueShutDown
+        self.lanes[lane].append(batch)
+        self._count += 1
+        _wakeup_next(self._getters)
+
+    def shutdown(self) -> None:
+        self._is_shutdown = True
+        for waiters in (self._getters, *self._putters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def get_batch(self) -> None | MessageBatch:
+        while self._count == 0:
+            if self._is_shutdown:
+                return None
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if self._count and not getter.cancelled():
+                    _wakeup_next(self._getters)
+                raise
+        lane = self._pick_lane()
+        batch = self.lanes[lane].popleft()
+        self._count -= 1
+        _wakeup_next(self._putters[lane])
+        return batch
+
+    def _pick_lane(self) -> int:
+        # Only called with at least one non-empty lane.
+        if self.config.lane_policy == "strict":
+            for lane in range(len(self.lanes) - 1, -1, -1):
+                if self.lanes[lane]:
+                    return lane
+        best = -1
+        total = 0
+        for lane, queue in enumerate(self.lanes):
+            if not queue:
+                continue
+            self._credit[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if best < 0 or self._credit[lane] >= self._credit[best]:
+                best = lane
+        self._credit[best] -= total
+        return best
+
+
+def _wakeup_next(waiters: Deque[asyncio.Future[None]]) -> None:
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            break
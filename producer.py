@@ -1,40 +1,192 @@
+from array import array
 import asyncio
+from collections import deque
+from concurrent.futures import Executor
 import random
 import string
-from typing import List
+from typing import AsyncIterator, Deque, List, Optional
 
-from broker import MessageBroker
+import numpy as np
+
+from broker import Broker
 from config import Config
+from dedup import DestinationIndex
+from local_stats import LocalStats
 from sms_message import SmsMessage, MessageBatch
 from stats_collector import StatsCollector
+from template import FIELD_SEPARATOR, intern_template
+
+# Bytes that message bodies are drawn from.
+_BODY_CHARSET = np.frombuffer(string.printable.encode("ascii"), dtype=np.uint8)
+
+
+def generate_batch_block(
+    rng: np.random.Generator,
+    conf: Config,
+    batch_count: int,
+    batch_size: int,
+) -> List[MessageBatch]:
+    # Generate `batch_count` batches of random messages with a few bulk
+    # NumPy calls for the whole block, rather than a Python loop per
+    # message. This is a plain function so it can also run in a worker
+    # process.
+    #
+    # With a message template, the batches share it and each message only
+    # gets random values for its fields.
+    n = batch_count * batch_size
+    destinations = rng.integers(0, 10**10, size=n, dtype=np.uint64)
+    template = None
+    if conf.message_template:
+        template = intern_template(conf.message_template)
+        field_length = conf.template_field_length
+        fields = template.field_count
+        length = fields * (field_length + 1) - 1 if fields else 0
+        lengths = np.full(n, length)
+        chars = _BODY_CHARSET[rng.integers(0, len(_BODY_CHARSET), size=(n, length))]
+        chars[:, field_length :: field_length + 1] = FIELD_SEPARATOR[0]
+        bodies = chars.tobytes()
+    else:
+        lengths = rng.integers(
+            conf.min_message_length, conf.max_message_length + 1, size=n
+        )
+    offsets = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    if template is None:
+        bodies = _BODY_CHARSET[
+            rng.integers(0, len(_BODY_CHARSET), size=int(offsets[-1]))
+        ].tobytes()
+
+    batches: List[MessageBatch] = []
+    for i in range(batch_count):
+        first = i * batch_size
+        last = first + batch_size
+        start = int(offsets[first])
+        end = int(offsets[last])
+        batch_offsets = (offsets[first : last + 1] - start).astype(np.uint32)
+        batches.append(
+            MessageBatch(
+                array("Q", destinations[first:last].tobytes()),
+                array("I", batch_offsets.tobytes()),
+                bodies[start:end],
+                template=template,
+            )
+        )
+    return batches
 
 
 class SmsMessageProducer:
     def __init__(
         self,
         conf: Config,
-        broker: MessageBroker,
+        broker: Broker,
         stats_collector: StatsCollector,
+        executor: Optional[Executor] = None,
+        stats: Optional[LocalStats] = None,
+        priority: int = 0,
+        dedup: Optional[DestinationIndex] = None,
     ) -> None:
         self.config = conf
         self.broker = broker
         self.stats_collector = stats_collector
+        # Stats are counted here and flushed to the collector in bulk. The
+        # default buffer flushes after every event.
+        self.stats = stats if stats is not None else LocalStats(stats_collector)
+        # If set, batches are generated in this executor (normally a process
+        # pool) instead of on the event loop.
+        self.executor = executor
+        # Priority given to every batch this producer sends.
+        self.priority = priority
+        # If set, messages to destinations already in this index are dropped,
+        # and the rest are added to it.
+        self.dedup = dedup
+        # Seeded from `random`, so that seeding it (as simulation mode does)
+        # makes runs repeatable.
+        self.rng = np.random.default_rng(random.getrandbits(128))
 
     async def send_multiple_batches(self, batch_count: int, batch_size: int) -> None:
-        for i in range(batch_count):
-            batch = await self.generate_message_batch(batch_size)
-            await self.broker.put_batch(batch)
-            await self.stats_collector.log_produced(batch_size)
-            # TODO: tunable sleep frequency
-            if (i + 1) % 10 == 0:
-                # Yield the processor so other coroutines can run
-                await asyncio.sleep(0)
+        if self.executor is not None:
+            blocks = self._prefetch_blocks(self.executor, batch_count, batch_size)
+        else:
+            blocks = self._generate_blocks(batch_count, batch_size)
+        loop = asyncio.get_running_loop()
+        sent = 0
+        async for block in blocks:
+            for batch in block:
+                await self._put_batch(batch, loop)
+                sent += 1
+                # TODO: tunable sleep frequency
+                if sent % 10 == 0:
+                    # Yield the processor so other coroutines can run
+                    await asyncio.sleep(0)
+        await self.stats.flush()
+
+    async def _put_batch(
+        self, batch: MessageBatch, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        if self.dedup is not None:
+            new = self.dedup.add_new(np.frombuffer(batch.destinations, dtype=np.uint64))
+            if not new.all():
+                await self.stats_collector.log_duplicates(len(batch) - int(new.sum()))
+                if not new.any():
+                    return
+                batch = batch.take(np.flatnonzero(new).tolist())
+        batch.priority = self.priority
+        batch.enqueued_at = loop.time()
+        await self.broker.put_batch(batch)
+        if self.stats.log_produced(len(batch)):
+            await self.stats.flush()
+
+    def _block_sizes(self, batch_count: int) -> List[int]:
+        block_size = max(1, self.config.generation_block_size)
+        full, remainder = divmod(batch_count, block_size)
+        return [block_size] * full + ([remainder] if remainder else [])
+
+    async def _generate_blocks(
+        self, batch_count: int, batch_size: int
+    ) -> AsyncIterator[List[MessageBatch]]:
+        for count in self._block_sizes(batch_count):
+            yield generate_batch_block(self.rng, self.config, count, batch_size)
+
+    async def _prefetch_blocks(
+        self, executor: Executor, batch_count: int, batch_size: int
+    ) -> AsyncIterator[List[MessageBatch]]:
+        # Keep enough blocks in progress in the executor to have about
+        # `prefetch_batches` batches ready ahead of the broker, so the event
+        # loop only has to enqueue finished batches.
+        loop = asyncio.get_running_loop()
+        block_sizes = deque(self._block_sizes(batch_count))
+        block_size = max(1, self.config.generation_block_size)
+        depth = max(1, -(-self.config.prefetch_batches // block_size))
+        pending: Deque[asyncio.Future[List[MessageBatch]]] = deque()
+
+        def submit() -> None:
+            # Each block gets its own child generator, so blocks draw
+            # independent random streams wherever they run.
+            pending.append(
+                loop.run_in_executor(
+                    executor,
+                    generate_batch_block,
+                    self.rng.spawn(1)[0],
+                    self.config,
+                    block_sizes.popleft(),
+                    batch_size,
+                )
+            )
+
+        try:
+            while block_sizes and len(pending) < depth:
+                submit()
+            while pending:
+                block = await pending.popleft()
+                if block_sizes:
+                    submit()
+                yield block
+        finally:
+            for future in pending:
+                future.cancel()
 
     async def generate_message_batch(self, batch_size: int) -> MessageBatch:
-        messages: List[SmsMessage] = []
-        for i in range(batch_size):
-            messages.append(self.generate_random_message())
-        return MessageBatch(messages)
+        return generate_batch_block(self.rng, self.config, 1, batch_size)[0]
 
     def generate_random_message(self) -> SmsMessage:
         dest = self._rand_phone_number()
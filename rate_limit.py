@@ -0,0 +1,193 @@
+import asyncio
+from collections import deque
+import logging
+import math
+from typing import Any, Callable, Coroutine, Deque, Dict, Set, Tuple
+
+from config import Config
+from sms_message import Message, MessageView, parse_destination
+from timer_wheel import TimingWheel
+
+log = logging.getLogger(__name__)
+
+# Sends a message that has been let through: (message, attempt).
+SendFunction = Callable[[Message, int], Coroutine[Any, Any, object]]
+
+# Bucket wakeups are kept on a timing wheel of this many slots.
+_WHEEL_SLOTS = 1024
+
+
+# A token bucket: `rate` tokens a second, holding at most `capacity`, and
+# starting full. A rate of `math.inf` never runs out. Messages that found
+# the bucket empty wait in `parked`, in order.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "parked")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self.tokens = self.capacity
+        self.updated = now
+        self.parked: Deque[Tuple[Message, int]] = deque()
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def ready_at(self) -> float:
+        # When the bucket will next have a whole token.
+        return self.updated + max(0.0, 1 - self.tokens) / self.rate
+
+
+# Limits the send rate per route, as a gateway would: every message takes a
+# token from the bucket for its destination's area-code prefix (the first
+# `rate_limit_prefix_digits` digits) and one from a global bucket. Routes
+# get `rate_limit_route` messages a second unless `rate_limit_routes` sets
+# their own rate, and the global bucket allows `rate_limit_global`; a rate
+# of 0 is unlimited. Buckets hold `rate_limit_burst` seconds of tokens.
+#
+# Senders call `admit` before each send. A message that is over its limit
+# is parked in its route's queue instead, and the sender goes on to its
+# next message, so a throttled route never holds up the others. Messages
+# that arrive while their route has messages parked are parked behind
+# them, so each route stays in order. A background task releases parked
+# messages as tokens refill, and sends them with `send`.
+#
+# Parked messages are held in memory, so there can be at most `capacity` of
+# them: `max_queued_batches` batches of `batch_size`, as many as the broker
+# holds. Senders wait in `wait_for_room` while the limiter is full, so they
+# stop taking batches and the broker pushes back on producers as usual.
+#
+# Admitting or parking a message is O(1). Routes with messages parked wait
+# for their next token on a timing wheel and, once they have one, take
+# turns at the global bucket round robin, so releasing is O(1) per message
+# as well, however many buckets there are.
+class RateLimiter:
+    def __init__(self, conf: Config, send: SendFunction) -> None:
+        self.config = conf
+        self.send = send
+        loop = asyncio.get_running_loop()
+        self._clock = loop.time
+        now = loop.time()
+        self._burst = conf.rate_limit_burst
+        self._route_rate = _rate(conf.rate_limit_route)
+        self._route_rates = {
+            prefix: _rate(rate) for prefix, rate in conf.rate_limit_routes
+        }
+        self._divisor = 10 ** (10 - conf.rate_limit_prefix_digits)
+        self.global_bucket = TokenBucket(_rate(conf.rate_limit_global), self._burst, now)
+        self.routes: Dict[int, TokenBucket] = {}
+        # Routes with messages parked that have a token of their own, and
+        # routes waiting for one.
+        self._active: Deque[TokenBucket] = deque()
+        self._waiting: TimingWheel[TokenBucket] = TimingWheel(
+            conf.rate_limit_tick, _WHEEL_SLOTS, now
+        )
+        # Messages parked, and released messages still being sent.
+        self.parked = 0
+        self.capacity = max(1, conf.max_queued_batches * max(1, conf.batch_size))
+        self._room = asyncio.Event()
+        self._room.set()
+        self._sending: Set[asyncio.Task[object]] = set()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._task: None | asyncio.Task[None] = None
+
+    def admit(self, msg: Message, attempt: int) -> bool:
+        # Take the tokens to send `msg` now and return True, or park it to
+        # be sent once there are tokens and return False.
+        if isinstance(msg, MessageView):
+            number = msg.destination_number
+        else:
+            number = parse_destination(msg.destination)
+        prefix = number // self._divisor
+        bucket = self.routes.get(prefix)
+        if bucket is None:
+            rate = self._route_rates.get(prefix, self._route_rate)
+            bucket = self.routes[prefix] = TokenBucket(rate, self._burst, self._clock())
+        if not bucket.parked:
+            now = self._clock()
+            bucket.refill(now)
+            self.global_bucket.refill(now)
+            if bucket.tokens >= 1 and self.global_bucket.tokens >= 1:
+                bucket.tokens -= 1
+                self.global_bucket.tokens -= 1
+                return True
+            self._active.append(bucket)
+            self._wakeup.set()
+            if self._task is None:
+                self._task = asyncio.create_task(self._release())
+        bucket.parked.append((msg, attempt))
+        self.parked += 1
+        if self.parked >= self.capacity:
+            self._room.clear()
+        return False
+
+    async def wait_for_room(self) -> None:
+        # Wait until fewer than `capacity` messages are parked. Callers should
+        # check again before parking another, as other waiters wake too.
+        await self._room.wait()
+
+    async def join(self) -> None:
+        # Wait until every parked message has been released and sent. If the
+        # task that releases them fails, they never will be, so raise its
+        # exception instead.
+        while self.parked or self._sending:
+            self._drained.clear()
+            drained = asyncio.ensure_future(self._drained.wait())
+            waiting_on: Set[asyncio.Future[Any]] = {drained}
+            if self._task is not None:
+                waiting_on.add(self._task)
+            await asyncio.wait(waiting_on, return_when=asyncio.FIRST_COMPLETED)
+            drained.cancel()
+            if self._task is not None and self._task.done():
+                self._task.result()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _release(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._active and not len(self._waiting):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            self._active.extend(self._waiting.advance(now))
+            self.global_bucket.refill(now)
+            while self._active and self.global_bucket.tokens >= 1:
+                bucket = self._active.popleft()
+                bucket.refill(now)
+                if bucket.tokens < 1:
+                    self._waiting.schedule(bucket.ready_at(), bucket)
+                    continue
+                bucket.tokens -= 1
+                self.global_bucket.tokens -= 1
+                msg, attempt = bucket.parked.popleft()
+                self.parked -= 1
+                if self.parked < self.capacity and not self._room.is_set():
+                    self._room.set()
+                task = asyncio.create_task(self.send(msg, attempt))
+                self._sending.add(task)
+                task.add_done_callback(self._sent)
+                if bucket.parked:
+                    self._active.append(bucket)
+            await asyncio.sleep(self.config.rate_limit_tick)
+
+    def _sent(self, task: "asyncio.Task[object]") -> None:
+        self._sending.discard(task)
+        if not task.cancelled():
+            error = task.exception()
+            if error is not None:
+                log.error("Send of a released message failed", exc_info=error)
+        if not self.parked and not self._sending:
+            self._drained.set()
+
+
+def enabled(conf: Config) -> bool:
+    return bool(conf.rate_limit_global or conf.rate_limit_route or conf.rate_limit_routes)
+
+
+def _rate(rate: float) -> float:
+    return rate if rate > 0 else math.inf
@@ -0,0 +1,203 @@
+from array import array
+import asyncio
+import csv
+import json
+import mmap
+import os
+from typing import List, Optional, Sequence, Tuple
+
+from broker import Broker
+from config import Config
+from dedup import DestinationIndex
+from local_stats import LocalStats
+from producer import SmsMessageProducer
+from sms_message import MessageBatch
+from stats_collector import StatsCollector
+from template import FIELD_SEPARATOR, MessageTemplate, intern_template
+
+# (start, offset, end) of a producer's byte range: the rows that start in
+# [start, end) are its own, and those before `offset` are already done.
+Progress = Tuple[int, int, int]
+
+# Read-ahead is dropped from memory in steps of this many bytes.
+_RELEASE_BYTES = 4 * 1024 * 1024
+
+
+def byte_ranges(size: int, count: int) -> List[Tuple[int, int]]:
+    # Split a file of `size` bytes into `count` ranges of about equal size.
+    # Ranges split rows arbitrarily; each row belongs to the range that its
+    # first byte is in.
+    count = max(1, count)
+    bounds = [size * i // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_destination_bytes(field: bytes) -> None | int:
+    # A 10-digit US number, with or without punctuation or a leading "+1",
+    # or None if `field` isn't one.
+    digits = field.translate(None, b" -().+")
+    if len(digits) == 11 and digits.startswith(b"1"):
+        digits = digits[1:]
+    if len(digits) != 10 or not digits.isdigit():
+        return None
+    return int(digits)
+
+
+def parse_rows(
+    rows: Sequence[bytes],
+    default_body: bytes,
+    template: None | MessageTemplate = None,
+) -> Tuple[MessageBatch, int]:
+    # A batch of the messages in `rows`, each "destination[,message]" with
+    # the message optionally quoted as in CSV, and the number of rows that
+    # were skipped because they had no valid destination (such as a header).
+    # Rows without a message get `default_body`. Blank rows are ignored.
+    #
+    # With a template, rows are "destination[,field...]" instead, and the
+    # batch carries the template and each row's fields as its parameters.
+    destinations = array("Q")
+    offsets = array("I", [0])
+    bodies: List[bytes] = []
+    end = 0
+    skipped = 0
+    for row in rows:
+        row = row.rstrip(b"\r")
+        if not row.strip():
+            continue
+        if b'"' in row:
+            fields = next(csv.reader([row.decode("utf-8")]))
+            field = fields[0].encode("utf-8")
+            if template is not None:
+                body = FIELD_SEPARATOR.join(f.encode("utf-8") for f in fields[1:])
+            else:
+                body = fields[1].encode("utf-8") if len(fields) > 1 else default_body
+        else:
+            field, comma, body = row.partition(b",")
+            if template is not None:
+                body = body.replace(b",", FIELD_SEPARATOR)
+            elif not comma:
+                body = default_body
+        number = parse_destination_bytes(field)
+        if number is None:
+            skipped += 1
+            continue
+        destinations.append(number)
+        bodies.append(body)
+        end += len(body)
+        offsets.append(end)
+    batch = MessageBatch(destinations, offsets, b"".join(bodies), template=template)
+    return batch, skipped
+
+
+# Produces the messages in a recipient file, one row per message, instead of
+# random ones. The file is memory-mapped and each producer reads only the
+# rows in its own byte range, `batch_size` rows at a time, so memory use is
+# bounded by the broker no matter how big the file is; pages already read
+# are dropped from memory as it goes.
+#
+# `offset` is the start of the next row to read: every row before it has
+# been put into the broker. Starting a producer at a saved offset resumes
+# where it left off.
+class RecipientFileProducer(SmsMessageProducer):
+    def __init__(
+        self,
+        conf: Config,
+        broker: Broker,
+        stats_collector: StatsCollector,
+        path: str,
+        start: int,
+        end: int,
+        stats: Optional[LocalStats] = None,
+        priority: int = 0,
+        dedup: Optional[DestinationIndex] = None,
+    ) -> None:
+        super().__init__(conf, broker, stats_collector, None, stats, priority, dedup)
+        self.path = path
+        self.start = start
+        self.offset = start
+        self.end = end
+        self.skipped = 0
+
+    @property
+    def progress(self) -> Progress:
+        return (self.start, self.offset, self.end)
+
+    async def send_file(self) -> None:
+        with open(self.path, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            await self._send_rows(mm)
+        finally:
+            mm.close()
+        await self.stats.flush()
+
+    async def _send_rows(self, mm: mmap.mmap) -> None:
+        loop = asyncio.get_running_loop()
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        default_body = self.config.recipient_message.encode("utf-8")
+        template = None
+        if self.config.message_template:
+            template = intern_template(self.config.message_template)
+        batch_size = max(1, self.config.batch_size)
+        self.offset = _row_start(mm, self.offset)
+        released = self.offset - self.offset % mmap.PAGESIZE
+        sent = 0
+        while self.offset < self.end:
+            rows, next_offset = _read_rows(mm, self.offset, self.end, batch_size)
+            batch, skipped = parse_rows(rows, default_body, template)
+            self.skipped += skipped
+            if len(batch):
+                await self._put_batch(batch, loop)
+            self.offset = next_offset
+            sent += 1
+            if sent % 10 == 0:
+                await asyncio.sleep(0)
+            if self.offset - released >= _RELEASE_BYTES:
+                done = self.offset - self.offset % mmap.PAGESIZE
+                mm.madvise(mmap.MADV_DONTNEED, released, done - released)
+                released = done
+
+
+def _row_start(mm: mmap.mmap, offset: int) -> int:
+    # The start of the first row that starts at or after `offset`.
+    if offset == 0 or mm[offset - 1 : offset] == b"\n":
+        return offset
+    newline = mm.find(b"\n", offset)
+    return len(mm) if newline < 0 else newline + 1
+
+
+def _read_rows(
+    mm: mmap.mmap, offset: int, end: int, count: int
+) -> Tuple[List[bytes], int]:
+    # Up to `count` rows starting at `offset`, and the offset after them.
+    # Rows that start before `end` are read whole, even past `end`.
+    rows: List[bytes] = []
+    size = len(mm)
+    while len(rows) < count and offset < end:
+        newline = mm.find(b"\n", offset)
+        stop = size if newline < 0 else newline
+        rows.append(mm[offset:stop])
+        offset = stop + 1
+    return rows, min(offset, size)
+
+
+def load_progress(path: str, size: int, count: int) -> List[Tuple[int, int]]:
+    # The (offset, end) range each of `count` producers should read from a
+    # file of `size` bytes: the rest of each range in the progress file at
+    # `path` if there is one for the same number of producers, or else the
+    # whole file split evenly.
+    if path and os.path.exists(path):
+        with open(path) as fp:
+            saved: List[Progress] = [tuple(entry) for entry in json.load(fp)]
+        if len(saved) == max(1, count):
+            return [(offset, end) for _, offset, end in saved]
+    return byte_ranges(size, count)
+
+
+def save_progress(path: str, producers: Sequence[RecipientFileProducer]) -> None:
+    temporary = path + ".tmp"
+    with open(temporary, "w") as fp:
+        json.dump([producer.progress for producer in producers], fp)
+    os.replace(temporary, path)
@@ -0,0 +1,166 @@
+from array import array
+import asyncio
+import heapq
+import itertools
+import random
+from typing import Dict, List, Tuple
+
+from broker import Broker
+from config import Config
+from sms_message import Message, MessageBatch, MessageView, parse_destination
+from stats_collector import StatsCollector
+
+# (due time, sequence number, attempt, priority, destination, body, sequence
+# number in the write-ahead log or -1)
+_Delayed = Tuple[float, int, int, int, int, bytes, int]
+
+
+# Retries failed sends with exponential backoff and jitter. It wraps the
+# broker that senders read from and has the same interface, so producers
+# (or a pump from another process) put batches into it as usual.
+#
+# Senders report every message's outcome: `retry` for a failed send, which
+# parks the message in a delay heap if it has attempts left, and `done` once
+# a message is finished for good. A background task moves messages from the
+# heap back into the broker as they come due, so senders never wait out a
+# backoff themselves.
+#
+# Because retried messages go back into the same broker, shutting it down
+# has to wait until every message put into it is finished. `shutdown` only
+# records that no new batches are coming; the wrapped broker is shut down
+# once nothing is left in flight or waiting for a retry.
+class RetryQueue:
+    def __init__(self, conf: Config, broker: Broker, collector: StatsCollector) -> None:
+        self.config = conf
+        self.broker = broker
+        self.collector = collector
+        self.delayed: List[_Delayed] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: None | asyncio.Task[None] = None
+        # Messages put into the broker that have not finished yet.
+        self.outstanding = 0
+        self._input_closed = False
+        self._is_shutdown = False
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        if self._input_closed:
+            raise asyncio.QueueShutDown
+        self.outstanding += len(batch)
+        await self.broker.put_batch(batch)
+
+    async def get_batch(self) -> None | MessageBatch:
+        return await self.broker.get_batch()
+
+    def shutdown(self) -> None:
+        self._input_closed = True
+        self._maybe_shutdown()
+
+    def done(self, count: int = 1) -> None:
+        # `count` messages were sent, or failed for good.
+        self.outstanding -= count
+        self._maybe_shutdown()
+
+    def retry(self, msg: Message, attempt: int) -> bool:
+        # Schedule another attempt at a message whose send attempt number
+        # `attempt` (counting from 0) failed. Returns False, and counts the
+        # message as done, if it has no attempts left.
+        next_attempt = attempt + 1
+        if next_attempt >= self.config.retry_max_attempts:
+            self.done()
+            return False
+        priority = 0
+        log_sequence = -1
+        if isinstance(msg, MessageView):
+            destination = msg.destination_number
+            body = msg.body
+            priority = msg.priority
+            logged = msg.log_sequence
+            if logged is not None:
+                log_sequence = logged
+        else:
+            destination = parse_destination(msg.destination)
+            body = msg.message.encode("utf-8")
+        due = asyncio.get_running_loop().time() + self.backoff(next_attempt)
+        entry = (
+            due,
+            next(self._sequence),
+            next_attempt,
+            priority,
+            destination,
+            body,
+            log_sequence,
+        )
+        heapq.heappush(self.delayed, entry)
+        if self.delayed[0] is entry:
+            self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._release())
+        return True
+
+    def backoff(self, attempt: int) -> float:
+        # Exponential backoff with "equal jitter": half the delay is fixed
+        # and half is random, so retries spread out but never bunch up at 0.
+        delay = min(
+            self.config.retry_max_delay,
+            self.config.retry_base_delay * 2.0 ** (attempt - 1),
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _maybe_shutdown(self) -> None:
+        if self._input_closed and self.outstanding == 0 and not self._is_shutdown:
+            self._is_shutdown = True
+            self.broker.shutdown()
+            if self._task is not None:
+                self._task.cancel()
+
+    async def _release(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.delayed:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.delayed[0][0] - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+            for batch in self._pop_due_batches(loop.time()):
+                batch.enqueued_at = loop.time()
+                await self.collector.log_retried(len(batch))
+                await self.broker.put_batch(batch)
+
+    def _pop_due_batches(self, now: float) -> List[MessageBatch]:
+        # Group the due messages into batches of up to `batch_size`, one
+        # attempt number and priority per batch. Messages that were logged
+        # keep their log sequence numbers, so they are acknowledged against
+        # their original log record.
+        groups: Dict[Tuple[int, int, bool], List[_Delayed]] = {}
+        while self.delayed and self.delayed[0][0] <= now:
+            entry = heapq.heappop(self.delayed)
+            groups.setdefault((entry[2], entry[3], entry[6] >= 0), []).append(entry)
+        batches: List[MessageBatch] = []
+        batch_size = max(1, self.config.batch_size)
+        for (attempt, priority, logged), entries in groups.items():
+            for start in range(0, len(entries), batch_size):
+                chunk = entries[start : start + batch_size]
+                offsets = array("I", [0])
+                for entry in chunk:
+                    offsets.append(offsets[-1] + len(entry[5]))
+                batches.append(
+                    MessageBatch(
+                        array("Q", [entry[4] for entry in chunk]),
+                        offsets,
+                        b"".join(entry[5] for entry in chunk),
+                        attempt,
+                        priority=priority,
+                        log_sequence=(
+                            array("Q", [entry[6] for entry in chunk]) if logged else None
+                        ),
+                    )
+                )
+        return batches
@@ -3,11 +3,18 @@ from dataclasses import dataclass
 from enum import Enum
 import logging
 import random
+from typing import List, Set, Tuple
 
-from broker import MessageBroker
+from broker import Broker
 from config import Config
-from sms_message import SmsMessage
+from gateway import GatewayClient
+from local_stats import LocalStats
+from rate_limit import RateLimiter
+from retry import RetryQueue
+from sms_message import Message, MessageBatch, MessageView
 from stats_collector import StatsCollector
+from template import RenderCache
+from wal import WriteAheadLog
 
 log = logging.getLogger(__name__)
 
@@ -15,40 +22,218 @@ log = logging.getLogger(__name__)
 class SendResult(Enum):
     SUCCESS = (0,)
     FAILURE = (1,)
+    # Over its rate limit; the limiter sends it later.
+    PARKED = (2,)
 
 
 class Sender:
     def __init__(
         self,
         conf: Config,
-        broker: MessageBroker,
+        broker: Broker,
         collector: StatsCollector,
+        retries: None | RetryQueue = None,
+        stats: None | LocalStats = None,
+        wal: None | WriteAheadLog = None,
+        rendered: None | RenderCache = None,
+        limiter: None | RateLimiter = None,
+        gateway: None | GatewayClient = None,
     ) -> None:
         self.config = conf
         self.broker = broker
         self.collector = collector
+        # If set, failed sends are handed to this for another attempt.
+        self.retries = retries
+        # Stats are counted here and flushed to the collector in bulk. The
+        # default buffer flushes after every event.
+        self.stats = stats if stats is not None else LocalStats(collector)
+        # If set, finished messages are acknowledged in this log.
+        self.wal = wal
+        # Recently rendered template bodies; a pool of senders shares one.
+        self.rendered = (
+            rendered if rendered is not None else RenderCache(conf.render_cache_size)
+        )
+        # If set, messages over their rate limit are parked with this
+        # instead of being sent.
+        self.limiter = limiter
+        # If set, messages are sent to this gateway instead of simulated.
+        self.gateway = gateway
+        self.retired = False
+
+    def retire(self) -> None:
+        # Stop taking new batches. Messages already taken are still sent.
+        self.retired = True
 
     async def consume_messages(self) -> None:
-        while True:
+        if self.config.send_window > 1:
+            await self._consume_windowed(self.config.send_window)
+        else:
+            await self._consume_serial()
+        await self.stats.flush()
+
+    async def _consume_serial(self) -> None:
+        while not self.retired:
             maybe_batch = await self.broker.get_batch()
             if maybe_batch is None:
                 break
-            await self.collector.log_dqueued(len(maybe_batch.messages))
-            for msg in maybe_batch.messages:
-                await self.send_message(msg)
-
-    async def send_message(self, msg: SmsMessage) -> SendResult:
-        # Sleep first: assume even a failed send takes time
-        send_time = max(
-            random.normalvariate(
-                self.config.send_time_mean, self.config.send_time_stddev
-            ),
-            0,
-        )
-        await asyncio.sleep(send_time)
-        if random.random() < self.config.send_failure_rate:
-            await self.collector.log_failed(send_time)
-            log.debug("Send failed")
+            if self.stats.log_dequeued(
+                len(maybe_batch), self._queue_delay(maybe_batch), maybe_batch.priority
+            ):
+                await self.stats.flush()
+            for i, msg in enumerate(maybe_batch):
+                try:
+                    await self._send(msg, maybe_batch.attempt)
+                except BaseException:
+                    # The rest of the batch will never be sent, so don't
+                    # leave the retry queue waiting for it.
+                    if self.retries is not None:
+                        self.retries.done(len(maybe_batch) - i - 1)
+                    raise
+
+    async def _consume_windowed(self, window_size: int) -> None:
+        # Keep up to `window_size` sends outstanding at once. A slot in the
+        # window is reserved before each message is started, and before
+        # fetching a batch, so the next batch is fetched as soon as there
+        # is room rather than when the current one is finished. If a send
+        # raises, no more are started, and once the window drains the first
+        # exception is raised, as it is by _consume_serial.
+        loop = asyncio.get_running_loop()
+        in_flight: Set[asyncio.Task[SendResult]] = set()
+        room: None | asyncio.Future[None] = None
+        errors: List[BaseException] = []
+
+        def finished(task: asyncio.Task[SendResult]) -> None:
+            in_flight.discard(task)
+            if not task.cancelled():
+                error = task.exception()
+                if error is not None:
+                    errors.append(error)
+            if room is not None and not room.done():
+                room.set_result(None)
+
+        async def wait_for_room() -> None:
+            nonlocal room
+            while len(in_flight) >= window_size:
+                room = loop.create_future()
+                await room
+
+        while not self.retired and not errors:
+            await wait_for_room()
+            maybe_batch = await self.broker.get_batch()
+            if maybe_batch is None:
+                break
+            if self.stats.log_dequeued(
+                len(maybe_batch), self._queue_delay(maybe_batch), maybe_batch.priority
+            ):
+                await self.stats.flush()
+            for i, msg in enumerate(maybe_batch):
+                await wait_for_room()
+                if errors:
+                    # The rest of the batch will never be sent, so don't
+                    # leave the retry queue waiting for it.
+                    if self.retries is not None:
+                        self.retries.done(len(maybe_batch) - i)
+                    break
+                # Start eagerly: the send runs up to its first await right
+                # away instead of costing an extra trip through the loop.
+                task = asyncio.Task(
+                    self._send(msg, maybe_batch.attempt), loop=loop, eager_start=True
+                )
+                in_flight.add(task)
+                task.add_done_callback(finished)
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        if errors:
+            raise errors[0]
+
+    def _queue_delay(self, batch: MessageBatch) -> None | float:
+        if batch.enqueued_at is None:
+            return None
+        return asyncio.get_running_loop().time() - batch.enqueued_at
+
+    async def _send(self, msg: Message, attempt: int) -> SendResult:
+        limiter = self.limiter
+        if limiter is not None:
+            # Parking is bounded, so wait for room rather than take more
+            # messages out of the broker than the limiter can hold.
+            while limiter.parked >= limiter.capacity:
+                await limiter.wait_for_room()
+            if not limiter.admit(msg, attempt):
+                return SendResult.PARKED
+        return await self.send_admitted(msg, attempt)
+
+    async def send_admitted(self, msg: Message, attempt: int) -> SendResult:
+        # Send a message that is within its rate limit, and record its
+        # outcome with the retry queue and the write-ahead log. A send that
+        # raises still counts as finished with the retry queue, which would
+        # otherwise never shut the broker down.
+        try:
+            result = await self.send_message(msg)
+        except BaseException:
+            if self.retries is not None:
+                self.retries.done()
+            raise
+        if result is SendResult.FAILURE:
+            if self.retries is None or not self.retries.retry(msg, attempt):
+                if self.wal is not None:
+                    self.wal.ack(msg)
+                if self.stats.log_failed_permanently(1):
+                    await self.stats.flush()
+            return result
+        if self.wal is not None:
+            self.wal.ack(msg)
+        if self.retries is not None:
+            self.retries.done()
+        return result
+
+    def render(self, msg: Message) -> str:
+        # The body to send. Templated bodies are only rendered here, just
+        # before they are sent.
+        if isinstance(msg, MessageView):
+            template = msg.template
+            if template is not None:
+                return self.rendered.render(template, msg.params)
+        return msg.message
+
+    async def send_message(self, msg: Message) -> SendResult:
+        # Only the gateway needs the rendered body; a simulated send renders
+        # it for the debug log alone, and only when that is enabled.
+        if self.gateway is not None:
+            send_time, sent = await self._send_to_gateway(
+                self.gateway, msg, self.render(msg)
+            )
+        else:
+            # Sleep first: assume even a failed send takes time
+            send_time = max(
+                random.normalvariate(
+                    self.config.send_time_mean, self.config.send_time_stddev
+                ),
+                0,
+            )
+            await asyncio.sleep(send_time)
+            sent = random.random() >= self.config.send_failure_rate
+        if not sent:
+            if self.stats.log_failed(send_time):
+                await self.stats.flush()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Send of %d characters failed", len(self.render(msg)))
             return SendResult.FAILURE
-        await self.collector.log_sent(send_time)
+        if self.stats.log_sent(send_time):
+            await self.stats.flush()
         return SendResult.SUCCESS
+
+    async def _send_to_gateway(
+        self, gateway: GatewayClient, msg: Message, body: str
+    ) -> Tuple[float, bool]:
+        # The time the send took, including any wait for a connection, and
+        # whether it succeeded. A broken connection, or one that could not
+        # be opened at all (such as a failed DNS lookup), counts as a failed
+        # send.
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            sent = await gateway.send(msg.destination, body)
+        except OSError as e:
+            log.debug("Gateway connection failed: %s", e)
+            sent = False
+        return loop.time() - start, sent
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from typing import List, Set
+
+import autoscaler
+from broker import Broker
+from config import Config
+import gateway
+from local_stats import StatsFlusher
+import rate_limit
+from retry import RetryQueue
+import sender
+from stats_collector import StatsCollector
+from template import RenderCache
+from wal import WriteAheadLog
+import wheel_sender
+
+log = logging.getLogger(__name__)
+
+
+# Runs the configured sender engine until the broker is drained:
+# - "tasks": `sender_count` Sender tasks, each sending one message at a time
+# - "timer_wheel": a TimerWheelSender with up to `sender_count` sends in
+#   flight
+# If `retries` is given, it should also be the broker the senders read from.
+# If `flusher` is given, each Sender buffers its stats in a LocalStats from it.
+# If `wal` is given, finished messages are acknowledged in it.
+# With `autoscale_enabled`, a SenderAutoscaler resizes the pool of Sender
+# tasks as it runs, starting from `sender_count` (tasks engine only).
+# With rate limits configured, every Sender shares a RateLimiter, and the
+# messages it parks are sent by one more Sender of the pool's own once they
+# are released (tasks engine only).
+# With the "http" sender backend, every Sender sends through one
+# GatewayClient, so the pool shares its connections (tasks engine only).
+class SenderPool:
+    def __init__(
+        self,
+        conf: Config,
+        broker: Broker,
+        collector: StatsCollector,
+        retries: None | RetryQueue = None,
+        flusher: None | StatsFlusher = None,
+        wal: None | WriteAheadLog = None,
+    ) -> None:
+        self.config = conf
+        self.broker = broker
+        self.collector = collector
+        self.retries = retries
+        self.flusher = flusher
+        self.wal = wal
+        # Senders that have not been retired, and the tasks of every sender
+        # that is still running, retired or not.
+        self.senders: List[sender.Sender] = []
+        self.tasks: Set[asyncio.Task[None]] = set()
+        # Shared by every Sender, so each body is rendered once per pool.
+        self.rendered = RenderCache(conf.render_cache_size)
+        self.limiter: None | rate_limit.RateLimiter = None
+        self.gateway: None | gateway.GatewayClient = None
+
+    async def run(self) -> None:
+        if self.config.sender_backend not in ("simulated", "http"):
+            raise ValueError(f"Unknown sender backend {self.config.sender_backend!r}")
+        if self.config.sender_engine == "tasks":
+            if self.config.sender_backend == "http":
+                self.gateway = gateway.GatewayClient(self.config)
+            try:
+                await self._run_tasks()
+            finally:
+                if self.gateway is not None:
+                    await self.gateway.close()
+        elif self.config.sender_engine == "timer_wheel":
+            if self.config.autoscale_enabled:
+                raise ValueError("Autoscaling needs the tasks sender engine")
+            if rate_limit.enabled(self.config):
+                raise ValueError("Rate limits need the tasks sender engine")
+            if self.config.sender_backend != "simulated":
+                raise ValueError("The timer_wheel engine only simulates sends")
+            engine = wheel_sender.TimerWheelSender(
+                self.config, self.broker, self.collector, self.retries, self.wal
+            )
+            await engine.run()
+        else:
+            raise ValueError(f"Unknown sender engine {self.config.sender_engine!r}")
+
+    @property
+    def size(self) -> int:
+        return len(self.senders)
+
+    def resize(self, count: int) -> None:
+        # Start or retire Sender tasks until `count` senders are active.
+        # Retired senders finish the batch they are working on first; one
+        # that is already waiting for a batch still takes and sends that
+        # batch before it exits. At least one sender is kept, since the
+        # pool only ends when the broker is drained, and with no senders
+        # producers would wait on a full broker forever.
+        count = max(1, count)
+        while len(self.senders) < count:
+            self._start_sender()
+        while len(self.senders) > count:
+            self.senders.pop().retire()
+
+    async def _run_tasks(self) -> None:
+        released: None | sender.Sender = None
+        if rate_limit.enabled(self.config):
+            released = self._new_sender()
+            self.limiter = rate_limit.RateLimiter(self.config, released.send_admitted)
+        await self._start_in_stages(self.config.sender_count)
+        scaler_task: None | asyncio.Task[None] = None
+        if self.config.autoscale_enabled:
+            scaler = autoscaler.SenderAutoscaler(self.config, self, self.collector)
+            scaler_task = scaler.run()
+        try:
+            # Senders can be added while we wait, so wait until none are left.
+            while self.tasks:
+                await asyncio.wait(list(self.tasks))
+            if self.limiter is not None and released is not None:
+                await self.limiter.join()
+                await self._finish_sender(released)
+        finally:
+            if scaler_task is not None:
+                scaler_task.cancel()
+
+    async def _start_in_stages(self, count: int) -> None:
+        # Start the senders `sender_startup_chunk` at a time and let the loop
+        # run between chunks, so the first senders are sending while the
+        # rest are still being created, instead of everything waiting for
+        # one long loop over the whole pool.
+        chunk = self.config.sender_startup_chunk
+        if chunk <= 0:
+            chunk = count
+        while self.size < count:
+            self.resize(min(count, self.size + chunk))
+            await asyncio.sleep(0)
+
+    def _new_sender(self) -> sender.Sender:
+        stats = self.flusher.local_stats() if self.flusher is not None else None
+        return sender.Sender(
+            self.config,
+            self.broker,
+            self.collector,
+            self.retries,
+            stats,
+            self.wal,
+            self.rendered,
+            self.limiter,
+            self.gateway,
+        )
+
+    def _start_sender(self) -> None:
+        send = self._new_sender()
+        # Start eagerly: the sender runs up to its first await (normally
+        # waiting for or taking a batch) right away, which saves a trip
+        # through the loop per sender.
+        task = asyncio.Task(
+            self._run_sender(send), loop=asyncio.get_running_loop(), eager_start=True
+        )
+        self.senders.append(send)
+        self.tasks.add(task)
+        task.add_done_callback(self._sender_finished)
+
+    async def _run_sender(self, send: sender.Sender) -> None:
+        try:
+            await send.consume_messages()
+        finally:
+            await self._finish_sender(send)
+
+    async def _finish_sender(self, send: sender.Sender) -> None:
+        if self.flusher is not None:
+            await self.flusher.release(send.stats)
+        else:
+            await send.stats.flush()
+
+    def _sender_finished(self, task: asyncio.Task[None]) -> None:
+        self.tasks.discard(task)
+        # Like gather(return_exceptions=True): a failed sender does not stop
+        # the others. Its messages count as finished with the retry queue
+        # (see Sender.send_admitted), and its exception is logged here.
+        if not task.cancelled():
+            error = task.exception()
+            if error is not None:
+                log.error("A sender failed", exc_info=error)
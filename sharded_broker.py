@@ -0,0 +1,241 @@
+import asyncio
+from array import array
+from collections import deque
+from typing import Deque, List, Tuple
+import weakref
+
+import numpy as np
+import numpy.typing as npt
+
+from config import Config
+from sms_message import MessageBatch
+
+# Fibonacci hashing multiplier (2^64 / golden ratio).
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def shard_of(destinations: npt.NDArray[np.uint64], shard_count: int) -> npt.NDArray[np.int64]:
+    # The shard each destination belongs to. Destinations are hashed first
+    # so that nearby numbers spread across shards.
+    hashed = (destinations * _HASH_MULTIPLIER) >> np.uint64(32)
+    return ((hashed * np.uint64(shard_count)) >> np.uint64(32)).astype(np.int64)
+
+
+# A MessageBroker split into `broker_shards` shards, each with its own queue
+# and its own waiting senders, instead of one queue that every sender waits
+# on. `put_batch` splits a batch by destination hash, so every message for a
+# destination goes through the same shard, in order. Split batches are
+# smaller than the ones put, so shards are bounded in messages rather than
+# batches: each holds up to its share of `max_queued_batches` full batches
+# of `batch_size` messages (and takes a batch whenever it is below that).
+#
+# Each task that calls `get_batch` is given a home shard, round robin, the
+# first time it calls. It takes batches from its home shard, steals from the
+# other shards when that is empty, and only waits (on its home shard) when
+# every shard is empty. A batch put into a shard with nobody waiting on it
+# wakes a sender waiting on another shard to steal it.
+#
+# Shutdown works like MessageBroker: `put_batch` raises QueueShutDown, and
+# `get_batch` returns batches until every shard is empty and then None.
+class ShardedBroker:
+    def __init__(self, conf: Config) -> None:
+        self.config = conf
+        self.shard_count = max(1, conf.broker_shards)
+        self.shards: List[Deque[MessageBatch]] = [
+            deque() for _ in range(self.shard_count)
+        ]
+        # Messages each shard holds before puts into it wait, and holds now.
+        self.shard_capacity = max(
+            1, -(-conf.max_queued_batches * max(1, conf.batch_size) // self.shard_count)
+        )
+        self._shard_messages = [0] * self.shard_count
+        self._getters: List[Deque[asyncio.Future[None]]] = [
+            deque() for _ in range(self.shard_count)
+        ]
+        self._putters: List[Deque[asyncio.Future[None]]] = [
+            deque() for _ in range(self.shard_count)
+        ]
+        self._homes: weakref.WeakKeyDictionary[asyncio.Task[object], int] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._next_home = 0
+        self._count = 0
+        self._is_shutdown = False
+
+    def qsize(self) -> int:
+        return self._count
+
+    def lane_depths(self) -> List[int]:
+        # Shards are not priority lanes; the broker has a single lane.
+        return [self._count]
+
+    def shard_depths(self) -> List[int]:
+        return [len(shard) for shard in self.shards]
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        if self._is_shutdown:
+            raise asyncio.QueueShutDown
+        if self.shard_count == 1:
+            await self._put(0, batch)
+            return
+        destinations = np.frombuffer(batch.destinations, dtype=np.uint64)
+        shards = shard_of(destinations, self.shard_count)
+        first = int(shards[0]) if len(shards) else 0
+        if not np.any(shards != first):
+            await self._put(first, batch)
+            return
+        for shard, part in _split(batch, shards):
+            await self._put(shard, part)
+
+    async def _put(self, shard: int, batch: MessageBatch) -> None:
+        queue = self.shards[shard]
+        putters = self._putters[shard]
+        while self._shard_messages[shard] >= self.shard_capacity:
+            if self._is_shutdown:
+                raise asyncio.QueueShutDown
+            putter = asyncio.get_running_loop().create_future()
+            putters.append(putter)
+            try:
+                await putter
+            except:
+                putter.cancel()
+                try:
+                    putters.remove(putter)
+                except ValueError:
+                    pass
+                if (
+                    self._shard_messages[shard] < self.shard_capacity
+                    and not putter.cancelled()
+                ):
+                    _wakeup_next(putters)
+                raise
+        if self._is_shutdown:
+            raise asyncio.QueueShutDown
+        queue.append(batch)
+        self._count += 1
+        self._shard_messages[shard] += len(batch)
+        if self._shard_messages[shard] < self.shard_capacity:
+            # A get that made room woke one putter; pass it on.
+            _wakeup_next(putters)
+        if not _wakeup_next(self._getters[shard]):
+            # Nobody is waiting on this shard; wake someone who can steal.
+            for offset in range(1, self.shard_count):
+                other = (shard + offset) % self.shard_count
+                if _wakeup_next(self._getters[other]):
+                    break
+
+    def shutdown(self) -> None:
+        self._is_shutdown = True
+        for waiters in (*self._getters, *self._putters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def get_batch(self) -> None | MessageBatch:
+        home = self._home()
+        while self._count == 0:
+            if self._is_shutdown:
+                return None
+            getters = self._getters[home]
+            getter = asyncio.get_running_loop().create_future()
+            getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    getters.remove(getter)
+                except ValueError:
+                    pass
+                if self._count and not getter.cancelled():
+                    _wakeup_next(getters)
+                raise
+        for offset in range(self.shard_count):
+            shard = (home + offset) % self.shard_count
+            queue = self.shards[shard]
+            if queue:
+                batch = queue.popleft()
+                self._count -= 1
+                self._shard_messages[shard] -= len(batch)
+                _wakeup_next(self._putters[shard])
+                return batch
+        raise AssertionError("Shard counts out of sync")
+
+    def _home(self) -> int:
+        task = asyncio.current_task()
+        if task is None:
+            return 0
+        home = self._homes.get(task)
+        if home is None:
+            home = self._homes[task] = self._next_home
+            self._next_home = (self._next_home + 1) % self.shard_count
+        return home
+
+
+def _split(
+    batch: MessageBatch, shards: npt.NDArray[np.int64]
+) -> List[Tuple[int, MessageBatch]]:
+    # Split `batch` into one batch per shard in `shards` (the shard of each
+    # message), keeping the messages' order within each. Every column is
+    # gathered with NumPy, rather than copying messages one at a time.
+    count = len(shards)
+    order = np.argsort(shards, kind="stable")
+    ordered_shards = shards[order]
+    bounds = np.flatnonzero(ordered_shards[1:] != ordered_shards[:-1]) + 1
+    starts = np.concatenate(([0], bounds)).tolist()
+    ends = np.concatenate((bounds, [count])).tolist()
+
+    offsets = np.frombuffer(batch.offsets, dtype=np.uint32).astype(np.int64)
+    lengths = (offsets[1:] - offsets[:-1])[order]
+    new_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    # Each body byte's position in `batch.bodies`: the start of its
+    # message's body there, plus how far it is into the body.
+    byte_positions = np.repeat(offsets[:-1][order] - new_offsets[:-1], lengths)
+    byte_positions += np.arange(int(new_offsets[-1]))
+    bodies = np.frombuffer(batch.bodies, dtype=np.uint8)[byte_positions].tobytes()
+    destinations = np.frombuffer(batch.destinations, dtype=np.uint64)[order]
+    log_sequence = None
+    if batch.log_sequence is not None:
+        log_sequence = np.frombuffer(batch.log_sequence, dtype=np.uint64)[order]
+
+    parts: List[Tuple[int, MessageBatch]] = []
+    for start, end in zip(starts, ends):
+        body_start = int(new_offsets[start])
+        parts.append(
+            (
+                int(ordered_shards[start]),
+                MessageBatch(
+                    array("Q", destinations[start:end].tobytes()),
+                    array(
+                        "I",
+                        (new_offsets[start : end + 1] - body_start)
+                        .astype(np.uint32)
+                        .tobytes(),
+                    ),
+                    bodies[body_start : int(new_offsets[end])],
+                    batch.attempt,
+                    batch.enqueued_at,
+                    batch.priority,
+                    (
+                        None
+                        if log_sequence is None
+                        else array("Q", log_sequence[start:end].tobytes())
+                    ),
+                    batch.template,
+                ),
+            )
+        )
+    return parts
+
+
+def _wakeup_next(waiters: Deque[asyncio.Future[None]]) -> bool:
+    # Wake the first waiter that is still waiting. Returns whether there was
+    # one.
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return True
+    return False
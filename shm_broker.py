@@ -0,0 +1,176 @@
+import asyncio
+from multiprocessing.context import BaseContext
+from multiprocessing.shared_memory import SharedMemory
+import struct
+from typing import Any, Dict
+
+from config import Config
+from sms_message import MessageBatch, decode_batch, encode_batch
+
+# Header at the start of the shared memory block:
+# write position, read position, queued batch count, shutdown flag.
+# Positions are byte offsets that only ever increase; the offset into the
+# data region is the position modulo its capacity.
+_HEADER = struct.Struct("<QQQQ")
+# Each record is a 4-byte length followed by the packed batch, padded so the
+# next record starts on an 8-byte boundary.
+_RECORD_LENGTH = struct.Struct("<I")
+# Marks unused space at the end of the data region; the reader skips to the
+# start of the region when it sees it.
+_WRAP_MARKER = 0xFFFFFFFF
+_ALIGNMENT = 8
+
+# Polling backoff when the ring is full (for writers) or empty (for readers).
+_MIN_POLL_DELAY = 0.00005
+_MAX_POLL_DELAY = 0.001
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGNMENT - 1) & ~(_ALIGNMENT - 1)
+
+
+# A broker backed by a ring buffer in a `multiprocessing.shared_memory`
+# block, so batches can move between processes as packed bytes instead of
+# pickled objects. It has the same interface as `MessageBroker`:
+# `put_batch` blocks while the ring is full (by bytes, or by holding
+# `max_queued_batches` batches), and after `shutdown` readers drain the ring
+# and then get `None`.
+#
+# There is no cross-process way to wake an asyncio task, so waiting is done
+# by polling with a short backoff. That is fine for the intended use, where
+# each process has a single task (see `broker.pump_batches`) reading from
+# the ring, but it is a poor fit for thousands of senders reading directly.
+class SharedMemoryBroker:
+    def __init__(self, conf: Config, ctx: BaseContext) -> None:
+        self.config = conf
+        self.capacity = _align(conf.ring_buffer_bytes)
+        self.lock = ctx.Lock()
+        self.shm = SharedMemory(create=True, size=_HEADER.size + self.capacity)
+        self._owner = True
+        self._init_views()
+        _HEADER.pack_into(self.header, 0, 0, 0, 0, 0)
+
+    def _init_views(self) -> None:
+        buf = self.shm.buf
+        assert buf is not None
+        self.header = buf[: _HEADER.size]
+        self.data = buf[_HEADER.size : _HEADER.size + self.capacity]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {
+            "config": self.config,
+            "capacity": self.capacity,
+            "lock": self.lock,
+            "name": self.shm.name,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.config = state["config"]
+        self.capacity = state["capacity"]
+        self.lock = state["lock"]
+        # Only the creating process should unlink the block, so don't
+        # register it with this process's resource tracker.
+        self.shm = SharedMemory(name=state["name"], track=False)
+        self._owner = False
+        self._init_views()
+
+    def close(self) -> None:
+        # Release this process's mapping, and the block itself if this
+        # process created it. The broker is unusable afterwards.
+        self.header.release()
+        self.data.release()
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        payload = encode_batch(batch)
+        record_size = _align(_RECORD_LENGTH.size + len(payload))
+        if record_size > self.capacity:
+            raise ValueError(
+                f"Batch of {len(payload)} bytes does not fit in the ring buffer"
+            )
+        delay = _MIN_POLL_DELAY
+        while not self._try_put(payload, record_size):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _MAX_POLL_DELAY)
+
+    def _try_put(self, payload: bytes, record_size: int) -> bool:
+        with self.lock:
+            write_pos, read_pos, count, is_shutdown = _HEADER.unpack_from(
+                self.header, 0
+            )
+            if is_shutdown:
+                raise asyncio.QueueShutDown
+            if count >= self.config.max_queued_batches:
+                return False
+            offset = write_pos % self.capacity
+            # Records never straddle the end of the region.
+            padding = 0
+            if self.capacity - offset < record_size:
+                padding = self.capacity - offset
+            if self.capacity - (write_pos - read_pos) < padding + record_size:
+                return False
+            if padding:
+                _RECORD_LENGTH.pack_into(self.data, offset, _WRAP_MARKER)
+                offset = 0
+            _RECORD_LENGTH.pack_into(self.data, offset, len(payload))
+            start = offset + _RECORD_LENGTH.size
+            self.data[start : start + len(payload)] = payload
+            _HEADER.pack_into(
+                self.header,
+                0,
+                write_pos + padding + record_size,
+                read_pos,
+                count + 1,
+                is_shutdown,
+            )
+            return True
+
+    def shutdown(self) -> None:
+        with self.lock:
+            write_pos, read_pos, count, is_shutdown = _HEADER.unpack_from(
+                self.header, 0
+            )
+            _HEADER.pack_into(self.header, 0, write_pos, read_pos, count, 1)
+
+    async def get_batch(self) -> None | MessageBatch:
+        delay = _MIN_POLL_DELAY
+        while True:
+            with self.lock:
+                write_pos, read_pos, count, is_shutdown = _HEADER.unpack_from(
+                    self.header, 0
+                )
+                if count > 0:
+                    return self._take(write_pos, read_pos, count, is_shutdown)
+                if is_shutdown:
+                    return None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _MAX_POLL_DELAY)
+
+    def _take(
+        self, write_pos: int, read_pos: int, count: int, is_shutdown: int
+    ) -> MessageBatch:
+        # Must be called with the lock held and at least one batch queued.
+        offset = read_pos % self.capacity
+        (length,) = _RECORD_LENGTH.unpack_from(self.data, offset)
+        if length == _WRAP_MARKER:
+            read_pos += self.capacity - offset
+            offset = 0
+            (length,) = _RECORD_LENGTH.unpack_from(self.data, offset)
+        start = offset + _RECORD_LENGTH.size
+        # This is the one copy on the way out of the ring: the record's
+        # space is handed back to writers as soon as the lock is released,
+        # while the batch may sit in a worker's local broker for much
+        # longer. decode_batch then makes the columns views into the copy,
+        # so nothing else is copied or unpacked.
+        batch = decode_batch(self.data[start : start + length].tobytes())
+        _HEADER.pack_into(
+            self.header,
+            0,
+            write_pos,
+            read_pos + _align(_RECORD_LENGTH.size + length),
+            count - 1,
+            is_shutdown,
+        )
+        return batch
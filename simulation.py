@@ -0,0 +1,105 @@
+import asyncio
+import random
+import selectors
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Coroutine,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from config import Config
+
+if TYPE_CHECKING:
+    from _typeshed import FileDescriptorLike
+
+T = TypeVar("T")
+
+
+# A selector that never waits for a timer. When the event loop has nothing
+# ready to run and asks to wait `timeout` seconds for the next timer, it
+# checks for real I/O without blocking and, if there is none, moves its
+# virtual clock forward by `timeout` instead of sleeping. Only if no timer is
+# scheduled at all, or work the loop is waiting for is still running in an
+# executor (`executor_jobs`), does it block on real I/O; an executor job
+# wakes the loop through its self-pipe when it finishes.
+class VirtualClockSelector(selectors.BaseSelector):
+    def __init__(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        self.time = 0.0
+        self.executor_jobs = 0
+
+    def register(
+        self, fileobj: "FileDescriptorLike", events: int, data: Any = None
+    ) -> selectors.SelectorKey:
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj: "FileDescriptorLike") -> selectors.SelectorKey:
+        return self._selector.unregister(fileobj)
+
+    def select(
+        self, timeout: Optional[float] = None
+    ) -> List[Tuple[selectors.SelectorKey, int]]:
+        ready = self._selector.select(0)
+        if ready or (timeout is not None and timeout <= 0):
+            return ready
+        if timeout is None or self.executor_jobs:
+            return self._selector.select(None)
+        self.time += timeout
+        return []
+
+    def get_map(self) -> Mapping["FileDescriptorLike", selectors.SelectorKey]:
+        return self._selector.get_map()
+
+    def close(self) -> None:
+        self._selector.close()
+
+
+# An event loop whose clock is virtual: time only passes when every task is
+# waiting on a timer, and then it jumps straight to the next one. A run that
+# spends most of its time in `asyncio.sleep`, like the simulated sends, takes
+# only as long as the CPU work in it. Work run in an executor (file writes,
+# fsyncs, snapshot loads) takes no virtual time: the clock waits for it, so
+# timers never overtake it and runs stay repeatable.
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self) -> None:
+        self._virtual_selector = VirtualClockSelector()
+        super().__init__(self._virtual_selector)
+
+    def time(self) -> float:
+        return self._virtual_selector.time
+
+    def run_in_executor(  # type: ignore[override]
+        self, executor: Any, func: Callable[..., T], *args: Any
+    ) -> "asyncio.Future[T]":
+        future = super().run_in_executor(executor, func, *args)
+        self._virtual_selector.executor_jobs += 1
+        future.add_done_callback(self._executor_job_done)
+        return future
+
+    def _executor_job_done(self, future: "asyncio.Future[Any]") -> None:
+        self._virtual_selector.executor_jobs -= 1
+
+
+def run(main: Coroutine[Any, Any, T], conf: Config) -> T:
+    # Run `main` like `asyncio.run`. With `simulation` set in the config, it
+    # runs on a VirtualClockEventLoop, and the random number generators are
+    # seeded from `simulation_seed` so every run gives the same results.
+    if not conf.simulation:
+        return asyncio.run(main)
+    if conf.worker_processes > 1 or conf.producer_processes > 0:
+        # Work done in other processes takes real time that the virtual clock
+        # does not wait for.
+        main.close()
+        raise ValueError(
+            "Simulation mode needs worker_processes = 1 and producer_processes = 0"
+        )
+    # Components seed their NumPy generators from `random`, so seeding it
+    # seeds everything.
+    random.seed(conf.simulation_seed)
+    return asyncio.run(main, loop_factory=VirtualClockEventLoop)
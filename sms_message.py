@@ -1,13 +1,295 @@
+from array import array
+from collections.abc import Sequence
 from dataclasses import dataclass
-from typing import List
+import math
+import struct
+from typing import Iterable, Iterator, List, Union, overload
 
+from template import MessageTemplate, intern_template
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class SmsMessage:
     destination: str
     message: str
 
 
-@dataclass(frozen=True)
-class MessageBatch:
-    messages: List[SmsMessage]
+# Destinations are stored as 10-digit US numbers without a country code,
+# and formatted as "ddd-ddd-dddd" when accessed as a string.
+def format_destination(number: int) -> str:
+    digits = f"{number:010d}"
+    return f"{digits[:3]}-{digits[3:6]}-{digits[6:]}"
+
+
+def parse_destination(destination: str) -> int:
+    return int(destination.replace("-", ""))
+
+
+# A read-only view of one message in a MessageBatch. It only holds a
+# reference to the batch and an index; the fields are read from the batch's
+# columns on access.
+class MessageView:
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch: "MessageBatch", index: int) -> None:
+        self._batch = batch
+        self._index = index
+
+    @property
+    def destination_number(self) -> int:
+        return self._batch.destinations[self._index]
+
+    @property
+    def destination(self) -> str:
+        return format_destination(self._batch.destinations[self._index])
+
+    @property
+    def attempt(self) -> int:
+        return self._batch.attempt
+
+    @property
+    def priority(self) -> int:
+        return self._batch.priority
+
+    @property
+    def log_sequence(self) -> None | int:
+        sequence = self._batch.log_sequence
+        return None if sequence is None else sequence[self._index]
+
+    @property
+    def template(self) -> None | MessageTemplate:
+        return self._batch.template
+
+    @property
+    def params(self) -> bytes:
+        # The message's entry in the bodies column: its body, or its
+        # template parameters if the batch has a template.
+        batch = self._batch
+        start = batch.offsets[self._index]
+        end = batch.offsets[self._index + 1]
+        return bytes(batch.bodies[start:end])
+
+    @property
+    def body(self) -> bytes:
+        if self._batch.template is not None:
+            return self.message.encode("utf-8")
+        return self.params
+
+    @property
+    def message(self) -> str:
+        batch = self._batch
+        start = batch.offsets[self._index]
+        end = batch.offsets[self._index + 1]
+        if batch.template is not None:
+            return batch.template.render(bytes(batch.bodies[start:end]))
+        return str(batch.bodies[start:end], "utf-8")
+
+    def __repr__(self) -> str:
+        return f"MessageView(destination={self.destination!r}, message={self.message!r})"
+
+
+Message = Union[SmsMessage, MessageView]
+
+# Column types: either owned arrays, or memoryviews into a packed buffer
+# (see decode_batch).
+IntColumn = Union["array[int]", memoryview]
+BytesColumn = Union[bytes, memoryview]
+
+
+# A batch of messages stored column-wise, so that a queued batch is a
+# handful of flat buffers instead of a pair of `str` objects per message:
+# - `destinations`: one unsigned 64-bit integer per message
+# - `bodies`: every message body, UTF-8 encoded and concatenated
+# - `offsets`: len + 1 unsigned 32-bit offsets into `bodies`; message i is
+#   `bodies[offsets[i]:offsets[i + 1]]`
+# `attempt` is the number of earlier send attempts for every message in the
+# batch, so 0 for new messages. `priority` picks the broker lane the batch
+# goes in when the broker has several (see priority_broker.py); higher is
+# more urgent, and 0 is ordinary bulk traffic. `enqueued_at` is the event
+# loop time (by default `time.monotonic()`, which is the same in every
+# process) at which the batch was first put into a broker, if it has been.
+# `log_sequence` has each message's sequence number in the write-ahead log
+# (see wal.py), if the batch was logged; it stays in the process and is not
+# encoded.
+# If `template` is set (see template.py), `bodies` holds each message's
+# template parameters, separated by template.FIELD_SEPARATOR, instead of its
+# body, and bodies are only rendered when they are read.
+# Indexing or iterating yields `MessageView`s.
+class MessageBatch(Sequence[MessageView]):
+    __slots__ = (
+        "destinations",
+        "offsets",
+        "bodies",
+        "attempt",
+        "enqueued_at",
+        "priority",
+        "log_sequence",
+        "template",
+    )
+
+    def __init__(
+        self,
+        destinations: IntColumn,
+        offsets: IntColumn,
+        bodies: BytesColumn,
+        attempt: int = 0,
+        enqueued_at: None | float = None,
+        priority: int = 0,
+        log_sequence: None | IntColumn = None,
+        template: None | MessageTemplate = None,
+    ) -> None:
+        assert len(offsets) == len(destinations) + 1
+        self.destinations = destinations
+        self.offsets = offsets
+        self.bodies = bodies
+        self.attempt = attempt
+        self.enqueued_at = enqueued_at
+        self.priority = priority
+        self.log_sequence = log_sequence
+        self.template = template
+
+    @classmethod
+    def from_messages(
+        cls, messages: Iterable[Message], attempt: int = 0, priority: int = 0
+    ) -> "MessageBatch":
+        destinations = array("Q")
+        offsets = array("I", [0])
+        bodies: List[bytes] = []
+        end = 0
+        for msg in messages:
+            destinations.append(parse_destination(msg.destination))
+            body = msg.message.encode("utf-8")
+            bodies.append(body)
+            end += len(body)
+            offsets.append(end)
+        return cls(destinations, offsets, b"".join(bodies), attempt, priority=priority)
+
+    def take(self, indices: Iterable[int]) -> "MessageBatch":
+        # A new batch of the messages at `indices`, in order. Its columns are
+        # copies, so it does not keep this batch's buffers alive.
+        destinations = array("Q")
+        offsets = array("I", [0])
+        bodies: List[bytes] = []
+        log_sequence = None if self.log_sequence is None else array("Q")
+        end = 0
+        for i in indices:
+            destinations.append(self.destinations[i])
+            body = bytes(self.bodies[self.offsets[i] : self.offsets[i + 1]])
+            bodies.append(body)
+            end += len(body)
+            offsets.append(end)
+            if log_sequence is not None:
+                assert self.log_sequence is not None
+                log_sequence.append(self.log_sequence[i])
+        return MessageBatch(
+            destinations,
+            offsets,
+            b"".join(bodies),
+            self.attempt,
+            self.enqueued_at,
+            self.priority,
+            log_sequence,
+            self.template,
+        )
+
+    # Kept so callers can keep writing `batch.messages`; the batch is
+    # itself the sequence of messages.
+    @property
+    def messages(self) -> "MessageBatch":
+        return self
+
+    def __len__(self) -> int:
+        return len(self.destinations)
+
+    @overload
+    def __getitem__(self, index: int) -> MessageView: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[MessageView]: ...
+
+    def __getitem__(self, index: int | slice) -> MessageView | List[MessageView]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MessageBatch index out of range")
+        return MessageView(self, index)
+
+    def __iter__(self) -> Iterator[MessageView]:
+        for i in range(len(self.destinations)):
+            yield MessageView(self, i)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, MessageBatch):
+            return NotImplemented
+        return (
+            self.attempt == other.attempt
+            and self.priority == other.priority
+            and self.template is other.template
+            and bytes(self.destinations) == bytes(other.destinations)
+            and bytes(self.offsets) == bytes(other.offsets)
+            and bytes(self.bodies) == bytes(other.bodies)
+        )
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"MessageBatch({list(self)!r})"
+
+    # Pickle as the packed encoding rather than as arrays of Python objects.
+    def __reduce__(self) -> tuple[object, ...]:
+        return (decode_batch, (encode_batch(self),))
+
+
+# Packed binary encoding of a batch, used to move batches between processes
+# without pickling. Layout: message count, body length, attempt, priority,
+# enqueue time (NaN if not set) and template length (0 if there is none),
+# then the destinations, offsets and bodies columns as raw bytes, and the
+# template text. The header is 32 bytes, which keeps the destinations
+# column 8-byte aligned.
+_HEADER = struct.Struct("<IIIIdI4x")
+
+
+def encode_batch(batch: MessageBatch) -> bytes:
+    template = batch.template
+    return b"".join(
+        (
+            _HEADER.pack(
+                len(batch),
+                len(batch.bodies),
+                batch.attempt,
+                batch.priority,
+                math.nan if batch.enqueued_at is None else batch.enqueued_at,
+                0 if template is None else len(template.encoded),
+            ),
+            bytes(batch.destinations),
+            bytes(batch.offsets),
+            bytes(batch.bodies),
+            b"" if template is None else template.encoded,
+        )
+    )
+
+
+def decode_batch(buf: bytes | memoryview) -> MessageBatch:
+    # The columns of the result are views into `buf`; nothing is copied.
+    view = memoryview(buf)
+    count, body_length, attempt, priority, enqueued_at, template_length = (
+        _HEADER.unpack_from(view, 0)
+    )
+    start = _HEADER.size
+    dest_end = start + 8 * count
+    offsets_end = dest_end + 4 * (count + 1)
+    bodies_end = offsets_end + body_length
+    template = None
+    if template_length:
+        template = intern_template(view[bodies_end : bodies_end + template_length])
+    return MessageBatch(
+        view[start:dest_end].cast("Q"),
+        view[dest_end:offsets_end].cast("I"),
+        view[offsets_end:bodies_end],
+        attempt,
+        None if math.isnan(enqueued_at) else enqueued_at,
+        priority,
+        template=template,
+    )
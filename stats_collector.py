@@ -1,4 +1,10 @@
-from dataclasses import dataclass
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+from histogram import VECTOR_MIN, LogHistogram, Percentiles
 
 
 @dataclass(frozen=True)
@@ -8,6 +14,104 @@ class MessagingStats:
     sent: int
     failed: int
     average_time: float
+    # `failed` counts failed send attempts. Of those, `retried` were put
+    # back in the broker for another attempt, and `failed_permanently`
+    # were given up on.
+    retried: int = 0
+    failed_permanently: int = 0
+    # Produced messages dropped because their destination had already been
+    # sent to (see dedup.py); these are not counted in `produced`.
+    duplicates: int = 0
+    # Distributions of send times (for sent and failed attempts) and of the
+    # time batches spent in the broker between being enqueued and dequeued.
+    send_time_histogram: LogHistogram = field(default_factory=LogHistogram)
+    queue_delay_histogram: LogHistogram = field(default_factory=LogHistogram)
+    # The queue delays again, split up by batch priority.
+    queue_delay_by_priority: Dict[int, LogHistogram] = field(default_factory=dict)
+    # Latest event loop health sample, and the distribution of loop lag
+    # (see loop_probe.LoopProbe). With several processes, the lag is the
+    # worst of their loops and the counts are totals.
+    loop_lag: float = 0.0
+    task_count: int = 0
+    broker_depth: int = 0
+    # Batches waiting in each lane of the broker, lowest priority first.
+    lane_depths: Tuple[int, ...] = ()
+    loop_lag_histogram: LogHistogram = field(default_factory=LogHistogram)
+    # Event loop times (time.monotonic, the same in every process) at which
+    # the application started and the first message was sent.
+    started_at: None | float = None
+    first_sent_at: None | float = None
+
+    @property
+    def time_to_first_sent(self) -> None | float:
+        if self.started_at is None or self.first_sent_at is None:
+            return None
+        return self.first_sent_at - self.started_at
+
+    @property
+    def send_time_percentiles(self) -> Percentiles:
+        return self.send_time_histogram.percentiles()
+
+    @property
+    def queue_delay_percentiles(self) -> Percentiles:
+        return self.queue_delay_histogram.percentiles()
+
+    @property
+    def loop_lag_percentiles(self) -> Percentiles:
+        return self.loop_lag_histogram.percentiles()
+
+
+def _earliest(a: None | float, b: None | float) -> None | float:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def merge_stats(a: MessagingStats, b: MessagingStats) -> MessagingStats:
+    a_count = a.sent + a.failed
+    b_count = b.sent + b.failed
+    total_count = a_count + b_count
+    if total_count > 0:
+        avg = (a.average_time * a_count + b.average_time * b_count) / total_count
+    else:
+        avg = 0
+    send_times = a.send_time_histogram.copy()
+    send_times.merge(b.send_time_histogram)
+    queue_delays = a.queue_delay_histogram.copy()
+    queue_delays.merge(b.queue_delay_histogram)
+    by_priority = {p: h.copy() for p, h in a.queue_delay_by_priority.items()}
+    for priority, histogram in b.queue_delay_by_priority.items():
+        by_priority.setdefault(priority, LogHistogram()).merge(histogram)
+    lane_count = max(len(a.lane_depths), len(b.lane_depths))
+    lane_depths = tuple(
+        (a.lane_depths[i] if i < len(a.lane_depths) else 0)
+        + (b.lane_depths[i] if i < len(b.lane_depths) else 0)
+        for i in range(lane_count)
+    )
+    loop_lags = a.loop_lag_histogram.copy()
+    loop_lags.merge(b.loop_lag_histogram)
+    return MessagingStats(
+        produced=a.produced + b.produced,
+        dequeued=a.dequeued + b.dequeued,
+        sent=a.sent + b.sent,
+        failed=a.failed + b.failed,
+        average_time=avg,
+        retried=a.retried + b.retried,
+        failed_permanently=a.failed_permanently + b.failed_permanently,
+        duplicates=a.duplicates + b.duplicates,
+        send_time_histogram=send_times,
+        queue_delay_histogram=queue_delays,
+        queue_delay_by_priority=by_priority,
+        loop_lag=max(a.loop_lag, b.loop_lag),
+        task_count=a.task_count + b.task_count,
+        broker_depth=a.broker_depth + b.broker_depth,
+        lane_depths=lane_depths,
+        loop_lag_histogram=loop_lags,
+        started_at=_earliest(a.started_at, b.started_at),
+        first_sent_at=_earliest(a.first_sent_at, b.first_sent_at),
+    )
 
 
 class StatsCollector:
@@ -17,25 +121,115 @@ class StatsCollector:
         self.sent: int = 0
         self.failed: int = 0
         self.time: float = 0.0
+        self.retried: int = 0
+        self.failed_permanently: int = 0
+        self.duplicates: int = 0
+        self.send_times = LogHistogram()
+        self.queue_delays: Dict[int, LogHistogram] = {}
+        self.loop_lag: float = 0.0
+        self.task_count: int = 0
+        self.broker_depth: int = 0
+        self.lane_depths: Tuple[int, ...] = ()
+        self.loop_lags = LogHistogram()
+        self.started_at: None | float = None
+        self.first_sent_at: None | float = None
+        # Latest cumulative snapshot from each remote source, e.g. the
+        # StatsCollector in each worker process.
+        self.remote: Dict[int, MessagingStats] = {}
 
     # These methods don't really need to be async in this
     # toy implementation, but I'm imagining a distributed
     # implementation where the stats collector may be logging
     # to a database or some other external service. In that
     # case they should be async.
+    async def log_started(self) -> None:
+        self.started_at = asyncio.get_running_loop().time()
+
+    async def log_first_sent(self, sent_at: float) -> None:
+        # A message was sent at loop time `sent_at`, for components that
+        # report sends later than they happen.
+        self.first_sent_at = _earliest(self.first_sent_at, sent_at)
+
     async def log_produced(self, batch_size: int) -> None:
         self.produced += batch_size
 
     async def log_dqueued(self, batch_size: int) -> None:
         self.dequeued += batch_size
 
+    async def log_queue_delay(self, delay: float, priority: int = 0) -> None:
+        self._queue_delays(priority).record(delay)
+
     async def log_sent(self, send_time: float) -> None:
+        if self.first_sent_at is None:
+            self.first_sent_at = asyncio.get_running_loop().time()
         self.sent += 1
         self.time += send_time
+        self.send_times.record(send_time)
 
     async def log_failed(self, send_time: float) -> None:
         self.failed += 1
         self.time += send_time
+        self.send_times.record(send_time)
+
+    async def log_retried(self, count: int) -> None:
+        self.retried += count
+
+    async def log_failed_permanently(self, count: int) -> None:
+        self.failed_permanently += count
+
+    async def log_duplicates(self, count: int) -> None:
+        self.duplicates += count
+
+    # Bulk versions of log_queue_delay, log_sent and log_failed, for
+    # components that buffer or complete many events at once.
+    # `priorities`, if given, has the priority of the batch each delay is for.
+    async def log_queue_delays(
+        self, delays: Sequence[float], priorities: None | Sequence[int] = None
+    ) -> None:
+        if priorities is None:
+            self._queue_delays(0).record_many(delays)
+            return
+        if len(delays) < VECTOR_MIN:
+            for delay, priority in zip(delays, priorities):
+                self._queue_delays(priority).record(delay)
+            return
+        values = np.asarray(delays, dtype=np.float64)
+        keys = np.asarray(priorities)
+        for priority in np.unique(keys).tolist():
+            self._queue_delays(priority).record_many(values[keys == priority])
+
+    async def log_sent_many(self, send_times: Sequence[float]) -> None:
+        if self.first_sent_at is None:
+            self.first_sent_at = asyncio.get_running_loop().time()
+        self.sent += len(send_times)
+        self.time += sum(send_times)
+        self.send_times.record_many(send_times)
+
+    async def log_failed_many(self, send_times: Sequence[float]) -> None:
+        self.failed += len(send_times)
+        self.time += sum(send_times)
+        self.send_times.record_many(send_times)
+
+    # `lane_depths` is the number of batches in each lane of the broker.
+    async def log_loop_health(
+        self, lag: float, task_count: int, lane_depths: Sequence[int]
+    ) -> None:
+        self.loop_lag = lag
+        self.task_count = task_count
+        self.broker_depth = sum(lane_depths)
+        self.lane_depths = tuple(lane_depths)
+        self.loop_lags.record(lag)
+
+    def _queue_delays(self, priority: int) -> LogHistogram:
+        histogram = self.queue_delays.get(priority)
+        if histogram is None:
+            histogram = self.queue_delays[priority] = LogHistogram()
+        return histogram
+
+    async def log_remote_stats(self, source: int, stats: MessagingStats) -> None:
+        # Snapshots are cumulative, so each one replaces the previous one
+        # from the same source.
+        self.remote[source] = stats
 
     async def get_stats(self) -> MessagingStats:
         total_count = self.sent + self.failed
@@ -43,10 +237,32 @@ class StatsCollector:
             avg = self.time / total_count
         else:
             avg = 0
-        return MessagingStats(
+        queue_delays = LogHistogram()
+        for histogram in self.queue_delays.values():
+            queue_delays.merge(histogram)
+        stats = MessagingStats(
             produced=self.produced,
             dequeued=self.dequeued,
             sent=self.sent,
             failed=self.failed,
             average_time=avg,
+            retried=self.retried,
+            failed_permanently=self.failed_permanently,
+            duplicates=self.duplicates,
+            send_time_histogram=self.send_times.copy(),
+            queue_delay_histogram=queue_delays,
+            queue_delay_by_priority={
+                priority: histogram.copy()
+                for priority, histogram in self.queue_delays.items()
+            },
+            loop_lag=self.loop_lag,
+            task_count=self.task_count,
+            broker_depth=self.broker_depth,
+            lane_depths=self.lane_depths,
+            loop_lag_histogram=self.loop_lags.copy(),
+            started_at=self.started_at,
+            first_sent_at=self.first_sent_at,
         )
+        for remote_stats in self.remote.values():
+            stats = merge_stats(stats, remote_stats)
+        return stats
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import string
+from typing import Dict, Tuple
+
+# Separates a message's template parameters in a batch's `bodies` column.
+FIELD_SEPARATOR = b"\x1f"
+
+
+# A campaign's message text, with positional `{0}`, `{1}`, ... fields that
+# are filled in per recipient, as in `str.format` (so literal braces are
+# written `{{` and `}}`). Batches of a campaign share one template and only
+# store each message's parameters, which are rendered into its body when it
+# is sent.
+class MessageTemplate:
+    __slots__ = ("text", "encoded", "field_count")
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.encoded = text.encode("utf-8")
+        self.field_count = 0
+        for _, field, _, _ in string.Formatter().parse(text):
+            if field is None:
+                continue
+            if not field.isdigit():
+                raise ValueError(f"Template fields must be numbered: {{{field}}}")
+            self.field_count = max(self.field_count, int(field) + 1)
+
+    def render(self, params: bytes) -> str:
+        # Missing parameters are rendered as empty strings.
+        if not self.field_count:
+            return self.text
+        fields = str(params, "utf-8").split("\x1f")
+        if len(fields) < self.field_count:
+            fields += [""] * (self.field_count - len(fields))
+        return self.text.format(*fields)
+
+    def __repr__(self) -> str:
+        return f"MessageTemplate({self.text!r})"
+
+
+# Interned templates, by their encoded text, so that every batch of a
+# campaign (including batches decoded from other processes) shares one.
+_templates: Dict[bytes, MessageTemplate] = {}
+
+
+def intern_template(text: str | bytes | memoryview) -> MessageTemplate:
+    encoded = text.encode("utf-8") if isinstance(text, str) else bytes(text)
+    template = _templates.get(encoded)
+    if template is None:
+        template = _templates[encoded] = MessageTemplate(str(encoded, "utf-8"))
+    return template
+
+
+# The most recently rendered bodies, by template and parameters. Campaigns
+# where many recipients get the same parameters (or a template without
+# fields) render each body once instead of once per message.
+class RenderCache:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._bodies: OrderedDict[Tuple[MessageTemplate, bytes], str] = OrderedDict()
+
+    def render(self, template: MessageTemplate, params: bytes) -> str:
+        if self.size <= 0:
+            return template.render(params)
+        key = (template, params)
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+            return body
+        body = self._bodies[key] = template.render(params)
+        if len(self._bodies) > self.size:
+            self._bodies.popitem(last=False)
+        return body
@@ -0,0 +1,79 @@
+import asyncio
+
+import autoscaler
+import broker
+import config
+import producer
+import sender_pool
+import stats_collector
+
+
+class FakePool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def resize(self, count: int) -> None:
+        self.size = count
+
+
+def test_hill_climbs_on_throughput() -> None:
+    conf = config.Config(
+        autoscale_step=10, autoscale_min_senders=10, autoscale_max_senders=100
+    )
+    pool = FakePool(50)
+    scaler = autoscaler.SenderAutoscaler(conf, pool, stats_collector.StatsCollector())
+
+    def step(throughput: float, lag: float = 0.0) -> int:
+        pool.resize(scaler.next_size(throughput, lag))
+        return pool.size
+
+    assert step(500) == 60
+    assert step(600) == 70
+    # Throughput fell: turn around.
+    assert step(550) == 60
+    assert step(600) == 50
+    # The loop is saturated: shrink regardless of throughput.
+    assert step(700, lag=1.0) == 40
+    assert step(100) == 50
+    for _ in range(10):
+        step(1000 + pool.size)
+    assert pool.size == 100
+
+
+def test_never_shrinks_to_no_senders() -> None:
+    conf = config.Config(autoscale_step=10, autoscale_min_senders=0)
+    pool = FakePool(15)
+    scaler = autoscaler.SenderAutoscaler(conf, pool, stats_collector.StatsCollector())
+    for _ in range(5):
+        pool.resize(scaler.next_size(0.0, 1.0))
+    assert pool.size == 1
+
+
+async def test_pool_resizes_while_running() -> None:
+    conf = config.Config(
+        sender_count=4, send_time_mean=0.01, send_time_stddev=0.001, max_queued_batches=10
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    pool = sender_pool.SenderPool(conf, br, collector)
+    run_task = asyncio.create_task(pool.run())
+    prod = producer.SmsMessageProducer(conf, br, collector)
+
+    await prod.send_multiple_batches(20, 5)
+    assert pool.size == 4
+    pool.resize(10)
+    assert len(pool.tasks) == 10
+    await prod.send_multiple_batches(20, 5)
+    pool.resize(2)
+    assert pool.size == 2
+    await prod.send_multiple_batches(20, 5)
+    # The pool keeps one sender, so the broker still drains.
+    pool.resize(0)
+    assert pool.size == 1
+    await prod.send_multiple_batches(20, 5)
+    br.shutdown()
+    await run_task
+
+    stats = await collector.get_stats()
+    assert stats.sent + stats.failed == 400
+    assert not pool.tasks
@@ -0,0 +1,47 @@
+import pathlib
+
+import benchmark
+import config
+
+
+def test_grid() -> None:
+    points = benchmark.grid({"sender_count": [10, 20], "batch_size": [1, 5, 10]})
+    assert len(points) == 6
+    assert points[0] == {"sender_count": 10, "batch_size": 1}
+    assert points[-1] == {"sender_count": 20, "batch_size": 10}
+
+
+def test_run_point() -> None:
+    conf = config.Config(
+        message_count=200,
+        batch_size=10,
+        sender_count=20,
+        send_time_mean=0.01,
+        send_time_stddev=0.001,
+        max_queued_batches=10,
+        stats_flush_count=10,
+        stats_flush_interval=0.01,
+    )
+    result = benchmark.run_point(conf)
+    assert result["throughput"] > 0
+    assert result["cpu_time"] > 0
+    assert result["peak_rss_mb"] > 0
+    assert 0.005 < result["send_time_p50"] < 0.02
+
+
+def test_compare_against_baseline(tmp_path: pathlib.Path) -> None:
+    baseline = [
+        {"sender_count": 10, "throughput": 100.0, "cpu_time": 1.0, "peak_rss_mb": 50.0},
+        {"sender_count": 20, "throughput": 200.0, "cpu_time": 1.0, "peak_rss_mb": 50.0},
+    ]
+    path = str(tmp_path / "baseline.csv")
+    benchmark.write_results(baseline, path)
+    baseline = benchmark.read_results(path)
+
+    results = [
+        {"sender_count": 10, "throughput": 95.0, "cpu_time": 1.05, "peak_rss_mb": 50.0},
+        {"sender_count": 20, "throughput": 150.0, "cpu_time": 1.5, "peak_rss_mb": 50.0},
+    ]
+    regressions = benchmark.compare(results, baseline, tolerance=0.1)
+    assert len(regressions) == 2
+    assert all(r.startswith("sender_count=20") for r in regressions)
@@ -1,3 +1,5 @@
+import multiprocessing
+
 import broker
 import config
 import producer
@@ -18,3 +20,21 @@ async def test_round_trip() -> None:
     assert res == batch1
     res = await br.get_batch()
     assert res == batch2
+
+
+async def test_process_queue_round_trip() -> None:
+    conf = config.Config(max_queued_batches=100)
+    collector = stats_collector.StatsCollector()
+    br = broker.ProcessQueueBroker(conf, multiprocessing.get_context("spawn"))
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    batches = [await prod.generate_message_batch(5) for i in range(40)]
+
+    for batch in batches:
+        await br.put_batch(batch)
+    br.shutdown()
+    received = []
+    while (res := await br.get_batch()) is not None:
+        received.append(res)
+    assert received == batches
+    # Once drained, the broker keeps returning None.
+    assert await br.get_batch() is None
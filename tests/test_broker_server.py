@@ -0,0 +1,175 @@
+import asyncio
+import dataclasses
+import pickle
+import socket
+import tempfile
+from typing import List
+
+import pytest
+
+import application
+import broker_server
+import config
+import producer
+from sms_message import MessageBatch
+import stats_collector
+
+
+async def start_server(conf: config.Config) -> tuple[broker_server.BrokerServer, config.Config]:
+    server = broker_server.BrokerServer(conf, "127.0.0.1", 0)
+    await server.start()
+    return server, dataclasses.replace(conf, broker_port=server.bound_port)
+
+
+async def make_batches(conf: config.Config, count: int) -> List[MessageBatch]:
+    collector = stats_collector.StatsCollector()
+    prod = producer.SmsMessageProducer(conf, broker_server.BrokerClient(conf), collector)
+    return [await prod.generate_message_batch(i % 5 + 1) for i in range(count)]
+
+
+async def test_round_trip_and_drain() -> None:
+    server, conf = await start_server(config.Config(max_queued_batches=8, broker_window=4))
+    batches = await make_batches(conf, 50)
+    sender_side = broker_server.BrokerClient(conf)
+    producer_side = broker_server.BrokerClient(conf)
+
+    async def put_all() -> None:
+        for batch in batches:
+            await producer_side.put_batch(batch)
+        producer_side.shutdown()
+
+    put_task = asyncio.create_task(put_all())
+    received: List[MessageBatch] = []
+    while (batch := await asyncio.wait_for(sender_side.get_batch(), 5)) is not None:
+        received.append(batch)
+    await put_task
+    assert received == batches
+    with pytest.raises(asyncio.QueueShutDown):
+        await producer_side.put_batch(batches[0])
+    await producer_side.close()
+    await sender_side.close()
+    await server.close()
+
+
+async def test_credit_follows_max_queued_batches() -> None:
+    server, conf = await start_server(config.Config(max_queued_batches=3, broker_window=8))
+    batches = await make_batches(conf, 5)
+    producer_side = broker_server.BrokerClient(conf)
+    for batch in batches[:3]:
+        await asyncio.wait_for(producer_side.put_batch(batch), 1)
+    with pytest.raises(TimeoutError):
+        await asyncio.wait_for(producer_side.put_batch(batches[3]), 0.1)
+    # Taking batches out frees credit for more.
+    sender_side = broker_server.BrokerClient(conf)
+    assert await sender_side.get_batch() == batches[0]
+    await asyncio.wait_for(producer_side.put_batch(batches[4]), 1)
+    await producer_side.close()
+    await sender_side.close()
+    await server.close()
+
+
+async def test_waits_for_every_producer_and_splits_between_consumers() -> None:
+    server, conf = await start_server(
+        config.Config(max_queued_batches=16, broker_window=2, broker_producers=2)
+    )
+    batches = await make_batches(conf, 20)
+    producers = [broker_server.BrokerClient(conf) for _ in range(2)]
+    consumers = [broker_server.BrokerClient(conf) for _ in range(3)]
+
+    async def put_all(client: broker_server.BrokerClient, part: List[MessageBatch]) -> None:
+        for batch in part:
+            await client.put_batch(batch)
+        client.shutdown()
+
+    async def get_all(client: broker_server.BrokerClient) -> List[MessageBatch]:
+        received: List[MessageBatch] = []
+        while (batch := await client.get_batch()) is not None:
+            received.append(batch)
+            await asyncio.sleep(0)
+        return received
+
+    first_put = asyncio.create_task(put_all(producers[0], batches[:10]))
+    get_tasks = [asyncio.create_task(get_all(client)) for client in consumers]
+    await first_put
+    # One producer is done; the consumers keep waiting for the other.
+    await asyncio.sleep(0.05)
+    assert not any(task.done() for task in get_tasks)
+    await put_all(producers[1], batches[10:])
+    results = await asyncio.wait_for(asyncio.gather(*get_tasks), 5)
+    assert sum(len(result) for result in results) == 20
+    assert all(results)
+    for client in producers + consumers:
+        await client.close()
+    await server.close()
+
+
+def test_client_pickles_without_connection() -> None:
+    conf = config.Config(broker_port=1234)
+    client = pickle.loads(pickle.dumps(broker_server.BrokerClient(conf)))
+    assert client.config.broker_port == 1234
+
+
+async def test_application_over_network_broker() -> None:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    cfg = f"""
+[messages]
+message_count = 400
+[producer]
+producer_count = 2
+batch_size = 10
+[sender]
+sender_count = 20
+send_time_mean = 0.01
+send_time_stddev = 0.001
+[application]
+worker_processes = 2
+worker_stats_interval = 0.1
+[broker]
+max_queued_batches = 16
+backend = "network"
+port = {port}
+window = 4
+"""
+    with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
+        fp.write(cfg.encode("utf-8"))
+        fp.close()
+        app = application.Application(fp.name)
+        await app.run()
+    stats = await app.stats_collector.get_stats()
+    assert stats.produced == 400
+    assert stats.dequeued == 400
+    assert stats.sent + stats.failed == 400
+
+
+async def test_buffers_up_to_max_queued_batches_before_any_consumer() -> None:
+    server, conf = await start_server(config.Config(max_queued_batches=10, broker_window=2))
+    batches = await make_batches(conf, 11)
+    producer_side = broker_server.BrokerClient(conf)
+    for batch in batches[:10]:
+        await asyncio.wait_for(producer_side.put_batch(batch), 1)
+    with pytest.raises(TimeoutError):
+        await asyncio.wait_for(producer_side.put_batch(batches[10]), 0.1)
+    sender_side = broker_server.BrokerClient(conf)
+    assert await sender_side.get_batch() == batches[0]
+    await producer_side.close()
+    await sender_side.close()
+    await server.close()
+
+
+async def test_lost_connection_is_not_end_of_stream() -> None:
+    async def hang_up(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.close()
+
+    server = await asyncio.start_server(hang_up, "127.0.0.1", 0)
+    conf = config.Config(broker_port=server.sockets[0].getsockname()[1])
+    client = broker_server.BrokerClient(conf)
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(client.get_batch(), 1)
+    batches = await make_batches(conf, 1)
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(client.put_batch(batches[0]), 1)
+    await client.close()
+    server.close()
+    await server.wait_closed()
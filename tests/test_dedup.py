@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import numpy as np
+
+import broker
+import config
+import dedup
+import producer
+import stats_collector
+
+
+def numbers(*values: int) -> np.ndarray:
+    return np.array(values, dtype=np.uint64)
+
+
+def test_add_new() -> None:
+    index = dedup.DestinationIndex()
+    # Repeats within a batch, and numbers sharing a byte of the bitmap.
+    new = index.add_new(numbers(5551234567, 8, 9, 8, 15, 5551234567))
+    assert new.tolist() == [True, True, True, False, True, False]
+    assert index.count == 4
+    assert index.add_new(numbers(9, 10, 9999999999)).tolist() == [False, True, True]
+    assert index.contains(numbers(8, 9, 10, 11, 15, 5551234567, 9999999999)).tolist() == [
+        True,
+        True,
+        True,
+        False,
+        True,
+        True,
+        True,
+    ]
+    # Only the chunks with numbers in them are allocated.
+    assert index.chunks_used == 3
+
+
+def test_snapshot(tmp_path: Path) -> None:
+    index = dedup.DestinationIndex()
+    rng = np.random.default_rng(1)
+    destinations = rng.integers(0, 10**10, size=10_000, dtype=np.uint64)
+    index.add_new(destinations)
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    loaded = dedup.DestinationIndex.load(path)
+    assert loaded.count == index.count
+    assert loaded.chunks_used == index.chunks_used
+    assert loaded.contains(destinations).all()
+    others = rng.integers(0, 10**10, size=10_000, dtype=np.uint64)
+    assert (loaded.contains(others) == index.contains(others)).all()
+
+
+async def test_producer_drops_duplicates() -> None:
+    conf = config.Config(max_queued_batches=100)
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    index = dedup.DestinationIndex()
+    prod = producer.SmsMessageProducer(conf, br, collector, dedup=index)
+    # Generate the same batch the producer is about to send, and put its
+    # first 4 destinations in the index.
+    prod.rng = np.random.default_rng(0)
+    first = await prod.generate_message_batch(10)
+    index.add_new(np.frombuffer(first.destinations, dtype=np.uint64)[:4])
+    prod.rng = np.random.default_rng(0)
+    await prod.send_multiple_batches(1, 10)
+    br.shutdown()
+    sent = await br.get_batch()
+    assert sent is not None
+    assert list(sent.destinations) == list(first.destinations)[4:]
+    stats = await collector.get_stats()
+    assert stats.duplicates == 4
+    assert stats.produced == 6
@@ -0,0 +1,102 @@
+import asyncio
+import dataclasses
+import socket
+
+import broker
+import config
+import gateway
+import sender
+import sender_pool
+from sms_message import MessageBatch, SmsMessage
+import stats_collector
+
+
+async def start_stub(conf: config.Config) -> tuple[gateway.StubGateway, config.Config]:
+    stub = gateway.StubGateway(conf, "127.0.0.1", 0)
+    await stub.start()
+    return stub, dataclasses.replace(conf, gateway_port=stub.bound_port)
+
+
+async def test_send_success_and_failure() -> None:
+    for rate, expected in ((0.0, True), (1.0, False)):
+        conf = config.Config(
+            send_time_mean=0.001, send_time_stddev=0.0, send_failure_rate=rate
+        )
+        stub, conf = await start_stub(conf)
+        client = gateway.GatewayClient(conf)
+        try:
+            assert await client.send("555-123-4567", "héllo & goodbye") is expected
+            assert stub.requests == 1
+        finally:
+            await client.close()
+            await stub.close()
+
+
+async def test_requests_are_pipelined() -> None:
+    conf = config.Config(
+        send_time_mean=0.1,
+        send_time_stddev=0.0,
+        send_failure_rate=0.0,
+        gateway_connections=2,
+        gateway_pipeline_depth=8,
+    )
+    stub, conf = await start_stub(conf)
+    client = gateway.GatewayClient(conf)
+    loop = asyncio.get_running_loop()
+    try:
+        start = loop.time()
+        results = await asyncio.gather(
+            *(client.send(f"555-000-{i:04d}", f"msg {i}") for i in range(32))
+        )
+        elapsed = loop.time() - start
+        assert all(results)
+        assert stub.requests == 32
+        assert len(client.connections) == 2
+        # 16 requests in flight at a time: two rounds of 0.1 s, not 32.
+        assert 0.2 <= elapsed < 1.0
+    finally:
+        await client.close()
+        await stub.close()
+
+
+async def test_pool_sends_through_gateway() -> None:
+    conf = config.Config(
+        sender_count=50,
+        send_time_mean=0.01,
+        send_time_stddev=0.001,
+        send_failure_rate=0.2,
+        max_queued_batches=100,
+        sender_backend="http",
+        gateway_connections=4,
+    )
+    stub, conf = await start_stub(conf)
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    for i in range(20):
+        await br.put_batch(
+            MessageBatch.from_messages(
+                [SmsMessage(f"555-{i:03d}-{j:04d}", "alert") for j in range(10)]
+            )
+        )
+    br.shutdown()
+    try:
+        await asyncio.wait_for(sender_pool.SenderPool(conf, br, collector).run(), 10)
+    finally:
+        await stub.close()
+    stats = await collector.get_stats()
+    assert stats.sent + stats.failed == 200
+    assert 0 < stats.failed < 100
+    assert stub.requests == 200
+
+
+async def test_unreachable_gateway_fails_sends() -> None:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    conf = config.Config(sender_backend="http", gateway_port=port)
+    collector = stats_collector.StatsCollector()
+    client = gateway.GatewayClient(conf)
+    send = sender.Sender(conf, broker.MessageBroker(conf), collector, gateway=client)
+    result = await send.send_message(SmsMessage("555-123-4567", "hi"))
+    assert result is sender.SendResult.FAILURE
+    assert (await collector.get_stats()).failed == 1
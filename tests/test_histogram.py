@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from histogram import LogHistogram
+
+
+def test_percentiles_are_within_relative_error() -> None:
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(0, 1, 12_345)
+    hist = LogHistogram()
+    hist.record_many(values.tolist())
+    assert hist.count == len(values)
+    for percent in (50, 90, 99, 99.9):
+        expected = float(np.percentile(values, percent, method="inverted_cdf"))
+        assert hist.percentile(percent) == pytest.approx(expected, rel=0.02)
+
+
+def test_record_many_matches_record() -> None:
+    values = [0.0, 0.000001, 0.000127, 0.000128, 0.5, 1.0, 2.5, 100.0, -1.0, 1e9]
+    one_at_a_time = LogHistogram()
+    for value in values:
+        one_at_a_time.record(value)
+    bulk = LogHistogram()
+    bulk.record_many(values)
+    assert bulk == one_at_a_time
+    # Enough values to take the vectorized path.
+    for value in values * 10:
+        one_at_a_time.record(value)
+    bulk.record_many(values * 10)
+    assert bulk == one_at_a_time
+
+
+def test_merge() -> None:
+    a = LogHistogram()
+    a.record_many([1.0] * 99)
+    b = LogHistogram()
+    b.record(10.0)
+    merged = a.copy()
+    merged.merge(b)
+    assert merged.count == 100
+    assert merged.percentile(50) == pytest.approx(1.0, rel=0.02)
+    assert merged.percentile(100) == pytest.approx(10.0, rel=0.02)
+    assert a.count == 99
+    assert LogHistogram().percentile(99) == 0.0
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+import config
+import local_stats
+import stats_collector
+
+
+async def test_flushes_at_threshold() -> None:
+    collector = stats_collector.StatsCollector()
+    stats = local_stats.LocalStats(collector, flush_count=3)
+    assert not stats.log_dequeued(10)
+    assert not stats.log_sent(1.0)
+    assert stats.log_failed(2.0)
+    assert (await collector.get_stats()).dequeued == 0
+
+    await stats.flush()
+    result = await collector.get_stats()
+    assert result.dequeued == 10
+    assert result.sent == 1
+    assert result.failed == 1
+    assert result.average_time == pytest.approx(1.5)
+    assert stats.pending == 0
+
+
+async def test_flusher_flushes_idle_buffers() -> None:
+    collector = stats_collector.StatsCollector()
+    conf = config.Config(stats_flush_count=1000, stats_flush_interval=0.01)
+    flusher = local_stats.StatsFlusher(conf, collector)
+    stats = flusher.local_stats()
+    stats.log_produced(5)
+    stats.log_failed_permanently(2)
+
+    task = flusher.run()
+    await asyncio.sleep(0.05)
+    task.cancel()
+    result = await collector.get_stats()
+    assert result.produced == 5
+    assert result.failed_permanently == 2
+
+    stats.log_produced(1)
+    await flusher.release(stats)
+    assert (await collector.get_stats()).produced == 6
+    assert stats not in flusher.buffers
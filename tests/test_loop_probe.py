@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+import broker
+import config
+import loop_probe
+import sms_message
+import stats_collector
+
+
+async def test_probe_reports_lag_and_depth() -> None:
+    conf = config.Config(monitor_probe_interval=0.01, max_queued_batches=10)
+    collector = stats_collector.StatsCollector()
+    queue = broker.MessageBroker(conf)
+    for _ in range(3):
+        await queue.put_batch(sms_message.MessageBatch.from_messages([]))
+    task = loop_probe.LoopProbe(conf, collector, queue.lane_depths).run()
+
+    await asyncio.sleep(0.05)
+    # Block the loop so the probe wakes up late.
+    time.sleep(0.1)
+    await asyncio.sleep(0.02)
+    task.cancel()
+
+    stats = await collector.get_stats()
+    assert stats.broker_depth == 3
+    assert stats.lane_depths == (3,)
+    assert stats.task_count >= 2
+    assert stats.loop_lag_histogram.count >= 3
+    assert stats.loop_lag_percentiles.p999 >= 0.05
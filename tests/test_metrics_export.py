@@ -0,0 +1,76 @@
+import asyncio
+import json
+import pathlib
+
+from histogram import Percentiles
+import metrics_export
+
+
+def make_snapshot(produced: int) -> metrics_export.MetricsSnapshot:
+    return metrics_export.MetricsSnapshot(
+        timestamp=100.0,
+        elapsed=2.0,
+        produced=produced,
+        dequeued=40,
+        sent=20,
+        failed=5,
+        retried=3,
+        failed_permanently=1,
+        queue_depth=produced - 40,
+        in_flight=15,
+        throughput=12.5,
+        recent_throughput=10.0,
+        average_latency=1.1,
+        send_time=Percentiles(p50=1.0, p90=1.2, p99=1.5, p999=2.0),
+        queue_delay=Percentiles(p50=0.1, p90=0.2, p99=0.3, p999=0.4),
+        loop_lag=0.002,
+        loop_lag_p99=0.01,
+        task_count=1000,
+        broker_depth=7,
+        time_to_first_sent=0.5,
+    )
+
+
+async def test_json_lines_sink(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "metrics.jsonl"
+    sink = metrics_export.JsonLinesSink(str(path))
+    await sink.start()
+    await sink.write(make_snapshot(100))
+    await sink.write(make_snapshot(200))
+    await sink.close()
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r["produced"] for r in records] == [100, 200]
+    assert records[1]["queue_depth"] == 160
+    assert records[0]["send_time"]["p99"] == 1.5
+
+
+async def fetch(port: int, path: str) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def test_prometheus_sink() -> None:
+    sink = metrics_export.PrometheusSink("127.0.0.1", 0)
+    await sink.start()
+    try:
+        await sink.write(make_snapshot(100))
+        response = await fetch(sink.bound_port, "/metrics")
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        body = response.split(b"\r\n\r\n", 1)[1].decode()
+        assert "sms_produced_total 100" in body
+        assert "sms_queue_depth 60" in body
+        assert "sms_in_flight 15" in body
+        assert "sms_loop_lag_seconds 0.002" in body
+        assert "sms_broker_depth 7" in body
+        assert "sms_time_to_first_sent_seconds 0.5" in body
+        assert 'sms_send_time_seconds{quantile="0.99"} 1.5' in body
+
+        response = await fetch(sink.bound_port, "/")
+        assert response.startswith(b"HTTP/1.1 404")
+    finally:
+        await sink.close()
@@ -1,5 +1,6 @@
 from monitor import Monitor
 from config import Config
+from histogram import LogHistogram
 from stats_collector import MessagingStats, StatsCollector
 
 
@@ -8,20 +9,56 @@ def test_stats_to_string() -> None:
     collector = StatsCollector()
     monitor = Monitor(conf, collector, now=10)
 
+    send_times = LogHistogram()
+    send_times.record_many([1.0] * 10 + [2.0])
+    queue_delays = LogHistogram()
+    queue_delays.record(0.25)
+    loop_lags = LogHistogram()
+    loop_lags.record(0.004)
     stats = MessagingStats(
-        produced=100, dequeued=25, sent=10, failed=1, average_time=1.2
+        produced=100,
+        dequeued=25,
+        sent=10,
+        failed=1,
+        average_time=1.2,
+        retried=1,
+        failed_permanently=0,
+        send_time_histogram=send_times,
+        queue_delay_histogram=queue_delays,
+        loop_lag=0.0015,
+        task_count=42,
+        broker_depth=3,
+        loop_lag_histogram=loop_lags,
+        started_at=100.0,
+        first_sent_at=101.25,
     )
 
     expected = """
 Total Produced: 100
-Enqueued: 75
+Enqueued: 76
 Processing: 14
 Finished: 11
 Failures: 10 sent, 1 failed. 9.1% failure rate.
+Retries: 1 retried, 0 permanently failed.
 Throughput: 5.5 msgs/s overall, 5.5 msgs/s recently.
 Latency: 1.2 s/msg.
+Send time: 1.000 s p50, 1.000 s p90, 2.000 s p99, 2.000 s p99.9.
+Queue delay: 0.250 s p50, 0.250 s p90, 0.250 s p99, 0.250 s p99.9.
+Event loop: 0.002 s lag, 0.004 s lag p99, 42 tasks, 3 batches in broker.
+Startup: 1.250 s to the first message sent.
 Elapsed: 2.0 s total run time.
 """
 
     res = monitor._stats_to_string(stats, now=12)
     assert res == expected
+
+
+def test_queue_depth_counts_retried_messages() -> None:
+    monitor = Monitor(Config(), StatsCollector(), now=10)
+    # Every message failed once and was dequeued again; 2 retries are queued.
+    stats = MessagingStats(
+        produced=10, dequeued=18, sent=8, failed=10, average_time=1.0, retried=10
+    )
+    snapshot = monitor._snapshot(stats, now=12)
+    assert snapshot.queue_depth == 2
+    assert snapshot.in_flight == 0
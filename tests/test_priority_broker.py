@@ -0,0 +1,117 @@
+import asyncio
+from typing import List
+
+import pytest
+
+import config
+import priority_broker
+import sender
+from sms_message import MessageBatch, SmsMessage
+import stats_collector
+
+
+def make_batch(priority: int, tag: str = "x") -> MessageBatch:
+    return MessageBatch.from_messages(
+        [SmsMessage("555-555-0100", tag)], priority=priority
+    )
+
+
+async def test_strict_priority() -> None:
+    conf = config.Config(priority_lanes=3, max_queued_batches=100)
+    br = priority_broker.PriorityMessageBroker(conf)
+    for i in range(5):
+        await br.put_batch(make_batch(0, f"bulk{i}"))
+    await br.put_batch(make_batch(2, "urgent"))
+    await br.put_batch(make_batch(1, "high"))
+    # Out of range priorities are clamped to the lanes there are.
+    await br.put_batch(make_batch(7, "urgent2"))
+    assert br.lane_depths() == [5, 1, 2]
+
+    order: List[str] = []
+    for _ in range(8):
+        batch = await br.get_batch()
+        assert batch is not None
+        order.append(batch[0].message)
+    assert order == ["urgent", "urgent2", "high", "bulk0", "bulk1", "bulk2", "bulk3", "bulk4"]
+
+
+async def test_weighted_fair_share() -> None:
+    conf = config.Config(
+        priority_lanes=2, lane_policy="weighted", lane_weights=(1, 3), max_queued_batches=100
+    )
+    br = priority_broker.PriorityMessageBroker(conf)
+    for _ in range(20):
+        await br.put_batch(make_batch(0))
+        await br.put_batch(make_batch(1))
+    priorities: List[int] = []
+    for _ in range(8):
+        batch = await br.get_batch()
+        assert batch is not None
+        priorities.append(batch.priority)
+    assert priorities.count(1) == 6
+    assert priorities.count(0) == 2
+
+
+@pytest.mark.parametrize("weights", [(0, 1), (1, -2)])
+def test_rejects_weights_below_one(weights: tuple[int, ...]) -> None:
+    conf = config.Config(priority_lanes=2, lane_policy="weighted", lane_weights=weights)
+    with pytest.raises(ValueError, match="at least 1"):
+        priority_broker.PriorityMessageBroker(conf)
+
+
+async def test_lanes_are_bounded_separately() -> None:
+    conf = config.Config(priority_lanes=2, max_queued_batches=2)
+    br = priority_broker.PriorityMessageBroker(conf)
+    await br.put_batch(make_batch(0))
+    await br.put_batch(make_batch(0))
+    blocked = asyncio.create_task(br.put_batch(make_batch(0)))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+    # The urgent lane still has room.
+    await asyncio.wait_for(br.put_batch(make_batch(1)), 1)
+
+    assert (await br.get_batch()) == make_batch(1)
+    assert not blocked.done()
+    assert (await br.get_batch()) == make_batch(0)
+    await asyncio.wait_for(blocked, 1)
+    assert br.qsize() == 2
+
+
+async def test_shutdown_drains_then_returns_none() -> None:
+    conf = config.Config(priority_lanes=2, max_queued_batches=10)
+    br = priority_broker.PriorityMessageBroker(conf)
+    waiting = asyncio.create_task(br.get_batch())
+    await asyncio.sleep(0)
+    await br.put_batch(make_batch(0))
+    assert (await waiting) == make_batch(0)
+    await br.put_batch(make_batch(1))
+
+    br.shutdown()
+    with pytest.raises(asyncio.QueueShutDown):
+        await br.put_batch(make_batch(1))
+    assert (await br.get_batch()) == make_batch(1)
+    assert (await br.get_batch()) is None
+    assert (await br.get_batch()) is None
+
+
+async def test_queue_delay_is_tracked_per_priority() -> None:
+    conf = config.Config(
+        priority_lanes=2,
+        max_queued_batches=10,
+        send_time_mean=0.001,
+        send_time_stddev=0.0001,
+    )
+    collector = stats_collector.StatsCollector()
+    br = priority_broker.PriorityMessageBroker(conf)
+    loop = asyncio.get_running_loop()
+    for priority in (0, 1, 1):
+        batch = make_batch(priority)
+        batch.enqueued_at = loop.time()
+        await br.put_batch(batch)
+    br.shutdown()
+    await sender.Sender(conf, br, collector).consume_messages()
+
+    stats = await collector.get_stats()
+    assert stats.queue_delay_by_priority[0].count == 1
+    assert stats.queue_delay_by_priority[1].count == 2
+    assert stats.queue_delay_histogram.count == 3
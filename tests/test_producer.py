@@ -1,12 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+
 import broker
+import numpy as np
 import config
 import producer
 import re
-from sms_message import SmsMessage
+from sms_message import Message
 import stats_collector
 
 
-def validate_message(msg: SmsMessage) -> None:
+def validate_message(msg: Message) -> None:
     assert len(msg.message) == 100
     assert len(msg.destination) == 12
 
@@ -34,3 +38,58 @@ async def test_message_batch() -> None:
     assert len(batch.messages) == 25
     for msg in batch.messages:
         validate_message(msg)
+
+
+def test_batch_block() -> None:
+    conf = config.Config(min_message_length=5, max_message_length=20)
+    rng = np.random.default_rng(1)
+    block = producer.generate_batch_block(rng, conf, 7, 13)
+    assert len(block) == 7
+    for batch in block:
+        assert len(batch) == 13
+        for msg in batch:
+            assert 5 <= len(msg.message) <= 20
+            assert msg.message.isascii()
+            assert 0 <= msg.destination_number < 10**10
+            assert len(msg.destination) == 12
+
+
+async def test_send_multiple_batches_partial_block() -> None:
+    conf = config.Config(max_queued_batches=100, generation_block_size=4)
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    await prod.send_multiple_batches(10, 3)
+    stats = await collector.get_stats()
+    assert stats.produced == 30
+    assert br.queue.qsize() == 10
+
+
+async def test_send_with_process_pool() -> None:
+    conf = config.Config(
+        max_queued_batches=100, generation_block_size=3, prefetch_batches=6
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as pool:
+        prod = producer.SmsMessageProducer(conf, br, collector, pool)
+        await prod.send_multiple_batches(10, 4)
+    stats = await collector.get_stats()
+    assert stats.produced == 40
+    assert br.queue.qsize() == 10
+    br.shutdown()
+    while (batch := await br.get_batch()) is not None:
+        assert len(batch) == 4
+        for msg in batch:
+            validate_message(msg)
+
+
+async def test_prefetch_with_zero_block_size() -> None:
+    # Like _block_sizes, a block size below 1 means blocks of one batch.
+    conf = config.Config(max_queued_batches=100, generation_block_size=0)
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    with ThreadPoolExecutor(1) as pool:
+        prod = producer.SmsMessageProducer(conf, br, collector, pool)
+        await prod.send_multiple_batches(5, 2)
+    assert br.queue.qsize() == 5
@@ -0,0 +1,173 @@
+import asyncio
+from typing import List, Tuple
+
+import pytest
+
+import broker
+import config
+import rate_limit
+import sender_pool
+from sms_message import Message, MessageBatch, SmsMessage
+import stats_collector
+
+
+def message(destination: str, i: int = 0) -> SmsMessage:
+    return SmsMessage(destination=destination, message=f"msg {i}")
+
+
+def test_token_bucket() -> None:
+    bucket = rate_limit.TokenBucket(10.0, 0.5, 100.0)
+    assert bucket.tokens == 5.0
+    bucket.tokens = 0.0
+    bucket.refill(100.25)
+    assert abs(bucket.tokens - 2.5) < 1e-9
+    bucket.tokens = 0.5
+    assert abs(bucket.ready_at() - 100.3) < 1e-9
+    bucket.refill(200.0)
+    assert bucket.tokens == 5.0
+
+
+def test_routes_config() -> None:
+    conf = config._read_config_from_string(
+        '[rate_limit]\nroute_rate = 5.0\nroutes = { "212" = 50.0, "555" = 1 }\n'
+    )
+    assert conf.rate_limit_route == 5.0
+    assert conf.rate_limit_routes == ((212, 50.0), (555, 1.0))
+    assert rate_limit.enabled(conf)
+    assert not rate_limit.enabled(config.Config())
+
+
+async def test_parks_over_limit_and_releases_in_order() -> None:
+    conf = config.Config(
+        rate_limit_route=100.0,
+        rate_limit_routes=((212, 1000.0),),
+        rate_limit_burst=0.02,
+        rate_limit_tick=0.001,
+    )
+    sent: List[Tuple[str, int]] = []
+
+    async def send(msg: Message, attempt: int) -> None:
+        sent.append((msg.message, attempt))
+
+    limiter = rate_limit.RateLimiter(conf, send)
+    # The 555 bucket holds 2 tokens; the rest are parked, in order.
+    admitted = [limiter.admit(message("555-000-0000", i), 0) for i in range(6)]
+    assert admitted == [True, True, False, False, False, False]
+    # A busy route does not hold up others.
+    assert limiter.admit(message("212-555-0000"), 1)
+    assert limiter.parked == 4
+    await asyncio.wait_for(limiter.join(), 1.0)
+    assert sent == [(f"msg {i}", 0) for i in range(2, 6)]
+    assert limiter.parked == 0
+
+
+async def test_global_limit_applies_across_routes() -> None:
+    conf = config.Config(rate_limit_global=200.0, rate_limit_burst=0.01)
+    sent: List[Message] = []
+
+    async def send(msg: Message, attempt: int) -> None:
+        sent.append(msg)
+
+    limiter = rate_limit.RateLimiter(conf, send)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    admitted = sum(
+        limiter.admit(message(f"{100 + i}-000-0000"), 0) for i in range(40)
+    )
+    assert admitted == 2
+    await asyncio.wait_for(limiter.join(), 2.0)
+    assert len(sent) == 38
+    # 38 more tokens at 200 a second.
+    assert loop.time() - start >= 0.15
+
+
+async def test_failed_sends_are_logged_and_release_failures_raised(
+    caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    conf = config.Config(rate_limit_route=100.0, rate_limit_burst=0.01)
+
+    async def send(msg: Message, attempt: int) -> None:
+        raise RuntimeError(f"could not send {msg.message}")
+
+    limiter = rate_limit.RateLimiter(conf, send)
+    admitted = [limiter.admit(message("555-000-0000", i), 0) for i in range(3)]
+    assert admitted == [True, False, False]
+    await asyncio.wait_for(limiter.join(), 1.0)
+    assert "could not send msg 2" in caplog.text
+
+    limiter = rate_limit.RateLimiter(conf, send)
+
+    def broken_advance(now: float) -> List[rate_limit.TokenBucket]:
+        raise ValueError("wheel broke")
+
+    monkeypatch.setattr(limiter._waiting, "advance", broken_advance)
+    limiter.admit(message("555-000-0000"), 0)
+    limiter.admit(message("555-000-0000"), 0)
+    with pytest.raises(ValueError, match="wheel broke"):
+        await asyncio.wait_for(limiter.join(), 1.0)
+
+
+async def test_parked_messages_are_capped() -> None:
+    conf = config.Config(
+        sender_count=20,
+        send_time_mean=0.0,
+        send_time_stddev=0.0,
+        send_failure_rate=0.0,
+        max_queued_batches=2,
+        batch_size=5,
+        rate_limit_global=500.0,
+        rate_limit_burst=0.01,
+        rate_limit_tick=0.001,
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    pool = sender_pool.SenderPool(conf, br, collector)
+    most_parked = 0
+
+    async def produce() -> None:
+        nonlocal most_parked
+        for start in range(0, 200, 5):
+            await br.put_batch(
+                MessageBatch.from_messages(
+                    [message(f"{100 + i}-000-0000", i) for i in range(start, start + 5)]
+                )
+            )
+            if pool.limiter is not None:
+                most_parked = max(most_parked, pool.limiter.parked)
+        br.shutdown()
+
+    await asyncio.wait_for(asyncio.gather(produce(), pool.run()), 5.0)
+    assert pool.limiter is not None
+    assert pool.limiter.capacity == 10
+    assert 0 < most_parked <= 10
+    assert (await collector.get_stats()).sent == 200
+
+
+async def test_pool_sends_everything_within_limits() -> None:
+    conf = config.Config(
+        sender_count=20,
+        send_time_mean=0.001,
+        send_time_stddev=0.0001,
+        send_failure_rate=0.0,
+        max_queued_batches=100,
+        rate_limit_route=200.0,
+        rate_limit_burst=0.05,
+        rate_limit_tick=0.001,
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    for route in ("555", "212"):
+        await br.put_batch(
+            MessageBatch.from_messages(
+                [message(f"{route}-000-{i:04d}", i) for i in range(50)]
+            )
+        )
+    br.shutdown()
+    pool = sender_pool.SenderPool(conf, br, collector)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.wait_for(pool.run(), 5.0)
+    stats = await collector.get_stats()
+    assert stats.sent == 100
+    # Each route sends 10 at once and the other 40 at 200 a second.
+    assert loop.time() - start >= 0.15
@@ -0,0 +1,127 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import List
+
+import application
+import broker
+import config
+import recipients
+from sms_message import MessageBatch
+import stats_collector
+
+
+def write_file(path: Path, count: int) -> List[int]:
+    numbers = [5550000000 + i * 37 for i in range(count)]
+    with open(path, "w") as fp:
+        fp.write("phone,message\n")
+        for i, number in enumerate(numbers):
+            fp.write(f"{number},hello {i}\n")
+    return numbers
+
+
+def test_parse_rows() -> None:
+    batch, skipped = recipients.parse_rows(
+        [
+            b"phone,message",
+            b"555-123-4567,hi there",
+            b'+1 (555) 000-0001,"hello, world"',
+            b"5550000002\r",
+            b"",
+            b"12345,too short",
+        ],
+        b"default",
+    )
+    assert skipped == 2
+    assert [msg.destination for msg in batch] == [
+        "555-123-4567",
+        "555-000-0001",
+        "555-000-0002",
+    ]
+    assert [msg.message for msg in batch] == ["hi there", "hello, world", "default"]
+
+
+async def drain(br: broker.MessageBroker) -> List[MessageBatch]:
+    batches = []
+    while (batch := await br.get_batch()) is not None:
+        batches.append(batch)
+    return batches
+
+
+async def test_ranges_cover_every_row_once(tmp_path: Path) -> None:
+    path = tmp_path / "recipients.csv"
+    numbers = write_file(path, 1000)
+    conf = config.Config(batch_size=7, max_queued_batches=1000)
+    br = broker.MessageBroker(conf)
+    collector = stats_collector.StatsCollector()
+    ranges = recipients.byte_ranges(path.stat().st_size, 5)
+    producers = [
+        recipients.RecipientFileProducer(conf, br, collector, str(path), start, end)
+        for start, end in ranges
+    ]
+    await asyncio.gather(*(prod.send_file() for prod in producers))
+    br.shutdown()
+    sent = [msg.destination_number for batch in await drain(br) for msg in batch]
+    assert sorted(sent) == numbers
+    assert sum(prod.skipped for prod in producers) == 1
+    assert all(prod.offset >= prod.end for prod in producers)
+    assert (await collector.get_stats()).produced == 1000
+
+
+async def test_resume_from_offset(tmp_path: Path) -> None:
+    path = tmp_path / "recipients.csv"
+    numbers = write_file(path, 100)
+    conf = config.Config(batch_size=10, max_queued_batches=3)
+    br = broker.MessageBroker(conf)
+    collector = stats_collector.StatsCollector()
+    size = path.stat().st_size
+    prod = recipients.RecipientFileProducer(conf, br, collector, str(path), 0, size)
+    # The broker only takes 3 batches, so the producer stops partway.
+    task = asyncio.create_task(prod.send_file())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    first = [msg.destination_number for _ in range(3) for msg in br.queue.get_nowait()]
+    start, offset, end = prod.progress
+    assert 0 < offset < end == size
+
+    resumed = recipients.RecipientFileProducer(conf, br, collector, str(path), offset, end)
+    resumer = asyncio.create_task(resumed.send_file())
+    rest: List[int] = []
+    while not resumer.done() or br.queue.qsize():
+        batch = await br.get_batch()
+        assert batch is not None
+        rest.extend(msg.destination_number for msg in batch)
+    assert first + rest == numbers
+
+
+def test_application_sends_file(tmp_path: Path) -> None:
+    path = tmp_path / "recipients.csv"
+    write_file(path, 500)
+    progress = tmp_path / "progress.json"
+    conf = config.Config(
+        recipient_file=str(path),
+        recipient_progress_path=str(progress),
+        producer_count=3,
+        batch_size=10,
+        sender_count=50,
+        send_time_mean=0.001,
+        send_time_stddev=0,
+        send_failure_rate=0,
+        max_queued_batches=10,
+        print_frequency=1000,
+        monitor_probe_interval=0,
+    )
+    app = application.Application("", conf)
+    asyncio.run(app.run())
+    stats = asyncio.run(app.stats_collector.get_stats())
+    assert stats.sent == 500
+    # Every producer and sender released its stats buffer.
+    assert not app.flusher.buffers
+    saved = json.loads(progress.read_text())
+    assert len(saved) == 3
+    assert all(offset >= end for _, offset, end in saved)
+
+    # Everything was read, so running again sends nothing.
+    app = application.Application("", conf)
+    asyncio.run(app.run())
+    assert asyncio.run(app.stats_collector.get_stats()).sent == 0
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import broker
+import config
+import producer
+import retry
+import sender
+from sms_message import Message
+import stats_collector
+import wheel_sender
+
+
+def make_config(engine: str = "tasks") -> config.Config:
+    return config.Config(
+        send_time_mean=0.001,
+        send_time_stddev=0.0001,
+        send_failure_rate=0.5,
+        max_queued_batches=100,
+        batch_size=5,
+        sender_engine=engine,
+        wheel_tick=0.001,
+        retry_max_attempts=3,
+        retry_base_delay=0.01,
+        retry_max_delay=0.02,
+    )
+
+
+def test_backoff_grows_and_is_capped() -> None:
+    conf = config.Config(retry_base_delay=1.0, retry_max_delay=6.0)
+    collector = stats_collector.StatsCollector()
+    retries = retry.RetryQueue(conf, broker.MessageBroker(conf), collector)
+    for i in range(100):
+        assert 0.5 <= retries.backoff(1) <= 1.0
+        assert 2.0 <= retries.backoff(3) <= 4.0
+        assert 3.0 <= retries.backoff(10) <= 6.0
+
+
+async def test_retry_gives_up_after_max_attempts() -> None:
+    conf = make_config()
+    collector = stats_collector.StatsCollector()
+    retries = retry.RetryQueue(conf, broker.MessageBroker(conf), collector)
+    prod = producer.SmsMessageProducer(conf, retries, collector)
+    batch = await prod.generate_message_batch(1)
+    await retries.put_batch(batch)
+    retries.shutdown()
+
+    assert await retries.get_batch() == batch
+    assert retries.retry(batch[0], attempt=0)
+    retried = await retries.get_batch()
+    assert retried is not None
+    assert retried.attempt == 1
+    assert retried[0].destination == batch[0].destination
+    assert retried[0].message == batch[0].message
+    assert retries.retry(retried[0], attempt=1)
+    retried = await retries.get_batch()
+    assert retried is not None
+    assert retried.attempt == 2
+    assert not retries.retry(retried[0], attempt=2)
+    # Nothing is left, so the broker shuts down behind the last message.
+    assert await retries.get_batch() is None
+    assert (await collector.get_stats()).retried == 2
+
+
+@pytest.mark.parametrize("engine", ["tasks", "timer_wheel"])
+async def test_every_message_finishes(engine: str) -> None:
+    conf = make_config(engine)
+    collector = stats_collector.StatsCollector()
+    retries = retry.RetryQueue(conf, broker.MessageBroker(conf), collector)
+    prod = producer.SmsMessageProducer(conf, retries, collector)
+
+    async def produce() -> None:
+        await prod.send_multiple_batches(20, 5)
+        retries.shutdown()
+
+    if engine == "tasks":
+        consumers = [
+            sender.Sender(conf, retries, collector, retries).consume_messages()
+            for i in range(5)
+        ]
+    else:
+        consumers = [wheel_sender.TimerWheelSender(conf, retries, collector, retries).run()]
+    await asyncio.wait_for(asyncio.gather(produce(), *consumers), 10)
+
+    stats = await collector.get_stats()
+    assert stats.produced == 100
+    assert stats.retried > 0
+    # Each failed attempt was either retried or given up on, and every
+    # message ended up sent or permanently failed.
+    assert stats.failed == stats.retried + stats.failed_permanently
+    assert stats.sent + stats.failed_permanently == 100
+    assert stats.dequeued == 100 + stats.retried
+    assert retries.outstanding == 0
+
+
+async def test_failed_sender_does_not_hang_the_retry_queue(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    conf = make_config()
+    collector = stats_collector.StatsCollector()
+    retries = retry.RetryQueue(conf, broker.MessageBroker(conf), collector)
+    prod = producer.SmsMessageProducer(conf, retries, collector)
+    send_message = sender.Sender.send_message
+    calls = 0
+
+    async def flaky_send(self: sender.Sender, msg: Message) -> sender.SendResult:
+        nonlocal calls
+        calls += 1
+        if calls == 3:
+            raise RuntimeError("send blew up")
+        return await send_message(self, msg)
+
+    monkeypatch.setattr(sender.Sender, "send_message", flaky_send)
+
+    async def produce() -> None:
+        await prod.send_multiple_batches(20, 5)
+        retries.shutdown()
+
+    consumers = [
+        sender.Sender(conf, retries, collector, retries).consume_messages()
+        for i in range(3)
+    ]
+    results = await asyncio.wait_for(
+        asyncio.gather(produce(), *consumers, return_exceptions=True), 10
+    )
+    assert sum(isinstance(result, RuntimeError) for result in results) == 1
+    # The failed sender's batch counts as finished, so the broker shut down.
+    assert retries.outstanding == 0
+    assert await retries.get_batch() is None
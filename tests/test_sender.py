@@ -1,7 +1,13 @@
+from typing import List
+
+import pytest
+
 import broker
 import config
 import producer
 import sender
+import sender_pool
+from sms_message import Message
 import stats_collector
 
 
@@ -30,3 +36,102 @@ async def test_stops_when_empty() -> None:
     stats = await collector.get_stats()
     assert stats.produced == 10 * 10
     assert stats.sent + stats.failed == 10 * 10
+
+
+async def test_windowed_sends_overlap(monkeypatch: pytest.MonkeyPatch) -> None:
+    collector = stats_collector.StatsCollector()
+    conf = config.Config(
+        send_time_mean=0.01, send_time_stddev=0.001, max_queued_batches=10, send_window=8
+    )
+    br = broker.MessageBroker(conf)
+    send = sender.Sender(conf, br, collector)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    in_flight = 0
+    most_in_flight = 0
+    send_message = sender.Sender.send_message
+
+    async def counting_send(self: sender.Sender, msg: Message) -> sender.SendResult:
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        try:
+            return await send_message(self, msg)
+        finally:
+            in_flight -= 1
+
+    monkeypatch.setattr(sender.Sender, "send_message", counting_send)
+    await prod.send_multiple_batches(4, 4)
+    br.shutdown()
+    await send.consume_messages()
+    stats = await collector.get_stats()
+    assert stats.dequeued == 16
+    assert stats.sent + stats.failed == 16
+    # Sends overlap, up to the window and no further.
+    assert most_in_flight == 8
+
+
+async def test_pool_starts_sending_before_it_is_complete(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    collector = stats_collector.StatsCollector()
+    await collector.log_started()
+    conf = config.Config(
+        sender_count=100,
+        sender_startup_chunk=10,
+        send_time_mean=0.0,
+        send_time_stddev=0.0,
+        max_queued_batches=10,
+    )
+    br = broker.MessageBroker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    await prod.send_multiple_batches(5, 2)
+    br.shutdown()
+    pool = sender_pool.SenderPool(conf, br, collector)
+    # The pool's size as each send finishes, which takes a pass of the loop.
+    sizes: List[int] = []
+    send_message = sender.Sender.send_message
+
+    async def recording_send(self: sender.Sender, msg: Message) -> sender.SendResult:
+        result = await send_message(self, msg)
+        sizes.append(pool.size)
+        return result
+
+    monkeypatch.setattr(sender.Sender, "send_message", recording_send)
+    await pool.run()
+
+    assert len(sizes) == 10
+    assert sizes[0] < 100
+    stats = await collector.get_stats()
+    assert stats.first_sent_at is not None
+    assert stats.time_to_first_sent is not None
+    assert stats.time_to_first_sent >= 0
+
+
+async def test_windowed_send_errors_are_raised(monkeypatch: pytest.MonkeyPatch) -> None:
+    collector = stats_collector.StatsCollector()
+    conf = config.Config(
+        send_time_mean=0.01, send_time_stddev=0.001, max_queued_batches=10, send_window=4
+    )
+    br = broker.MessageBroker(conf)
+    send = sender.Sender(conf, br, collector)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    send_message = sender.Sender.send_message
+    calls = 0
+
+    async def flaky_send(self: sender.Sender, msg: Message) -> sender.SendResult:
+        nonlocal calls
+        calls += 1
+        if calls == 3:
+            raise RuntimeError("send blew up")
+        return await send_message(self, msg)
+
+    monkeypatch.setattr(sender.Sender, "send_message", flaky_send)
+    await prod.send_multiple_batches(5, 4)
+    br.shutdown()
+    with pytest.raises(RuntimeError, match="send blew up"):
+        await send.consume_messages()
+    # The sender stopped taking batches soon after the failure, and every
+    # send it started besides the failed one finished.
+    stats = await collector.get_stats()
+    assert stats.dequeued < 20
+    assert stats.sent + stats.failed == calls - 1
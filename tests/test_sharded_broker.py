@@ -0,0 +1,134 @@
+import asyncio
+from array import array
+from typing import List
+
+import numpy as np
+
+import config
+import sharded_broker
+from sms_message import MessageBatch, SmsMessage
+
+
+def phone(i: int) -> str:
+    return f"555-{i // 10_000:03d}-{i % 10_000:04d}"
+
+
+def destinations(batch: MessageBatch) -> List[int]:
+    return list(np.frombuffer(batch.destinations, dtype=np.uint64).tolist())
+
+
+async def test_splits_batches_by_destination() -> None:
+    conf = config.Config(broker_shards=4, max_queued_batches=100, batch_size=10)
+    br = sharded_broker.ShardedBroker(conf)
+    messages = [SmsMessage(phone(i % 20), f"m{i}") for i in range(100)]
+    for start in range(0, 100, 10):
+        await br.put_batch(MessageBatch.from_messages(messages[start : start + 10], attempt=2))
+    assert sum(br.shard_depths()) == br.qsize()
+    assert all(depth > 0 for depth in br.shard_depths())
+
+    # Every message comes out exactly once, each destination from only one
+    # shard, and in the order it went in.
+    seen: dict[str, List[str]] = {}
+    for shard in br.shards:
+        shard_destinations = set()
+        for batch in shard:
+            assert batch.attempt == 2
+            shard_destinations.update(destinations(batch))
+            for msg in batch:
+                seen.setdefault(msg.destination, []).append(msg.message)
+        for other in br.shards:
+            if other is not shard:
+                for batch in other:
+                    assert shard_destinations.isdisjoint(destinations(batch))
+    for i in range(20):
+        assert seen[phone(i)] == [f"m{j}" for j in range(i, 100, 20)]
+
+
+async def test_home_shard_then_steal() -> None:
+    conf = config.Config(broker_shards=2, max_queued_batches=100)
+    br = sharded_broker.ShardedBroker(conf)
+    batches = [MessageBatch.from_messages([SmsMessage(phone(i), "x")]) for i in range(40)]
+    for batch in batches:
+        await br.put_batch(batch)
+    homes = [
+        sharded_broker.shard_of(np.frombuffer(b.destinations, dtype=np.uint64), 2)[0]
+        for b in batches
+    ]
+
+    async def drain() -> List[int]:
+        got: List[int] = []
+        while (batch := await br.get_batch()) is not None:
+            got.append(destinations(batch)[0])
+        return got
+
+    # The first reader is homed on shard 0; it takes all of shard 0 and
+    # then steals shard 1 once its own shard is empty.
+    task = asyncio.create_task(drain())
+    await asyncio.sleep(0)
+    br.shutdown()
+    got = await task
+    expected = [destinations(b)[0] for b, h in zip(batches, homes) if h == 0] + [
+        destinations(b)[0] for b, h in zip(batches, homes) if h == 1
+    ]
+    assert got == expected
+
+
+async def test_put_wakes_sender_on_other_shard() -> None:
+    conf = config.Config(broker_shards=4, max_queued_batches=100)
+    br = sharded_broker.ShardedBroker(conf)
+    # One waiting reader, homed on shard 0, gets batches for every shard.
+    reader = asyncio.create_task(br.get_batch())
+    await asyncio.sleep(0)
+    for i in range(20):
+        batch = MessageBatch.from_messages([SmsMessage(phone(i), "x")])
+        await br.put_batch(batch)
+        got = await asyncio.wait_for(reader, 1)
+        assert got is batch
+        reader = asyncio.create_task(br.get_batch())
+        await asyncio.sleep(0)
+    br.shutdown()
+    assert await reader is None
+
+
+async def test_shards_are_bounded() -> None:
+    # Each shard holds one batch of one message.
+    conf = config.Config(broker_shards=2, max_queued_batches=2, batch_size=1)
+    br = sharded_broker.ShardedBroker(conf)
+    same = [MessageBatch.from_messages([SmsMessage(phone(7), "x")]) for _ in range(2)]
+    await br.put_batch(same[0])
+    blocked = asyncio.create_task(br.put_batch(same[1]))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+    assert await br.get_batch() is same[0]
+    await blocked
+    br.shutdown()
+    assert await br.get_batch() is same[1]
+    assert await br.get_batch() is None
+
+
+async def test_shards_hold_max_queued_batches_worth_of_messages() -> None:
+    conf = config.Config(broker_shards=4, max_queued_batches=4, batch_size=10)
+    br = sharded_broker.ShardedBroker(conf)
+    for start in range(0, 40, 10):
+        batch = MessageBatch.from_messages(
+            [SmsMessage(phone(i * 7919), f"m{i}") for i in range(start, start + 10)]
+        )
+        # Each batch is split across the shards, but only counts once.
+        await asyncio.wait_for(br.put_batch(batch), 0.1)
+    assert br.qsize() > 4
+    assert sum(sum(len(batch) for batch in shard) for shard in br.shards) == 40
+
+
+def test_split_matches_take() -> None:
+    batch = MessageBatch.from_messages(
+        [SmsMessage(phone(i), "x" * (i % 7)) for i in range(50)], attempt=1, priority=2
+    )
+    batch.log_sequence = array("Q", range(100, 150))
+    shards = sharded_broker.shard_of(np.frombuffer(batch.destinations, dtype=np.uint64), 3)
+    parts = sharded_broker._split(batch, shards)
+    assert [shard for shard, _ in parts] == sorted(set(shards.tolist()))
+    for shard, part in parts:
+        expected = batch.take(np.flatnonzero(shards == shard).tolist())
+        assert part == expected
+        assert part.log_sequence == expected.log_sequence
+        assert (part.attempt, part.priority) == (1, 2)
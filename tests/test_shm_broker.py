@@ -0,0 +1,71 @@
+import asyncio
+import multiprocessing
+
+import pytest
+
+import config
+import producer
+import shm_broker
+import stats_collector
+
+
+def make_broker(conf: config.Config) -> shm_broker.SharedMemoryBroker:
+    return shm_broker.SharedMemoryBroker(conf, multiprocessing.get_context("spawn"))
+
+
+async def test_round_trip_and_drain() -> None:
+    conf = config.Config(max_queued_batches=10)
+    collector = stats_collector.StatsCollector()
+    br = make_broker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    batch1 = await prod.generate_message_batch(25)
+    batch2 = await prod.generate_message_batch(25)
+
+    await br.put_batch(batch1)
+    await br.put_batch(batch2)
+    br.shutdown()
+    with pytest.raises(asyncio.QueueShutDown):
+        await br.put_batch(batch1)
+    assert await br.get_batch() == batch1
+    assert await br.get_batch() == batch2
+    assert await br.get_batch() is None
+    br.close()
+
+
+async def test_wraps_around() -> None:
+    # A small ring forces records to wrap past the end many times.
+    conf = config.Config(max_queued_batches=100, ring_buffer_bytes=4096)
+    collector = stats_collector.StatsCollector()
+    br = make_broker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    batches = [await prod.generate_message_batch(3) for i in range(200)]
+
+    async def put_all() -> None:
+        for batch in batches:
+            await br.put_batch(batch)
+        br.shutdown()
+
+    put_task = asyncio.create_task(put_all())
+    received = []
+    while (res := await br.get_batch()) is not None:
+        received.append(res)
+    await put_task
+    assert received == batches
+    br.close()
+
+
+async def test_backpressure() -> None:
+    conf = config.Config(max_queued_batches=2)
+    collector = stats_collector.StatsCollector()
+    br = make_broker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    batch = await prod.generate_message_batch(1)
+
+    await br.put_batch(batch)
+    await br.put_batch(batch)
+    with pytest.raises(TimeoutError):
+        await asyncio.wait_for(br.put_batch(batch), 0.05)
+    await br.get_batch()
+    await asyncio.wait_for(br.put_batch(batch), 1)
+    br.close()
+
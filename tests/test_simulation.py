@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+
+import application
+import config
+import simulation
+from stats_collector import MessagingStats
+
+
+def test_virtual_clock_skips_sleeps() -> None:
+    async def sleep_an_hour() -> float:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(asyncio.sleep(3600), asyncio.sleep(1800))
+        return loop.time()
+
+    start = time.perf_counter()
+    end = simulation.run(sleep_an_hour(), config.Config(simulation=True))
+    assert time.perf_counter() - start < 1
+    assert end == pytest.approx(3600)
+
+
+def test_virtual_clock_waits_for_executor_work() -> None:
+    async def sleep_while_working() -> float:
+        loop = asyncio.get_running_loop()
+        timer = asyncio.ensure_future(asyncio.sleep(3600))
+        start = loop.time()
+        await loop.run_in_executor(None, time.sleep, 0.05)
+        elapsed = loop.time() - start
+        timer.cancel()
+        return elapsed
+
+    assert simulation.run(sleep_while_working(), config.Config(simulation=True)) == 0
+
+
+def run_app(conf: config.Config) -> MessagingStats:
+    app = application.Application("", conf)
+    simulation.run(app.run(), conf)
+    # Every producer and sender released its stats buffer.
+    assert not app.flusher.buffers
+    return asyncio.run(app.stats_collector.get_stats())
+
+
+def test_simulation_is_repeatable() -> None:
+    conf = config.Config(
+        message_count=2000,
+        batch_size=10,
+        sender_count=100,
+        send_time_mean=1.0,
+        send_time_stddev=0.1,
+        send_failure_rate=0.1,
+        retry_max_attempts=2,
+        max_queued_batches=20,
+        print_frequency=1000,
+        simulation=True,
+        simulation_seed=7,
+    )
+    start = time.perf_counter()
+    first = run_app(conf)
+    # About 20 s of simulated sends, plus retries.
+    assert time.perf_counter() - start < 10
+    assert first.sent + first.failed_permanently == 2000
+    assert first.retried > 0
+
+    assert run_app(conf) == first
+    assert run_app(config.Config(**{**conf.__dict__, "simulation_seed": 8})) != first
@@ -0,0 +1,48 @@
+from array import array
+import pickle
+
+from sms_message import MessageBatch, SmsMessage, decode_batch, encode_batch
+
+
+def make_batch() -> MessageBatch:
+    return MessageBatch.from_messages(
+        [
+            SmsMessage(destination="555-123-4567", message="hello"),
+            SmsMessage(destination="012-000-0000", message=""),
+            SmsMessage(destination="999-999-9999", message="héllo again"),
+        ]
+    )
+
+
+def test_message_views() -> None:
+    batch = make_batch()
+    assert len(batch) == 3
+    assert batch[0].destination == "555-123-4567"
+    assert batch[0].destination_number == 5551234567
+    assert batch[1].destination == "012-000-0000"
+    assert batch[1].message == ""
+    assert batch[-1].message == "héllo again"
+    assert [msg.message for msg in batch] == ["hello", "", "héllo again"]
+
+
+def test_batch_encoding() -> None:
+    batch = make_batch()
+    decoded = decode_batch(encode_batch(batch))
+    assert decoded == batch
+    assert [msg.destination for msg in decoded] == [
+        msg.destination for msg in batch
+    ]
+
+
+def test_batch_pickle() -> None:
+    batch = make_batch()
+    assert pickle.loads(pickle.dumps(batch)) == batch
+
+
+def test_batch_take() -> None:
+    batch = decode_batch(encode_batch(make_batch()))
+    batch.log_sequence = array("Q", [10, 11, 12])
+    taken = batch.take([2, 0])
+    assert [msg.message for msg in taken] == ["héllo again", "hello"]
+    assert [msg.log_sequence for msg in taken] == [12, 10]
+    assert isinstance(taken.bodies, bytes)
@@ -29,3 +29,23 @@ async def test_stats_collector() -> None:
     assert stats.sent == num_sent
     assert stats.failed == num_failed
     assert stats.average_time == pytest.approx(np.mean(times))
+
+
+async def test_remote_stats_are_merged() -> None:
+    collector = stats_collector.StatsCollector()
+    await collector.log_produced(10)
+    await collector.log_sent(1.0)
+
+    remote = stats_collector.MessagingStats(
+        produced=0, dequeued=4, sent=2, failed=1, average_time=3.0
+    )
+    await collector.log_remote_stats(0, remote)
+    # A newer snapshot from the same source replaces the old one.
+    await collector.log_remote_stats(0, remote)
+
+    stats = await collector.get_stats()
+    assert stats.produced == 10
+    assert stats.dequeued == 4
+    assert stats.sent == 3
+    assert stats.failed == 1
+    assert stats.average_time == pytest.approx((1.0 + 3 * 3.0) / 4)
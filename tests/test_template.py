@@ -0,0 +1,134 @@
+from array import array
+import pickle
+
+import numpy as np
+import pytest
+
+import broker
+import config
+import producer
+import recipients
+import sender
+from sms_message import MessageBatch, decode_batch, encode_batch
+import stats_collector
+from template import MessageTemplate, RenderCache, intern_template
+
+
+def test_render() -> None:
+    template = MessageTemplate("Alert for {0}: go to {1} ({0}) {{now}}")
+    assert template.field_count == 2
+    assert (
+        template.render(b"Ann\x1fshelter 4")
+        == "Alert for Ann: go to shelter 4 (Ann) {now}"
+    )
+    # Missing fields are left empty.
+    assert template.render(b"Ann") == "Alert for Ann: go to  (Ann) {now}"
+    assert MessageTemplate("Same for everyone").render(b"") == "Same for everyone"
+    with pytest.raises(ValueError):
+        MessageTemplate("Hello {name}")
+
+
+def test_intern() -> None:
+    template = intern_template("Hello {0}")
+    assert intern_template(b"Hello {0}") is template
+    assert intern_template(memoryview(b"Hello {0}")) is template
+
+
+def test_render_cache() -> None:
+    template = intern_template("Hello {0}")
+    cache = RenderCache(2)
+    first = cache.render(template, b"a")
+    assert first == "Hello a"
+    assert cache.render(template, b"a") is first
+    cache.render(template, b"b")
+    cache.render(template, b"c")
+    # "a" was the least recently used, so it was evicted.
+    assert cache.render(template, b"a") is not first
+
+
+def test_templated_batch_encoding() -> None:
+    template = intern_template("Hi {0}, your code is {1}")
+    batch = MessageBatch(
+        array("Q", [5551234567, 5550000000]),
+        array("I", [0, 8, 8]),
+        b"Bob\x1f1234",
+        template=template,
+    )
+    assert batch[0].message == "Hi Bob, your code is 1234"
+    assert batch[0].params == b"Bob\x1f1234"
+    assert batch[1].message == "Hi , your code is "
+    decoded = decode_batch(encode_batch(batch))
+    assert decoded.template is template
+    assert decoded == batch
+    assert pickle.loads(pickle.dumps(batch)) == batch
+    assert batch.take([0]).template is template
+
+
+def test_generated_batches() -> None:
+    conf = config.Config(message_template="{0} and {1}", template_field_length=5)
+    block = producer.generate_batch_block(np.random.default_rng(1), conf, 3, 4)
+    for batch in block:
+        assert batch.template is intern_template("{0} and {1}")
+        for msg in batch:
+            first, second = msg.params.split(b"\x1f")
+            assert len(first) == len(second) == 5
+            assert msg.message == f"{first.decode()} and {second.decode()}"
+
+
+def test_parse_rows_with_template() -> None:
+    template = intern_template("Dear {0}, meet at {1}")
+    batch, skipped = recipients.parse_rows(
+        [b"phone,name,place", b"5551234567,Ann,the hall", b'5550000001,"Smith, Bo",gym'],
+        b"",
+        template,
+    )
+    assert skipped == 1
+    assert [msg.message for msg in batch] == [
+        "Dear Ann, meet at the hall",
+        "Dear Smith, Bo, meet at gym",
+    ]
+
+
+async def test_sender_renders_template() -> None:
+    conf = config.Config(
+        message_template="Hello {0}",
+        send_time_mean=0,
+        send_time_stddev=0,
+        send_failure_rate=0,
+        max_queued_batches=10,
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    send = sender.Sender(conf, br, collector)
+    batch = producer.generate_batch_block(np.random.default_rng(1), conf, 1, 3)[0]
+    assert [send.render(msg) for msg in batch] == [msg.message for msg in batch]
+    await br.put_batch(batch)
+    br.shutdown()
+    await send.consume_messages()
+    assert (await collector.get_stats()).sent == 3
+
+
+async def test_simulated_sends_do_not_render(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    conf = config.Config(
+        message_template="Hello {0}",
+        send_time_mean=0,
+        send_time_stddev=0,
+        send_failure_rate=1,
+        max_queued_batches=10,
+    )
+    collector = stats_collector.StatsCollector()
+    br = broker.MessageBroker(conf)
+    send = sender.Sender(conf, br, collector)
+
+    def render(template: MessageTemplate, params: object) -> str:
+        raise AssertionError("rendered a simulated send")
+
+    monkeypatch.setattr(send.rendered, "render", render)
+    await br.put_batch(
+        producer.generate_batch_block(np.random.default_rng(1), conf, 1, 3)[0]
+    )
+    br.shutdown()
+    await send.consume_messages()
+    assert (await collector.get_stats()).failed == 3
@@ -0,0 +1,34 @@
+from timer_wheel import TimingWheel
+
+
+def test_expires_in_order_of_ticks() -> None:
+    wheel: TimingWheel[str] = TimingWheel(tick=0.1, slot_count=4)
+    wheel.schedule(0.25, "a")
+    wheel.schedule(0.05, "b")
+    wheel.schedule(0.35, "c")
+    assert len(wheel) == 3
+    assert wheel.advance(0.1) == ["b"]
+    assert wheel.advance(0.2) == []
+    assert wheel.advance(0.3) == ["a"]
+    assert wheel.advance(0.4) == ["c"]
+    assert len(wheel) == 0
+
+
+def test_items_beyond_one_revolution() -> None:
+    wheel: TimingWheel[int] = TimingWheel(tick=1.0, slot_count=3)
+    wheel.schedule(2.0, 1)
+    wheel.schedule(5.0, 2)  # Same slot as 2.0, one revolution later.
+    wheel.schedule(100.0, 3)
+    assert wheel.next_due() == 2.0
+    assert wheel.advance(2.0) == [1]
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == [2]
+    # Jumping far ahead visits every slot once.
+    assert wheel.advance(1000.0) == [3]
+
+
+def test_past_due_items_expire_on_next_tick() -> None:
+    wheel: TimingWheel[int] = TimingWheel(tick=1.0, slot_count=8, start=10.0)
+    wheel.schedule(3.0, 1)
+    assert wheel.advance(10.5) == []
+    assert wheel.advance(11.0) == [1]
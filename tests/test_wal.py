@@ -0,0 +1,157 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import List
+
+import application
+import broker
+import config
+from sms_message import MessageBatch, SmsMessage
+import wal
+
+
+def make_batch(start: int, count: int = 3) -> MessageBatch:
+    return MessageBatch.from_messages(
+        [SmsMessage(f"555-555-{i:04d}", f"message {i}") for i in range(start, start + count)]
+    )
+
+
+def wal_config(tmp_path: Path, **changes: object) -> config.Config:
+    return config.Config(**{"wal_dir": str(tmp_path / "wal"), **changes})  # type: ignore[arg-type]
+
+
+async def test_recovers_unfinished_messages(tmp_path: Path) -> None:
+    conf = wal_config(tmp_path)
+    log = wal.WriteAheadLog(conf)
+    assert log.recover() == []
+    batches = [make_batch(0), make_batch(3)]
+    for batch in batches:
+        await log.append(batch)
+    assert list(batches[1].log_sequence or []) == [3, 4, 5]
+    log.ack(batches[0][0])
+    log.ack(batches[0][1])
+    log.ack(batches[0][2])
+    log.ack(batches[1][1])
+    await log.close()
+
+    log = wal.WriteAheadLog(conf)
+    recovered = log.recover()
+    assert log.next_sequence == 6
+    assert recovered == [make_batch(3).take([0, 2])]
+    assert list(recovered[0].log_sequence or []) == [3, 5]
+    await log.close()
+
+
+async def test_group_commit(tmp_path: Path) -> None:
+    log = wal.WriteAheadLog(wal_config(tmp_path, wal_commit_interval=0.05))
+    log.recover()
+    writes: List[bytes] = []
+    write = log._write
+
+    def counting_write(data: bytes) -> None:
+        writes.append(data)
+        write(data)
+
+    log._write = counting_write  # type: ignore[method-assign]
+    # Batches appended within one commit interval share a group.
+    groups = [log.append(make_batch(3 * i)) for i in range(10)]
+    assert all(group is groups[0] for group in groups)
+    await groups[0]
+    assert len(writes) == 1
+    await log.close()
+
+
+async def test_stops_at_torn_record(tmp_path: Path) -> None:
+    conf = wal_config(tmp_path)
+    log = wal.WriteAheadLog(conf)
+    log.recover()
+    await log.append(make_batch(0))
+    await log.append(make_batch(3))
+    await log.close()
+    (segment,) = os.listdir(conf.wal_dir)
+    path = os.path.join(conf.wal_dir, segment)
+    os.truncate(path, os.path.getsize(path) - 20)
+
+    log = wal.WriteAheadLog(conf)
+    assert log.recover() == [make_batch(0)]
+    await log.close()
+
+
+async def test_deletes_finished_segments(tmp_path: Path) -> None:
+    conf = wal_config(tmp_path, wal_segment_bytes=1, wal_commit_interval=0)
+    log = wal.WriteAheadLog(conf)
+    log.recover()
+    batches = [make_batch(3 * i) for i in range(4)]
+    for batch in batches:
+        await log.append(batch)
+    assert len(log.segments) == 5
+    for msg in batches[1]:
+        log.ack(msg)
+    for msg in batches[0]:
+        log.ack(msg)
+    await log.close()
+    # Only the finished segments at the front are deleted, and the newest
+    # segment is kept to remember where the sequence numbers continue.
+    assert len(os.listdir(conf.wal_dir)) == 3
+
+    log = wal.WriteAheadLog(conf)
+    assert log.recover() == batches[2:]
+    assert log.next_sequence == 12
+    await log.close()
+
+
+async def test_durable_broker_passes_on_committed_batches(tmp_path: Path) -> None:
+    conf = wal_config(tmp_path, max_queued_batches=10)
+    log = wal.WriteAheadLog(conf)
+    log.recover()
+    durable = wal.DurableBroker(conf, broker.MessageBroker(conf), log)
+    batches = [make_batch(3 * i) for i in range(5)]
+    for batch in batches:
+        await durable.put_batch(batch)
+    durable.shutdown()
+    received = []
+    while (got := await durable.get_batch()) is not None:
+        received.append(got)
+    assert received == batches
+    assert all(batch.log_sequence is not None for batch in received)
+    await log.close()
+
+
+def test_application_resumes_unfinished_messages(tmp_path: Path) -> None:
+    conf = wal_config(
+        tmp_path,
+        message_count=100,
+        batch_size=10,
+        sender_count=20,
+        send_time_mean=0.001,
+        send_time_stddev=0,
+        send_failure_rate=0,
+        max_queued_batches=10,
+        print_frequency=1000,
+        monitor_probe_interval=0,
+    )
+
+    # An earlier run that logged 40 messages and finished 25 of them.
+    async def earlier_run() -> None:
+        log = wal.WriteAheadLog(conf)
+        log.recover()
+        for i in range(4):
+            batch = make_batch(10 * i, 10)
+            await log.append(batch)
+            for msg in batch[: 10 if i < 2 else 5 * (i - 2)]:
+                log.ack(msg)
+        await log.close()
+
+    asyncio.run(earlier_run())
+    app = application.Application("", conf)
+    asyncio.run(app.run())
+    stats = asyncio.run(app.stats_collector.get_stats())
+    assert stats.produced == 15 + 60
+    assert stats.sent == 75
+
+    # Everything is finished now, so another run has nothing to send.
+    app = application.Application("", conf)
+    asyncio.run(app.run())
+    stats = asyncio.run(app.stats_collector.get_stats())
+    assert stats.produced == 0
+    assert stats.sent == 0
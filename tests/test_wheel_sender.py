@@ -0,0 +1,53 @@
+import pytest
+
+import broker
+import config
+import producer
+from sms_message import MessageBatch
+import stats_collector
+import wheel_sender
+
+
+async def test_sends_all_messages() -> None:
+    collector = stats_collector.StatsCollector()
+    conf = config.Config(
+        sender_count=25,
+        send_time_mean=0.02,
+        send_time_stddev=0.005,
+        max_queued_batches=100,
+        wheel_tick=0.005,
+    )
+    br = broker.MessageBroker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    await prod.send_multiple_batches(20, 10)
+    br.shutdown()
+
+    engine = wheel_sender.TimerWheelSender(conf, br, collector)
+    await engine.run()
+    stats = await collector.get_stats()
+    assert stats.dequeued == 200
+    assert stats.sent + stats.failed == 200
+    assert 0.01 < stats.average_time < 0.03
+    assert engine.in_flight == 0
+
+
+async def test_receive_errors_reach_the_caller() -> None:
+    collector = stats_collector.StatsCollector()
+    conf = config.Config(sender_count=25, send_time_mean=0.01, wheel_tick=0.005)
+    br = broker.MessageBroker(conf)
+    prod = producer.SmsMessageProducer(conf, br, collector)
+    await prod.send_multiple_batches(1, 10)
+    batches = [await br.get_batch()]
+
+    class FailingBroker(broker.MessageBroker):
+        async def get_batch(self) -> None | MessageBatch:
+            if batches:
+                return batches.pop()
+            raise RuntimeError("broker failed")
+
+    engine = wheel_sender.TimerWheelSender(conf, FailingBroker(conf), collector)
+    with pytest.raises(RuntimeError, match="broker failed"):
+        await engine.run()
+    # What was received before the error was still sent.
+    stats = await collector.get_stats()
+    assert stats.sent + stats.failed == 10
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import tempfile
+from typing import Any
+
+import pytest
+
+import application
+import worker
+
+
+def test_shard_size() -> None:
+    sizes = [worker.shard_size(10, 4, i) for i in range(4)]
+    assert sizes == [3, 3, 2, 2]
+    assert sum(worker.shard_size(50_000, 7, i) for i in range(7)) == 50_000
+
+
+cfg_str = """
+[messages]
+message_count = 400
+min_message_length = 10
+max_message_length = 20
+
+[producer]
+producer_count = 2
+batch_size = 10
+
+[sender]
+sender_count = 20
+send_time_mean = 0.01
+send_time_stddev = 0.001
+send_failure_rate = 0.1
+
+[application]
+worker_processes = 2
+worker_stats_interval = 0.1
+
+[broker]
+max_queued_batches = 64
+"""
+
+
+@pytest.mark.parametrize("backend", ["queue", "shared_memory"])
+async def test_sharded_application(backend: str) -> None:
+    with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
+        fp.write(cfg_str.encode("utf-8"))
+        fp.write(f'backend = "{backend}"\n'.encode("utf-8"))
+        fp.close()
+        app = application.Application(fp.name)
+        await app.run()
+    stats = await app.stats_collector.get_stats()
+    assert stats.produced == 400
+    assert stats.dequeued == 400
+    assert stats.sent + stats.failed == 400
+
+
+def _die(*args: Any) -> None:
+    os._exit(1)
+
+
+async def test_all_workers_dying_stops_the_run(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(worker, "run_worker", _die)
+    with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
+        # Far more batches than the broker holds, so the producers block.
+        fp.write(cfg_str.replace("400", "100_000").encode("utf-8"))
+        fp.close()
+        app = application.Application(fp.name)
+        with pytest.raises(RuntimeError, match="worker processes exited"):
+            await asyncio.wait_for(app.run(), 30)
+    assert app.produce_task.cancelled()
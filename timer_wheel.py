@@ -0,0 +1,67 @@
+import math
+from typing import Generic, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Tolerance for converting times to ticks, so that e.g. 0.3 / 0.1 counts as
+# tick 3 despite floating point rounding.
+_EPSILON = 1e-9
+
+
+# A hashed timing wheel. Time is divided into ticks of `tick` seconds, and
+# an item due at tick t is kept in slot t % slot_count. Scheduling is O(1)
+# and advancing only looks at the slots for the ticks that have passed, so
+# the cost does not grow with the number of pending items the way a heap
+# does. Items due more than one revolution ahead stay in their slot until
+# the wheel comes around to their tick.
+class TimingWheel(Generic[T]):
+    def __init__(self, tick: float, slot_count: int, start: float = 0.0) -> None:
+        assert tick > 0
+        assert slot_count > 0
+        self.tick = tick
+        self.slots: List[List[Tuple[int, T]]] = [[] for i in range(slot_count)]
+        self.current_tick = math.floor(start / tick + _EPSILON)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def schedule(self, due: float, item: T) -> None:
+        # Items due in the past are returned by the next call to `advance`.
+        due_tick = max(math.ceil(due / self.tick - _EPSILON), self.current_tick + 1)
+        self.slots[due_tick % len(self.slots)].append((due_tick, item))
+        self.size += 1
+
+    def advance(self, now: float) -> List[T]:
+        # Return every item due at or before `now`, in no particular order.
+        target_tick = math.floor(now / self.tick + _EPSILON)
+        expired: List[T] = []
+        if target_tick <= self.current_tick:
+            return expired
+        # Past a full revolution every slot gets visited anyway.
+        last_tick = min(target_tick, self.current_tick + len(self.slots))
+        for t in range(self.current_tick + 1, last_tick + 1):
+            slot = self.slots[t % len(self.slots)]
+            if not slot:
+                continue
+            remaining: List[Tuple[int, T]] = []
+            for entry in slot:
+                if entry[0] <= target_tick:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[t % len(self.slots)] = remaining
+        self.current_tick = target_tick
+        self.size -= len(expired)
+        return expired
+
+    def next_due(self) -> None | float:
+        # Earliest time at which `advance` could return something, or None
+        # if the wheel is empty. This scans the wheel, so it is meant for
+        # occasional use such as deciding how long to sleep when idle.
+        if self.size == 0:
+            return None
+        earliest = min(
+            entry[0] for slot in self.slots for entry in slot
+        )
+        return earliest * self.tick
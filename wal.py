@@ -0,0 +1,369 @@
+from array import array
+import asyncio
+import bisect
+from dataclasses import dataclass
+import logging
+import mmap
+import os
+import struct
+from typing import IO, Iterator, List, Tuple
+import zlib
+
+import numpy as np
+import numpy.typing as npt
+
+from broker import Broker
+from config import Config
+from sms_message import Message, MessageBatch, MessageView, decode_batch, encode_batch
+
+log = logging.getLogger(__name__)
+
+# Each record is a header (kind, payload length, CRC-32 of the payload) and
+# the payload, padded to a multiple of 8 bytes so the columns of a logged
+# batch can be read in place.
+_RECORD = struct.Struct("<III4x")
+# A batch: the log sequence number of its first message, then the batch in
+# the packed encoding of sms_message.encode_batch.
+_BATCH = 1
+# Acknowledgements: the log sequence numbers of finished messages, as
+# unsigned 64-bit integers.
+_ACKS = 2
+_FIRST_SEQUENCE = struct.Struct("<Q")
+# Segments are named "<segment number>-<first log sequence number>.wal".
+_SUFFIX = ".wal"
+
+
+@dataclass
+class _Segment:
+    path: str
+    number: int
+    # Log sequence number of the first message logged in this segment. The
+    # segment holds the messages from here up to the next segment's first.
+    first_sequence: int
+    # Messages logged in this segment that are not finished.
+    unfinished: int = 0
+
+
+# A write-ahead log of the batches put into the broker and of the messages
+# that are finished (sent, or failed for good), so that a run that dies can
+# be restarted and only send what was not finished.
+#
+# Every logged message gets a log sequence number, counting up from 0 over
+# all runs, which travels with it in MessageBatch.log_sequence. Records are
+# appended to segment files in `wal_dir`, and written in group commits: one
+# write and fsync for everything appended in `wal_commit_interval` seconds,
+# or as soon as `wal_commit_bytes` are waiting, so durability costs one
+# fsync per group instead of one per batch. Acknowledgements are written with
+# the next group, and nothing waits for them; if they are lost, the message
+# is sent again after a restart, so delivery is at least once.
+#
+# A segment is closed once it is over `wal_segment_bytes`. Closed segments
+# are deleted, oldest first, once every message in them is finished; a
+# segment is only deleted when all older ones are, because its acks may be
+# for messages in older segments.
+#
+# Each run writes to a new segment, so a record cut short by a crash is only
+# ever at the end of a segment, where recovery stops reading.
+class WriteAheadLog:
+    def __init__(self, conf: Config) -> None:
+        self.config = conf
+        self.directory = conf.wal_dir
+        self.segments: List[_Segment] = []
+        self._first_sequences: List[int] = []
+        # The log sequence number of the next message appended.
+        self.next_sequence = 0
+        self._file: None | IO[bytes] = None
+        # Records waiting for the next group commit.
+        self._records: List[bytes] = []
+        self._acks = array("Q")
+        self._pending_bytes = 0
+        self._pending_messages = 0
+        self._group: None | asyncio.Future[None] = None
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._writer: None | asyncio.Task[None] = None
+        self._closing = False
+        self._error: None | BaseException = None
+
+    def recover(self) -> List[MessageBatch]:
+        # Read the log left by earlier runs, and return batches of the
+        # messages in it that are not finished, in the order they were
+        # logged. Also opens a new segment for this run, so it must be called
+        # once, before anything is appended.
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                number_text, first_text = name[: -len(_SUFFIX)].split("-")
+                self.segments.append(
+                    _Segment(
+                        os.path.join(self.directory, name),
+                        int(number_text),
+                        int(first_text),
+                    )
+                )
+        self.segments.sort(key=lambda segment: segment.number)
+
+        # First pass: everything that was acknowledged, and where the log
+        # ended.
+        acked_parts: List[npt.NDArray[np.uint64]] = []
+        for segment in self.segments:
+            self.next_sequence = max(self.next_sequence, segment.first_sequence)
+            for kind, payload in _scan(segment.path):
+                if kind == _BATCH:
+                    (first,) = _FIRST_SEQUENCE.unpack_from(payload)
+                    count = len(decode_batch(payload[_FIRST_SEQUENCE.size :]))
+                    self.next_sequence = max(self.next_sequence, first + count)
+                elif kind == _ACKS:
+                    acked_parts.append(np.frombuffer(payload, dtype=np.uint64).copy())
+        acked = np.unique(np.concatenate(acked_parts or [np.empty(0, np.uint64)]))
+
+        # Second pass: the batches, less their finished messages.
+        recovered: List[MessageBatch] = []
+        for segment in self.segments:
+            for kind, payload in _scan(segment.path):
+                if kind != _BATCH:
+                    continue
+                (first,) = _FIRST_SEQUENCE.unpack_from(payload)
+                batch = decode_batch(payload[_FIRST_SEQUENCE.size :])
+                sequences = np.arange(first, first + len(batch), dtype=np.uint64)
+                positions = np.searchsorted(acked, sequences)
+                finished = positions < len(acked)
+                finished[finished] = acked[positions[finished]] == sequences[finished]
+                unfinished = np.flatnonzero(~finished)
+                if len(unfinished) == 0:
+                    continue
+                segment.unfinished += len(unfinished)
+                batch.log_sequence = array("Q", sequences.tobytes())
+                batch.enqueued_at = None
+                recovered.append(batch.take(unfinished.tolist()))
+
+        number = self.segments[-1].number + 1 if self.segments else 0
+        self._open_segment(number, self.next_sequence)
+        return recovered
+
+    def append(self, batch: MessageBatch) -> asyncio.Future[None]:
+        # Log `batch`, giving its messages log sequence numbers. Returns a
+        # future that is done once the batch is on disk.
+        if self._error is not None:
+            raise self._error
+        count = len(batch)
+        batch.log_sequence = array(
+            "Q", range(self.next_sequence, self.next_sequence + count)
+        )
+        record = _record(
+            _BATCH, _FIRST_SEQUENCE.pack(self.next_sequence) + encode_batch(batch)
+        )
+        self.next_sequence += count
+        self._records.append(record)
+        self._pending_bytes += len(record)
+        self._pending_messages += count
+        if self._group is None:
+            self._group = asyncio.get_running_loop().create_future()
+        group = self._group
+        self._schedule()
+        return group
+
+    def ack(self, msg: Message) -> None:
+        # `msg` is finished: sent, or failed for good.
+        if not isinstance(msg, MessageView):
+            return
+        sequence = msg.log_sequence
+        if sequence is None:
+            return
+        self._acks.append(sequence)
+        self._pending_bytes += 8
+        index = bisect.bisect_right(self._first_sequences, sequence) - 1
+        self.segments[index].unfinished -= 1
+        self._schedule()
+
+    async def close(self) -> None:
+        # Commit everything still waiting, and close the log.
+        self._closing = True
+        if self._writer is not None:
+            self._wakeup.set()
+            self._full.set()
+            await self._writer
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _remove_files, self._take_finished())
+        if self._file is not None:
+            await loop.run_in_executor(None, self._file.close)
+            self._file = None
+
+    def _schedule(self) -> None:
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_groups())
+        self._wakeup.set()
+        if self._pending_bytes >= self.config.wal_commit_bytes:
+            self._full.set()
+
+    async def _write_groups(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            if not self._closing and self._pending_bytes < self.config.wal_commit_bytes:
+                # Give more records a chance to join the group.
+                try:
+                    await asyncio.wait_for(
+                        self._full.wait(), self.config.wal_commit_interval
+                    )
+                except TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._full.clear()
+            records = self._records
+            if self._acks:
+                records.append(_record(_ACKS, self._acks.tobytes()))
+            group = self._group
+            messages = self._pending_messages
+            self._records = []
+            self._acks = array("Q")
+            self._pending_bytes = 0
+            self._pending_messages = 0
+            self._group = None
+            if records:
+                try:
+                    await loop.run_in_executor(None, self._write, b"".join(records))
+                    self.segments[-1].unfinished += messages
+                    # Rotate before the group is done, so that its batches
+                    # are in a closed segment by the time anyone sees them.
+                    assert self._file is not None
+                    if (
+                        not self._closing
+                        and self._file.tell() >= self.config.wal_segment_bytes
+                    ):
+                        await self._rotate()
+                except BaseException as e:
+                    self._error = e
+                    if group is not None:
+                        group.set_exception(e)
+                    raise
+            if group is not None:
+                group.set_result(None)
+            if self._closing and not self._records and not self._acks:
+                return
+
+    def _write(self, data: bytes) -> None:
+        assert self._file is not None
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _rotate(self) -> None:
+        # Start a new segment at the first message not yet written, and
+        # delete the segments that are done with. Batches are appended and
+        # acknowledged while the files are opened and removed in the
+        # executor, so the segment list is only changed here, on the loop.
+        loop = asyncio.get_running_loop()
+        assert self._file is not None
+        number = self.segments[-1].number + 1
+        first = self.next_sequence - self._pending_messages
+        path = self._segment_path(number, first)
+        await loop.run_in_executor(None, self._file.close)
+        self._file = await loop.run_in_executor(None, open, path, "ab")
+        self._add_segment(path, number, first)
+        await loop.run_in_executor(None, _remove_files, self._take_finished())
+
+    def _open_segment(self, number: int, first_sequence: int) -> None:
+        path = self._segment_path(number, first_sequence)
+        self._file = open(path, "ab")
+        self._add_segment(path, number, first_sequence)
+
+    def _segment_path(self, number: int, first_sequence: int) -> str:
+        return os.path.join(self.directory, f"{number:08d}-{first_sequence:020d}{_SUFFIX}")
+
+    def _add_segment(self, path: str, number: int, first_sequence: int) -> None:
+        self.segments.append(_Segment(path, number, first_sequence))
+        self._first_sequences = [segment.first_sequence for segment in self.segments]
+
+    def _take_finished(self) -> List[str]:
+        # Drop the segments that can be deleted from the list, and return
+        # their paths. The segment being written to is never deleted: its
+        # name records where the log sequence numbers continue from.
+        deleted = 0
+        while deleted < len(self.segments) - 1 and self.segments[deleted].unfinished == 0:
+            deleted += 1
+        paths = [segment.path for segment in self.segments[:deleted]]
+        if deleted:
+            del self.segments[:deleted]
+            self._first_sequences = [segment.first_sequence for segment in self.segments]
+        return paths
+
+
+def _remove_files(paths: List[str]) -> None:
+    for path in paths:
+        os.remove(path)
+
+
+def _record(kind: int, payload: bytes) -> bytes:
+    padding = b"\0" * (-len(payload) % 8)
+    return _RECORD.pack(kind, len(payload), zlib.crc32(payload)) + payload + padding
+
+
+def _scan(path: str) -> Iterator[Tuple[int, memoryview]]:
+    # The records in a segment, as views into a read-only memory map of the
+    # file; the map goes away with the last view into it. Stops at the first
+    # record that is cut short or fails its checksum, which is where a crash
+    # interrupted a write.
+    with open(path, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size == 0:
+            return
+        view = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    position = 0
+    while position + _RECORD.size <= size:
+        kind, length, checksum = _RECORD.unpack_from(view, position)
+        start = position + _RECORD.size
+        end = start + length
+        if kind not in (_BATCH, _ACKS) or end > size:
+            return
+        payload = view[start:end]
+        if zlib.crc32(payload) != checksum:
+            return
+        yield kind, payload
+        position = end + (-length % 8)
+
+
+# Logs every batch put into `broker` in `wal` before passing it on, so that
+# senders only see batches that are on disk. Producers don't wait for the
+# fsync: batches wait in a queue of up to `max_queued_batches` until their
+# group is committed, and a task passes them on in order. Batches that are
+# already logged (recovered ones) are passed on as they are.
+class DurableBroker:
+    def __init__(self, conf: Config, broker: Broker, wal: WriteAheadLog) -> None:
+        self.config = conf
+        self.broker = broker
+        self.wal = wal
+        self._committing: asyncio.Queue[Tuple[None | asyncio.Future[None], MessageBatch]] = (
+            asyncio.Queue(conf.max_queued_batches)
+        )
+        self._forwarder: None | asyncio.Task[None] = None
+
+    async def put_batch(self, batch: MessageBatch) -> None:
+        if self._forwarder is None:
+            self._forwarder = asyncio.create_task(self._forward())
+        committed = None if batch.log_sequence is not None else self.wal.append(batch)
+        await self._committing.put((committed, batch))
+
+    def shutdown(self) -> None:
+        # The wrapped broker is shut down once every batch is passed on.
+        self._committing.shutdown()
+        if self._forwarder is None:
+            self.broker.shutdown()
+
+    async def get_batch(self) -> None | MessageBatch:
+        return await self.broker.get_batch()
+
+    async def _forward(self) -> None:
+        try:
+            while True:
+                committed, batch = await self._committing.get()
+                if committed is not None:
+                    await committed
+                await self.broker.put_batch(batch)
+        except asyncio.QueueShutDown:
+            pass
+        except Exception:
+            log.exception("Writing the write-ahead log failed")
+            self._committing.shutdown(immediate=True)
+        finally:
+            self.broker.shutdown()
@@ -0,0 +1,134 @@
+import asyncio
+import math
+import random
+from typing import List, Tuple
+
+import numpy as np
+
+from broker import Broker
+from config import Config
+from retry import RetryQueue
+from sms_message import MessageView
+from stats_collector import StatsCollector
+from timer_wheel import TimingWheel
+from wal import WriteAheadLog
+
+# (send time, whether the send failed, message, attempt)
+_InFlight = Tuple[float, bool, MessageView, int]
+
+
+# An alternative to running one Sender task per sender. Here `sender_count`
+# is only the limit on sends in flight: one task pulls batches from the
+# broker and schedules each message's simulated send on a timing wheel, and
+# another completes whatever is due on each tick and reports it to the
+# stats collector in aggregate. The CPU cost is a couple of tasks plus O(1)
+# per message, regardless of how many sends are in flight.
+class TimerWheelSender:
+    def __init__(
+        self,
+        conf: Config,
+        broker: Broker,
+        collector: StatsCollector,
+        retries: None | RetryQueue = None,
+        wal: None | WriteAheadLog = None,
+    ) -> None:
+        self.config = conf
+        self.broker = broker
+        self.collector = collector
+        self.retries = retries
+        self.wal = wal
+        # Seeded from `random`, so that seeding it (as simulation mode does)
+        # makes runs repeatable.
+        self.rng = np.random.default_rng(random.getrandbits(128))
+        self.in_flight = 0
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+        self._done_receiving = False
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        tick = self.config.wheel_tick
+        # Make one revolution cover nearly all send times, so most items are
+        # completed the first time the wheel reaches their slot.
+        horizon = self.config.send_time_mean + 6 * self.config.send_time_stddev
+        slot_count = max(1, math.ceil(horizon / tick)) + 1
+        self.wheel: TimingWheel[_InFlight] = TimingWheel(tick, slot_count, loop.time())
+        receive_task = asyncio.create_task(self._receive())
+        try:
+            await self._complete()
+        except BaseException:
+            receive_task.cancel()
+            raise
+        # Sends are only all complete once receiving has stopped, so the
+        # task is done; this raises the error it stopped with, if any.
+        await receive_task
+
+    async def _receive(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self._has_room.wait()
+                batch = await self.broker.get_batch()
+                if batch is None:
+                    break
+                count = len(batch)
+                now = loop.time()
+                await self.collector.log_dqueued(count)
+                if batch.enqueued_at is not None:
+                    await self.collector.log_queue_delay(
+                        now - batch.enqueued_at, batch.priority
+                    )
+                send_times = np.maximum(
+                    self.rng.normal(
+                        self.config.send_time_mean,
+                        self.config.send_time_stddev,
+                        count,
+                    ),
+                    0,
+                )
+                failures = self.rng.random(count) < self.config.send_failure_rate
+                for msg, send_time, failed in zip(
+                    batch, send_times.tolist(), failures.tolist()
+                ):
+                    self.wheel.schedule(
+                        now + send_time, (send_time, failed, msg, batch.attempt)
+                    )
+                self.in_flight += count
+                if self.in_flight >= self.config.sender_count:
+                    self._has_room.clear()
+        finally:
+            self._done_receiving = True
+
+    async def _complete(self) -> None:
+        loop = asyncio.get_running_loop()
+        tick = self.config.wheel_tick
+        while not (self._done_receiving and self.in_flight == 0):
+            await asyncio.sleep(tick)
+            done = self.wheel.advance(loop.time())
+            if not done:
+                continue
+            sent_times: List[float] = []
+            failed_times: List[float] = []
+            permanent_failures = 0
+            for send_time, failed, msg, attempt in done:
+                if failed:
+                    failed_times.append(send_time)
+                    if self.retries is None or not self.retries.retry(msg, attempt):
+                        permanent_failures += 1
+                        if self.wal is not None:
+                            self.wal.ack(msg)
+                else:
+                    sent_times.append(send_time)
+                    if self.wal is not None:
+                        self.wal.ack(msg)
+            if sent_times:
+                await self.collector.log_sent_many(sent_times)
+                if self.retries is not None:
+                    self.retries.done(len(sent_times))
+            if failed_times:
+                await self.collector.log_failed_many(failed_times)
+            if permanent_failures:
+                await self.collector.log_failed_permanently(permanent_failures)
+            self.in_flight -= len(done)
+            if self.in_flight < self.config.sender_count:
+                self._has_room.set()
@@ -0,0 +1,93 @@
+import asyncio
+import multiprocessing.queues
+from typing import Tuple
+
+import broker
+import broker_server
+from config import Config
+import local_stats
+import loop_probe
+import retry
+import sender_pool
+import shm_broker
+from stats_collector import MessagingStats, StatsCollector
+
+# (worker id, cumulative stats, whether this is the worker's final report)
+StatsReport = Tuple[int, MessagingStats, bool]
+
+
+def shard_size(total: int, shard_count: int, index: int) -> int:
+    # Split `total` into `shard_count` nearly equal parts, with the
+    # remainder going to the lowest-numbered shards.
+    base, remainder = divmod(total, shard_count)
+    return base + (1 if index < remainder else 0)
+
+
+def run_worker(
+    worker_id: int,
+    conf: Config,
+    source: broker.Broker,
+    stats_queue: "multiprocessing.queues.Queue[StatsReport]",
+) -> None:
+    # Entry point for a worker process. `conf.sender_count` is this
+    # worker's share of the senders, not the total.
+    asyncio.run(_run_worker(worker_id, conf, source, stats_queue))
+
+
+async def _run_worker(
+    worker_id: int,
+    conf: Config,
+    source: broker.Broker,
+    stats_queue: "multiprocessing.queues.Queue[StatsReport]",
+) -> None:
+    collector = StatsCollector()
+    flusher = local_stats.StatsFlusher(conf, collector)
+    flush_task = flusher.run()
+    queue = broker.local_broker(conf)
+    local_broker: broker.Broker = queue
+    retries: None | retry.RetryQueue = None
+    if conf.retry_max_attempts > 1:
+        # Retries stay within this worker, so they need no extra trip
+        # between processes.
+        retries = retry.RetryQueue(conf, local_broker, collector)
+        local_broker = retries
+    probe_task: None | asyncio.Task[None] = None
+    if conf.monitor_probe_interval > 0:
+        probe_task = loop_probe.LoopProbe(conf, collector, queue.lane_depths).run()
+    report_task = asyncio.create_task(
+        _report_stats(worker_id, conf, collector, stats_queue)
+    )
+
+    pool = sender_pool.SenderPool(conf, local_broker, collector, retries, flusher)
+    pool_task = asyncio.create_task(pool.run())
+    try:
+        await broker.pump_batches(source, local_broker)
+    except BaseException:
+        # Losing the source (such as the connection to a broker server) is
+        # not the end of the stream, so fail the worker rather than let the
+        # senders drain what they have and report a clean finish.
+        pool_task.cancel()
+        raise
+    await asyncio.gather(pool_task, return_exceptions=True)
+
+    if probe_task is not None:
+        probe_task.cancel()
+    report_task.cancel()
+    flush_task.cancel()
+    await flusher.flush_all()
+    if isinstance(source, shm_broker.SharedMemoryBroker):
+        source.close()
+    elif isinstance(source, broker_server.BrokerClient):
+        await source.close()
+    stats_queue.put((worker_id, await collector.get_stats(), True))
+
+
+async def _report_stats(
+    worker_id: int,
+    conf: Config,
+    collector: StatsCollector,
+    stats_queue: "multiprocessing.queues.Queue[StatsReport]",
+) -> None:
+    while True:
+        await asyncio.sleep(conf.worker_stats_interval)
+        stats_queue.put_nowait((worker_id, await collector.get_stats(), False))